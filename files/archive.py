@@ -0,0 +1,166 @@
+# archive.py
+# Архив закрытых заявок: база остаётся маленькой и быстрой, а история,
+# которую положено хранить, не удаляется (в отличие от /cleanup).
+#
+# Формат: на каждый месяц (по дате создания заявки) — файл
+# FILES_DIR/archive/YYYY-MM.jsonl.gz. Одна строка — одна заявка со всеми
+# полями и её ответами (JSON). Файл только дописывается: каждый перенос
+# добавляет блок — отдельный gzip-член (склеенные члены — обычный gzip,
+# `zcat 2025-01.jsonl.gz` читает весь месяц). Для zstd понадобилась бы
+# внешняя зависимость, а gzip есть в стандартной библиотеке.
+#
+# Оглавление в базе (db._m011_archive): archive_blocks — где лежит блок
+# (смещение, длина, sha256), archive_index — тикет -> блок. Поиск заявки в
+# архиве читает и распаковывает только её блок (до ARCHIVE_BATCH заявок), а
+# экспорт за период — только блоки, пересекающиеся с периодом. Автор, дата и
+# начало текста тоже лежат в оглавлении: «Мои обращения» жителя показывают
+# архивные заявки, не читая файлы. Полнотекстовый поиск (/search) архив не
+# охватывает — индекс FTS живёт в базе; архивная заявка открывается по номеру.
+#
+# Перенос идёт порциями по ARCHIVE_BATCH в транзакции писателя (db.archive_batch):
+# блок сначала дописывается в файл (с fsync), потом в той же транзакции
+# записывается оглавление и удаляются заявки. Сбой посередине оставляет
+# заявки в базе, а в файле — блок без ссылки, который никто не прочитает.
+#
+# Проверки — tests/test_archive.py.
+
+import asyncio
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from hashlib import sha256
+from pathlib import Path
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+import db
+import dedup
+from config import ARCHIVE_BATCH, ARCHIVE_GZIP_LEVEL, FILES_DIR
+
+log = logging.getLogger("bot.archive")
+
+ARCHIVE_DIR = Path(FILES_DIR) / "archive"
+# поля карточки заявки — в том же порядке, что в db.get_request_by_id
+FIELDS = [c.split(" ", 1)[0] for c in db.REQUESTS_BASE_COLUMNS]
+PROGRESS_EVERY = 3.0
+FILL_BATCH = 20  # блоков за запрос в fill_index
+
+Progress = Callable[[int], Awaitable[None]]
+
+# перенос в архив — по одному за раз: смещение блока берётся из размера файла
+_LOCK = asyncio.Lock()
+
+
+class ArchiveCorrupted(Exception):
+    pass
+
+
+def _append(month: str, records: List[dict]) -> Tuple[str, int, int, str]:
+    lines = "".join(json.dumps(r, ensure_ascii=False, separators=(",", ":")) + "\n" for r in records)
+    data = gzip.compress(lines.encode("utf-8"), compresslevel=ARCHIVE_GZIP_LEVEL)
+    rel = f"{month}.jsonl.gz"
+    path = ARCHIVE_DIR / rel
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "ab") as f:
+        offset = f.seek(0, os.SEEK_END)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return rel, offset, len(data), sha256(data).hexdigest()
+
+
+async def _write_block(month: str, records: List[dict]) -> Tuple[str, int, int, str]:
+    return await asyncio.to_thread(_append, month, records)
+
+
+def _read_text(rel: str, offset: int, length: int, digest: str) -> str:
+    with open(ARCHIVE_DIR / rel, "rb") as f:
+        f.seek(offset)
+        data = f.read(length)
+    if sha256(data).hexdigest() != digest:
+        raise ArchiveCorrupted(f"{rel}: блок со смещением {offset} повреждён")
+    return gzip.decompress(data).decode("utf-8")
+
+
+def _read_block(rel: str, offset: int, length: int, digest: str) -> List[dict]:
+    return [json.loads(line) for line in _read_text(rel, offset, length, digest).splitlines()]
+
+
+def _find_in_block(rel: str, offset: int, length: int, digest: str, ticket: str) -> Optional[dict]:
+    # разбираем JSON только нужной строки: поле ticket записано без пробелов (см. _append)
+    text = _read_text(rel, offset, length, digest)
+    pos = text.find(f'"ticket":{json.dumps(ticket, ensure_ascii=False)}')
+    if pos < 0:
+        return None
+    start = text.rfind("\n", 0, pos) + 1
+    end = text.find("\n", pos)
+    return json.loads(text[start:end if end >= 0 else len(text)])
+
+
+async def archive_before(date_yyyy_mm_dd: str, progress: Optional[Progress] = None) -> int:
+    """Перенести в архив закрытые заявки, созданные до даты. Возвращает их число."""
+    before_ms = int(datetime.strptime(date_yyyy_mm_dd, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp() * 1000)
+    done = 0
+    last = monotonic()
+    async with _LOCK:
+        while True:
+            ids = await db.archive_batch(before_ms, ARCHIVE_BATCH, _write_block)
+            if not ids:
+                break
+            dedup.forget(*ids)
+            done += len(ids)
+            if progress and monotonic() - last >= PROGRESS_EVERY:
+                last = monotonic()
+                await progress(done)
+            # между порциями писатель свободен — бот продолжает принимать заявки
+            await asyncio.sleep(0)
+    if done:
+        log.info("В архив перенесено заявок: %s", done)
+    return done
+
+
+async def lookup(ref) -> Optional[dict]:
+    """Архивная заявка по id или тикету: все поля и "replies" — или None."""
+    where = await db.find_archived(ref)
+    if not where:
+        return None
+    ticket, _request_id, rel, offset, length, digest = where
+    return await asyncio.to_thread(_find_in_block, rel, offset, length, digest, ticket)
+
+
+def as_row(record: dict) -> tuple:
+    """Запись архива -> строка в формате db.get_request_by_id (для карточки)."""
+    return tuple(record.get(f) for f in FIELDS)
+
+
+async def iter_rows(start_iso: str, end_iso: str) -> AsyncIterator[List[tuple]]:
+    """Архивные заявки за период порциями по блоку — строками экспорта (см. db.iter_export_requests)."""
+    start_ms, end_ms = (int(datetime.fromisoformat(x).replace(tzinfo=timezone.utc).timestamp() * 1000)
+                        for x in (start_iso, end_iso))
+    for rel, offset, length, digest in await db.list_archive_blocks(start_iso, end_iso):
+        records = await asyncio.to_thread(_read_block, rel, offset, length, digest)
+        rows = [as_row(r) + (r.get("media_sha256"),) for r in records
+                if start_ms <= (r.get("created_ts") or 0) <= end_ms]
+        if rows:
+            yield rows
+
+
+async def fill_index():
+    """Дописать автора, дату и начало текста в оглавление для заявок, перенесённых до _m017."""
+    after, filled = 0, 0
+    while blocks := await db.list_unindexed_blocks(after, FILL_BATCH):
+        for block_id, rel, offset, length, digest in blocks:
+            after = block_id
+            try:
+                records = await asyncio.to_thread(_read_block, rel, offset, length, digest)
+            except (OSError, ArchiveCorrupted) as e:
+                log.warning("Блок архива %s не прочитан: %s", block_id, e)
+                continue
+            await db.set_archive_owners([(r.get("user_id"), r.get("created_at"), r.get("text"), r["ticket"])
+                                         for r in records])
+            filled += len(records)
+    if filled:
+        log.info("Оглавление архива дополнено: %s заявок", filled)
+
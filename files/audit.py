@@ -0,0 +1,158 @@
+# audit.py
+# Журнал действий (таблица audit_log): кто и когда менял статус заявки,
+# направлял её в отдел, вёл диалог, отвечал; массовые и опасные операции
+# (чистка, закрытие всех активных, архив, рассылка, выдача прав админа).
+#
+# record() ничего не ждёт и не пишет в базу: событие с временем и автором
+# попадает в буфер в памяти, а фоновая задача сбрасывает буфер одной
+# транзакцией (executemany) — когда в нём набралось AUDIT_BATCH событий или
+# прошло AUDIT_FLUSH_EVERY секунд. Так журнал не добавляет коммит к каждому
+# действию оператора. Если запись не удалась, события остаются в буфере до
+# следующей попытки (не больше AUDIT_MAX_PENDING, старые отбрасываются).
+# stop_audit() при остановке бота сбрасывает всё, что накопилось.
+#
+# history() — история заявки для админа: записанное в базу плюс ещё не
+# сброшенное из буфера.
+#
+# Проверки — tests/test_audit.py.
+
+import asyncio
+import json
+import logging
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+import db
+from config import AUDIT_BATCH, AUDIT_FLUSH_EVERY, AUDIT_MAX_PENDING
+
+log = logging.getLogger("bot.audit")
+
+# ---- действия ----
+CREATED = "created"                 # житель создал заявку: {duplicate_of}
+STATUS = "status"                   # смена статуса: {was, to, original — исходная для дублей, bulk}
+ROUTE = "route"                     # направлена в отдел: {dept}
+DIALOG_START = "dialog_start"
+DIALOG_STOP = "dialog_stop"
+DIALOG_TIMEOUT = "dialog_timeout"   # диалог закрыт по неактивности
+REPLY = "reply"                     # разовый ответ жителю
+CLEANUP = "cleanup"                 # удаление заявок: {scope, before, deleted}
+BULK_CLOSE = "bulk_close"           # закрытие всех активных: {status, closed}
+ARCHIVE = "archive"                 # перенос в архив: {before, moved}
+BROADCAST = "broadcast"             # массовая рассылка: {chars}
+ADMIN = "admin"                     # выданы права администратора
+DEPARTMENT = "department"           # изменён отдел: {key, name, chat_id} или {key, active}
+
+LABELS = {
+    CREATED: "создана",
+    STATUS: "статус",
+    ROUTE: "направлена в отдел",
+    DIALOG_START: "начат диалог",
+    DIALOG_STOP: "диалог завершён",
+    DIALOG_TIMEOUT: "диалог закрыт по неактивности",
+    REPLY: "ответ жителю",
+    CLEANUP: "удаление заявок",
+    BULK_CLOSE: "закрытие всех активных",
+    ARCHIVE: "перенос в архив",
+    BROADCAST: "рассылка",
+    ADMIN: "выданы права администратора",
+    DEPARTMENT: "изменён отдел",
+}
+
+# (ticket, actor_id, action, details, created_at, created_ts) — как в db.save_audit
+Event = Tuple[Optional[str], Optional[int], str, Optional[str], str, int]
+
+_PENDING: List[Event] = []
+_WAKE: Optional[asyncio.Event] = None
+_FLUSHER: Optional[asyncio.Task] = None
+_stopping = False
+
+
+def record(action: str, ticket: Optional[str] = None, actor_id: Optional[int] = None, **details):
+    """Записать событие (в буфер; в базу — фоном). details — JSON-поля события."""
+    now = datetime.utcnow()
+    payload = json.dumps({k: v for k, v in details.items() if v is not None}, ensure_ascii=False) if details else None
+    _PENDING.append((
+        ticket, actor_id, action, payload,
+        now.isoformat(), int(now.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    ))
+    if len(_PENDING) >= AUDIT_BATCH and _WAKE is not None:
+        _WAKE.set()
+
+
+async def flush():
+    """Записать накопленные события одной транзакцией."""
+    global _PENDING
+    if not _PENDING:
+        return
+    events, _PENDING = _PENDING, []
+    try:
+        await db.save_audit(events)
+    except Exception as e:
+        # не теряем события: вернуть в начало буфера (новые могли прийти за время записи)
+        waiting = events + _PENDING
+        if len(waiting) > AUDIT_MAX_PENDING:
+            log.warning("Журнал: отброшено старых событий: %s", len(waiting) - AUDIT_MAX_PENDING)
+        _PENDING = waiting[-AUDIT_MAX_PENDING:]
+        log.warning("Не удалось записать журнал (%s событий ждут): %s", len(_PENDING), e)
+
+
+async def _flush_loop():
+    while not _stopping:
+        try:
+            await asyncio.wait_for(_WAKE.wait(), AUDIT_FLUSH_EVERY)
+        except asyncio.TimeoutError:
+            pass
+        _WAKE.clear()
+        await flush()
+
+
+async def start_audit():
+    global _WAKE, _FLUSHER, _stopping
+    _stopping = False
+    _WAKE = asyncio.Event()
+    _FLUSHER = asyncio.create_task(_flush_loop())
+
+
+async def stop_audit():
+    """Остановить фоновую запись и сбросить в базу всё, что осталось."""
+    global _FLUSHER, _stopping
+    if _FLUSHER:
+        # не отменяем задачу: отмена посреди flush() потеряла бы уже взятую из буфера пачку
+        _stopping = True
+        _WAKE.set()
+        await asyncio.gather(_FLUSHER, return_exceptions=True)
+        _FLUSHER = None
+    await flush()
+    if _PENDING:
+        log.warning("Остановка: не записано событий журнала: %s", len(_PENDING))
+
+
+async def history(ticket: str, limit: int = 50) -> List[Tuple[Optional[int], str, dict, str]]:
+    """Последние limit событий заявки, старые первыми: [(actor_id, action, details, created_at)]."""
+    rows = [(a, act, d, at, ts) for a, act, d, at, ts in await db.list_audit(ticket, limit)]
+    rows += [(a, act, d, at, ts) for t, a, act, d, at, ts in _PENDING if t == ticket]
+    rows.sort(key=lambda r: r[4])
+    return [(a, act, json.loads(d) if d else {}, at) for a, act, d, at, _ts in rows[-limit:]]
+
+
+def describe(action: str, details: dict) -> str:
+    """Событие одной строкой для карточки истории."""
+    text = LABELS.get(action, action)
+    if action == STATUS:
+        text += f": {details['was']} → {details['to']}" if details.get("was") else f": {details.get('to')}"
+        if details.get("original"):
+            text += f" (вместе с {details['original']})"
+        if details.get("bulk"):
+            text += " (массово)"
+    elif action == CREATED and details.get("duplicate_of"):
+        text += f" как дубль {details['duplicate_of']}"
+    elif action == ROUTE:
+        text += f": {details.get('dept')}"
+    elif action == CLEANUP:
+        text += f" ({details.get('scope')}{' до ' + details['before'] if details.get('before') else ''}): {details.get('deleted')}"
+    elif action == BULK_CLOSE:
+        text += f": {details.get('closed')}"
+    elif action == ARCHIVE:
+        text += f" до {details.get('before')}: {details.get('moved')}"
+    return text
+
@@ -0,0 +1,129 @@
+# broadcast.py
+# Массовая рассылка в фоне.
+# Задание и состояние каждого получателя хранятся в БД (broadcast_jobs /
+# broadcast_recipients), поэтому после рестарта рассылка продолжается с того
+# места, где остановилась. Отправка идёт параллельно (не больше
+# BROADCAST_CONCURRENCY одновременно) через общий лимитер из ratelimit.py.
+# Админ видит одно сообщение с прогрессом, которое обновляется по ходу.
+
+import asyncio
+import logging
+from time import monotonic
+from typing import Dict, Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from callbacks import OP_BROADCAST_STOP, pack
+from config import BROADCAST_BATCH, BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_EVERY
+from db import (
+    broadcast_mark, broadcast_pending, create_broadcast, finish_broadcast,
+    get_broadcast, list_running_broadcasts
+)
+from ratelimit import send_with_retry
+
+log = logging.getLogger("bot.broadcast")
+
+# job_id -> задача, которая ведёт рассылку
+_TASKS: Dict[int, asyncio.Task] = {}
+# задания, которые админ попросил остановить
+_CANCELLED: set = set()
+
+
+def _stop_keyboard(job_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("⏹ Остановить", callback_data=pack(OP_BROADCAST_STOP, job_id))]])
+
+
+async def _show_progress(bot, chat_id: int, message_id: int, job_id: int, final: Optional[str] = None):
+    row = await get_broadcast(job_id)
+    if not row or not message_id:
+        return
+    total, sent, failed, _status = row
+    title = final or "📣 Рассылка идёт…"
+    text = f"{title}\nОтправлено: {sent} из {total}\nОшибок: {failed}"
+    try:
+        await bot.edit_message_text(
+            chat_id=chat_id, message_id=message_id, text=text,
+            reply_markup=None if final else _stop_keyboard(job_id)
+        )
+    except BadRequest:
+        # «message is not modified» и т.п. — не критично
+        pass
+    except Exception as e:
+        log.warning("Не удалось обновить прогресс рассылки %s: %s", job_id, e)
+
+
+async def _send_one(bot, sem: asyncio.Semaphore, uid: int, text: str):
+    async with sem:
+        try:
+            await send_with_retry(lambda: bot.send_message(chat_id=uid, text=text), uid)
+            return uid, "sent", None
+        except Exception as e:
+            return uid, "failed", str(e)[:200]
+
+
+async def _run(bot, job_id: int, chat_id: int, message_id: int, text: str):
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_uid = 0
+    last_progress = 0.0
+    try:
+        while job_id not in _CANCELLED:
+            batch = await broadcast_pending(job_id, last_uid, BROADCAST_BATCH)
+            if not batch:
+                break
+            results = await asyncio.gather(*(_send_one(bot, sem, uid, text) for uid in batch))
+            await broadcast_mark(job_id, results)
+            last_uid = batch[-1]
+            if monotonic() - last_progress >= BROADCAST_PROGRESS_EVERY:
+                last_progress = monotonic()
+                await _show_progress(bot, chat_id, message_id, job_id)
+        if job_id in _CANCELLED:
+            await finish_broadcast(job_id, "cancelled")
+            await _show_progress(bot, chat_id, message_id, job_id, final="⏹ Рассылка остановлена.")
+        else:
+            await finish_broadcast(job_id, "done")
+            await _show_progress(bot, chat_id, message_id, job_id, final="✅ Рассылка завершена.")
+    except asyncio.CancelledError:
+        # остановка бота: задание остаётся 'running' и продолжится после рестарта
+        raise
+    except Exception:
+        log.exception("Рассылка %s упала", job_id)
+    finally:
+        _TASKS.pop(job_id, None)
+        _CANCELLED.discard(job_id)
+
+
+def _spawn(bot, job_id: int, chat_id: int, message_id: int, text: str):
+    _TASKS[job_id] = asyncio.create_task(_run(bot, job_id, chat_id, message_id, text))
+
+
+async def start_broadcast(bot, admin_id: int, chat_id: int, message_id: int, text: str) -> int:
+    """Создать задание и запустить его в фоне. Возвращает job_id сразу."""
+    job_id, total = await create_broadcast(admin_id, chat_id, message_id, text)
+    log.info("Рассылка %s: %s получателей", job_id, total)
+    await _show_progress(bot, chat_id, message_id, job_id)
+    _spawn(bot, job_id, chat_id, message_id, text)
+    return job_id
+
+
+def cancel_broadcast(job_id: int) -> bool:
+    if job_id not in _TASKS:
+        return False
+    _CANCELLED.add(job_id)
+    return True
+
+
+async def resume_broadcasts(bot):
+    """Вызывается при старте: продолжить незавершённые рассылки."""
+    for job_id, chat_id, message_id, text in await list_running_broadcasts():
+        if job_id not in _TASKS:
+            log.info("Продолжаем рассылку %s", job_id)
+            _spawn(bot, job_id, chat_id, message_id, text)
+
+
+async def stop_broadcasts():
+    """Вызывается при остановке бота: прервать задачи, состояние уже в БД."""
+    tasks = list(_TASKS.values())
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,117 @@
+# bulk.py
+# Массовые операции над заявками: чистка (/cleanup, «Опасные операции») и
+# закрытие всех активных (/bulkclose).
+#
+# Раньше каждая шла одним DELETE/UPDATE: на сотне тысяч строк (с триггерами
+# поиска, гео и отчётности) это секунды, и всё это время держится замок
+# писателя — новые заявки жителей ждут. Теперь операция идёт порциями по
+# BULK_BATCH заявок по диапазону id (db.cleanup_batch / db.close_active_batch),
+# а между порциями уступает писателя остальным. Админ видит прогресс.
+# Заявки, созданные уже во время операции, она не трогает (граница — наибольший
+# id на старте).
+#
+# При закрытии жителям уходит уведомление о статусе — через outbox, в той же
+# транзакции, что и порция, с низким приоритетом: уведомления о новых и
+# экстренных заявках идут раньше. Несколько заявок одного жителя из порции —
+# одним сообщением.
+#
+# Одновременно идёт одна массовая операция (busy()).
+#
+# Задержка приёма заявок во время чистки — tests/test_bulk.py.
+
+import asyncio
+import logging
+from time import monotonic
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import audit
+import db
+import dedup
+from config import BULK_BATCH, BULK_PAUSE
+import outbox
+
+log = logging.getLogger("bot.bulk")
+
+PROGRESS_EVERY = 3.0
+MAX_TICKETS_IN_MESSAGE = 20
+
+Progress = Callable[[int, int], Awaitable[None]]
+Step = Callable[[int], Awaitable[Tuple[int, Optional[int]]]]
+
+_LOCK = asyncio.Lock()
+
+
+def busy() -> bool:
+    return _LOCK.locked()
+
+
+async def _run(step: Step, total: int, progress: Optional[Progress]) -> int:
+    done, after, last = 0, 0, monotonic()
+    while True:
+        n, after = await step(after)
+        if after is None:
+            return done
+        done += n
+        if progress and monotonic() - last >= PROGRESS_EVERY:
+            last = monotonic()
+            await progress(done, total)
+        await asyncio.sleep(BULK_PAUSE)
+
+
+async def cleanup(
+    scope: str, before: Optional[str] = None, progress: Optional[Progress] = None, actor_id: Optional[int] = None
+) -> int:
+    """Удалить заявки: scope — active | all | before (с датой YYYY-MM-DD). Возвращает число удалённых."""
+    async with _LOCK:
+        total, upto = await db.count_cleanup(scope, before)
+
+        async def step(after: int):
+            ids, last = await db.cleanup_batch(scope, after, upto, BULK_BATCH, before)
+            dedup.forget(*ids)
+            return len(ids), last
+
+        done = await _run(step, total, progress)
+    log.info("Чистка %s%s: удалено %s", scope, f" до {before}" if before else "", done)
+    audit.record(audit.CLEANUP, actor_id=actor_id, scope=scope, before=before, deleted=done)
+    return done
+
+
+def _status_text(tickets: List[str], status: str) -> str:
+    if len(tickets) == 1:
+        return f"Статус вашей заявки {tickets[0]} изменён: {status}"
+    shown = ", ".join(tickets[:MAX_TICKETS_IN_MESSAGE])
+    more = f" и ещё {len(tickets) - MAX_TICKETS_IN_MESSAGE}" if len(tickets) > MAX_TICKETS_IN_MESSAGE else ""
+    return f"Статус ваших заявок изменён: {status}\n{shown}{more}"
+
+
+def _status_messages(rows: List[Tuple[int, str, int]], status: str) -> List[db.OutboxRow]:
+    by_user: Dict[int, List[str]] = {}
+    for _id, ticket, user_id in rows:
+        by_user.setdefault(user_id, []).append(ticket)
+    return [
+        outbox.message(user_id, _status_text(tickets, status), f"status:{tickets[0]}:{status}", outbox.PRIORITY_BACKGROUND)
+        for user_id, tickets in by_user.items()
+    ]
+
+
+async def close_active(
+    progress: Optional[Progress] = None, status: str = "Завершено", actor_id: Optional[int] = None
+) -> int:
+    """Перевести все активные заявки в status и уведомить авторов. Возвращает число закрытых."""
+    async with _LOCK:
+        total, upto = await db.count_cleanup("active")
+
+        async def step(after: int):
+            rows, last = await db.close_active_batch(
+                after, upto, BULK_BATCH, status, outbox=lambda closed: _status_messages(closed, status)
+            )
+            for request_id, ticket, _user_id in rows:
+                dedup.forget(request_id)
+                audit.record(audit.STATUS, ticket, actor_id, to=status, bulk=True)
+            return len(rows), last
+
+        done = await _run(step, total, progress)
+    log.info("Массовое закрытие: %s заявок", done)
+    audit.record(audit.BULK_CLOSE, actor_id=actor_id, status=status, closed=done)
+    return done
+
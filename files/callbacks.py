@@ -0,0 +1,175 @@
+# callbacks.py
+# Инлайн-кнопки: компактный формат callback_data и диспетчер по коду действия.
+#
+# Формат: "<код действия>:<арг>:<арг>…", где код — пара букв и номер версии
+# ("o1", "st1"). Аргументы кодируются коротко: заявка — её числовой id
+# (а не тикет), статус — одной буквой. Так данные кнопки укладываются в
+# 64 байта Telegram с большим запасом, даже если формат тикета вырастет.
+#
+# Версия входит в код: если у действия меняются аргументы, заводится новый
+# код ("o2"), а обработчик старого остаётся, пока живы старые сообщения.
+# Кнопки в формате до перехода ("open:T…", "status:T…:Завершено") тоже
+# разбираются — см. LEGACY.
+#
+# Поиск обработчика — один словарь по коду, без цепочки startswith.
+# Проверки — tests/test_callbacks.py.
+
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+MAX_DATA = 64  # лимит Telegram на callback_data, байт
+
+# ---- коды действий ----
+OP_OPEN_USER = "ou1"        # житель: своя карточка (заявка)
+OP_OPEN_USER_PAGED = "ou2"  # то же из списка: (заявка, курсор страницы) — с кнопкой «К списку»
+OP_MY_PAGE = "mp1"          # житель: страница «Мои обращения» (направление, created_ts, id)
+OP_CATEGORY = "c1"          # житель: выбор категории (ключ)
+OP_ROUTE_MENU = "rm1"       # админ: меню отделов (заявка)
+OP_ROUTE = "r1"             # админ: направить в отдел (заявка, ключ отдела)
+OP_BROADCAST_OK = "bc1"     # админ: подтвердить рассылку
+OP_BROADCAST_STOP = "bs1"   # админ: остановить рассылку (id задания)
+OP_BROADCAST_CANCEL = "bx1" # админ: отменить рассылку
+OP_CLEAN_ACTIVE = "da1"     # админ: удалить активные (подтверждение)
+OP_BULKCLOSE = "db1"        # админ: закрыть активные (подтверждение)
+OP_DANGER_CANCEL = "dx1"    # админ: отмена опасной операции
+OP_OPEN = "o1"              # админ: карточка заявки
+OP_OPEN_PAGED = "o2"        # то же из очереди: (заявка, курсор страницы) — с кнопкой «К списку»
+OP_QUEUE_PAGE = "q1"        # админ: страница очереди (направление, created_ts, id)
+OP_QUEUE_FILTER = "qf1"     # админ: выбор значения фильтра очереди (поле)
+OP_QUEUE_SET = "qs1"        # админ: установить фильтр (поле, значение)
+OP_SEARCH_PAGE = "sp1"      # админ: страница результатов поиска (номер поиска, страница)
+OP_OPEN_FOUND = "o3"        # то же из поиска: (заявка, номер поиска, страница) — с кнопкой «К списку»
+OP_NEARBY = "nb1"           # админ: активные заявки рядом с заявкой (заявка, радиус в метрах)
+OP_OPEN_NEARBY = "o4"       # то же из «Рядом»: (заявка, исходная заявка, радиус) — с кнопкой «К списку»
+OP_DIALOG_START = "gs1"     # админ: начать диалог (заявка)
+OP_DIALOG_STOP = "gp1"      # админ: завершить диалог (заявка)
+OP_STATUS = "st1"           # админ: сменить статус (заявка, код статуса)
+OP_REPLY = "rp1"            # админ: разовый ответ (заявка)
+OP_NOOP = "n1"              # ничего не делать
+OP_HISTORY = "h1"           # админ: история заявки из журнала действий (заявка)
+
+
+# ---- кодирование аргументов ----
+Ref = Union[int, str]  # ссылка на заявку: id или (в старых кнопках) тикет
+
+
+class Codes:
+    """Перечисление <-> короткий код. Неизвестный код не расшифровывается."""
+
+    def __init__(self, mapping: Dict[str, str]):
+        self.to_code = dict(mapping)
+        self.from_code = {c: v for v, c in mapping.items()}
+        if len(self.from_code) != len(self.to_code):
+            raise ValueError("Коды перечисления повторяются")
+
+    def encode(self, value: str) -> str:
+        return self.to_code[value]
+
+    def decode(self, code: str) -> str:
+        return self.from_code[code]
+
+
+STATUS = Codes({"Новый": "n", "В обработке": "p", "Завершено": "d", "Отклонено": "x"})
+
+
+def ref(s: str) -> Ref:
+    """Заявка в аргументе: цифры — id, иначе тикет (старые кнопки, диалог)."""
+    return int(s) if s.isdigit() else s
+
+
+def pack(op: str, *args) -> str:
+    """Собрать callback_data. Ссылки на заявку передавайте id (int), если он известен."""
+    data = ":".join((op,) + tuple(str(a) for a in args))
+    if len(data.encode()) > MAX_DATA:
+        raise ValueError(f"callback_data длиннее {MAX_DATA} байт: {data!r}")
+    return data
+
+
+# ---- старый формат ----
+# префикс -> (код действия, разбор аргументов после префикса)
+LEGACY: Dict[str, Tuple[str, List[Callable[[str], object]]]] = {
+    "openuser": (OP_OPEN_USER, [str]),
+    "cat": (OP_CATEGORY, [str]),
+    "route_menu": (OP_ROUTE_MENU, [str]),
+    "route": (OP_ROUTE, [str, str]),
+    "broadcast:confirm": (OP_BROADCAST_OK, []),
+    "broadcast:stop": (OP_BROADCAST_STOP, [int]),
+    "broadcast:cancel": (OP_BROADCAST_CANCEL, []),
+    "danger:clean_active:confirm": (OP_CLEAN_ACTIVE, []),
+    "danger:bulkclose_active:confirm": (OP_BULKCLOSE, []),
+    "danger:cancel": (OP_DANGER_CANCEL, []),
+    "open": (OP_OPEN, [str]),
+    "dialog:start": (OP_DIALOG_START, [str]),
+    "dialog:stop": (OP_DIALOG_STOP, [str]),
+    "status": (OP_STATUS, [str, str]),  # тут статус — полным текстом
+    "reply": (OP_REPLY, [str]),
+    "noop": (OP_NOOP, [str]),
+}
+
+
+# ---- реестр ----
+Handler = Callable[..., Awaitable[None]]  # handler(update, context, *args)
+
+
+class Action:
+    __slots__ = ("op", "handler", "parsers", "admin")
+
+    def __init__(self, op: str, handler: Handler, parsers, admin: bool):
+        self.op = op
+        self.handler = handler
+        self.parsers = parsers
+        self.admin = admin
+
+
+class CallbackRegistry:
+    def __init__(self):
+        self._actions: Dict[str, Action] = {}
+
+    def action(self, op: str, *parsers: Callable[[str], object], admin: bool = False):
+        """Обработчик кода op; parsers разбирают аргументы по порядку."""
+        def deco(handler: Handler) -> Handler:
+            if op in self._actions:
+                raise ValueError(f"Действие {op} уже зарегистрировано")
+            self._actions[op] = Action(op, handler, parsers, admin)
+            return handler
+        return deco
+
+    def decode(self, data: str) -> Optional[Tuple[Action, list]]:
+        """Найти действие и разобрать аргументы. None — кнопка не распознана."""
+        head, _, rest = data.partition(":")
+        action = self._actions.get(head)
+        if action is not None:
+            parsers = action.parsers
+            if not parsers:
+                return (action, []) if not rest else None
+            raw = rest.split(":")
+            if len(raw) != len(parsers):
+                return None
+            try:
+                if len(raw) == 1:  # самый частый случай — только заявка
+                    return action, [parsers[0](rest)]
+                return action, [p(a) for p, a in zip(parsers, raw)]
+            except (KeyError, ValueError):
+                return None
+        return self._decode_legacy(data)
+
+    def _decode_legacy(self, data: str) -> Optional[Tuple[Action, list]]:
+        parts = data.split(":")
+        # самый длинный подходящий префикс: "danger:cancel" раньше "danger"
+        for n in range(len(parts), 0, -1):
+            legacy = LEGACY.get(":".join(parts[:n]))
+            if legacy is None:
+                continue
+            op, parsers = legacy
+            action = self._actions.get(op)
+            raw = parts[n:]
+            # последний аргумент забирает остаток (в старом формате он мог содержать «:»)
+            if action is None or len(raw) < len(parsers) or (not parsers and raw):
+                return None
+            if parsers and len(raw) > len(parsers):
+                raw = raw[:len(parsers) - 1] + [":".join(raw[len(parsers) - 1:])]
+            try:
+                return action, [p(a) for p, a in zip(parsers, raw)]
+            except ValueError:
+                return None
+        return None
+
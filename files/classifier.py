@@ -0,0 +1,96 @@
+# classifier.py
+# Автоопределение экстренной категории по тексту заявки.
+# Все ключевые слова из config.URGENT_KEYWORDS собираются в одно регулярное
+# выражение в виде префиксного дерева (trie): на каждой позиции текста
+# проверяется не каждое слово по очереди, а только ветка дерева — поэтому
+# время почти не зависит от размера словаря. За один проход находим все
+# совпадения и ранжируем категории.
+#
+# Ключевые слова — это основы слов («наводнен», «заминир»): совпадение
+# ищется с начала слова, любое окончание допускается («наводнение»,
+# «заминировали»). Пробел в ключе совпадает с любым количеством пробелов.
+# «ё» приравнивается к «е».
+#
+# Проверки (в том числе скорость против цикла `kw in text`) — tests/test_classifier.py.
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+import config
+
+
+def _norm(s: str) -> str:
+    return (s or "").lower().replace("ё", "е")
+
+
+def _trie_regex(words) -> str:
+    """Собрать из списка слов регулярку-дерево: ['бомба','бпла'] -> 'б(?:омба|пла)'."""
+    trie: Dict = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def build(node) -> str:
+        end = "" in node
+        branches = []
+        for ch in sorted(k for k in node if k):
+            piece = r"\s+" if ch == " " else re.escape(ch)
+            branches.append(piece + build(node[ch]))
+        if not branches:
+            return ""
+        if len(branches) == 1 and not end:
+            return branches[0]
+        body = "(?:" + "|".join(branches) + ")"
+        return body + "?" if end else body
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    def __init__(self, keywords: Dict[str, str]):
+        self.source = keywords
+        self.size = len(keywords)
+        self._cat = {" ".join(_norm(k).split()): v for k, v in keywords.items()}
+        self._re = re.compile(r"\b(" + _trie_regex(self._cat) + r")") if self._cat else None
+        self._space = re.compile(r"\s+")
+
+    def matches(self, text: str) -> List[Tuple[str, int]]:
+        """Все категории из текста: [(категория, число совпадений)], лучшая — первой."""
+        if self._re is None:
+            return []
+        counts: Dict[str, int] = {}
+        first: Dict[str, int] = {}
+        for m in self._re.finditer(_norm(text)):
+            cat = self._cat.get(self._space.sub(" ", m.group(1)))
+            if cat is None:
+                continue
+            counts[cat] = counts.get(cat, 0) + 1
+            first.setdefault(cat, m.start())
+        # больше совпадений — выше; при равенстве — кто раньше упомянут
+        return sorted(counts.items(), key=lambda kv: (-kv[1], first[kv[0]]))
+
+
+_MATCHER: Optional[KeywordMatcher] = None
+
+
+def reload_matcher(keywords: Optional[Dict[str, str]] = None) -> KeywordMatcher:
+    """Пересобрать матчер (по умолчанию — из config.URGENT_KEYWORDS)."""
+    global _MATCHER
+    _MATCHER = KeywordMatcher(config.URGENT_KEYWORDS if keywords is None else keywords)
+    return _MATCHER
+
+
+def get_matcher() -> KeywordMatcher:
+    # пересобираем, если словарь в config заменили или в нём поменялось число ключей;
+    # правку значений на лету нужно сопроводить вызовом reload_matcher()
+    kw = config.URGENT_KEYWORDS
+    if _MATCHER is None or _MATCHER.source is not kw or _MATCHER.size != len(kw):
+        return reload_matcher()
+    return _MATCHER
+
+
+def match_urgent(text: str) -> List[Tuple[str, int]]:
+    return get_matcher().matches(text)
+
@@ -23,6 +23,117 @@ ADMIN_SECRET = os.getenv("ADMIN_SECRET", "secret123")
 DB_PATH = str(BASE_DIR / "bot.db")
 FILES_DIR = str(BASE_DIR / "files")
 
+# Номер процесса бота (0–99) — входит в номер заявки. Если запущено
+# несколько процессов на одной базе, у каждого должен быть свой WORKER_ID.
+WORKER_ID = int(os.getenv("WORKER_ID", "1"))
+
+# Адреса Bot API: для локального сервера Bot API или тестовой подмены.
+# К адресам дописывается токен (как в python-telegram-bot: base_url / base_file_url).
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "https://api.telegram.org/bot")
+TELEGRAM_BASE_FILE_URL = os.getenv("TELEGRAM_BASE_FILE_URL", "https://api.telegram.org/file/bot")
+
+# ==== Режим получения обновлений от Telegram ====
+# polling  — long polling (по умолчанию, как раньше)
+# webhook  — встроенный HTTP-сервер принимает обновления и сразу их обрабатывает
+# ingress  — HTTP-сервер только складывает обновления в очередь (таблица update_inbox)
+# worker   — процесс без сервера: забирает обновления из очереди и обрабатывает.
+#            Воркеров может быть несколько: WORKERS_TOTAL штук с WORKER_ID 0..N-1,
+#            каждый берёт свою долю чатов (chat_id % WORKERS_TOTAL), порядок внутри чата сохраняется.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")        # публичный https-адрес, напр. https://bot.example.ru/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # сверяется с X-Telegram-Bot-Api-Secret-Token
+WORKERS_TOTAL = int(os.getenv("WORKERS_TOTAL", "1"))
+UPDATE_POLL_INTERVAL = 0.2  # пауза воркера, когда очередь пуста (сек)
+CACHE_SYNC_EVERY = 1.0      # как часто воркер сверяет кэши (админы, отделы, диалоги) с БД (сек)
+# Фоновые задачи в единственном экземпляре (возобновление рассылок, закрытие
+# неактивных диалогов) запускает только «главный» процесс
+IS_PRIMARY = BOT_MODE != "worker" or WORKER_ID % max(1, WORKERS_TOTAL) == 0
+
+# Сколько соединений-читателей держать открытыми (писатель всегда один)
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+
+# ==== Лимиты исходящих сообщений Telegram ====
+# Глобально Telegram пускает ~30 сообщений/сек, берём с запасом.
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+# Интервал между сообщениями в один чат (сек): личка / группа
+TG_CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", "1.0"))
+TG_GROUP_INTERVAL = float(os.getenv("TG_GROUP_INTERVAL", "3.0"))
+
+# ==== Исходящие сообщения (таблица outbox, см. outbox.py) ====
+# Сколько сообщений отправляется одновременно (в один чат — всегда по одному)
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_POLL = 1.0            # как часто проверять таблицу без сигнала (сек): повторы, другие процессы
+OUTBOX_ATTEMPTS = 8          # попыток при сетевых сбоях, потом сообщение помечается неотправленным
+OUTBOX_BACKOFF = 2.0         # пауза перед повтором (сек), удваивается с каждой попыткой…
+OUTBOX_BACKOFF_MAX = 300.0   # …но не больше
+OUTBOX_KEEP = 2 * 24 * 3600  # сколько хранить отправленные (сек): ключи защищают от повторов
+
+# ==== Обработка входящих обновлений ====
+# Обновления разных чатов обрабатываются параллельно (не больше UPDATE_CONCURRENCY
+# одновременно), обновления одного чата — строго по очереди.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+UPDATE_BACKLOG = 1024        # сколько обновлений может ждать своей очереди, дальше приём тормозится
+UPDATE_METRICS_EVERY = 60    # как часто писать в лог метрики очереди (сек)
+ROUTE_SLOW_LOG = 1.0         # обработчик сообщения дольше этого (сек) попадает в лог
+
+# ==== Диалоги оператор <-> житель ====
+# Диалог закрывается сам, если в нём никто не писал дольше этого времени (сек)
+DIALOG_IDLE_TIMEOUT = int(os.getenv("DIALOG_IDLE_TIMEOUT", str(6 * 60 * 60)))
+DIALOG_SWEEP_EVERY = 60  # как часто проверять и сохранять активность (сек)
+
+# ==== Списки заявок ====
+MY_REQUESTS_PAGE = 5      # «Мои обращения»: заявок на странице
+ADMIN_QUEUE_PAGE = 10     # очередь админа: заявок на странице
+QUEUE_CACHE_TTL = 5.0     # сколько секунд страница очереди берётся из кэша (общего для всех админов)
+SEARCH_PAGE = 5           # поиск по тексту: заявок на странице
+SEARCH_CANDIDATES = 1000  # поиск ранжирует столько самых свежих совпадений (см. db.search_requests)
+NEARBY_RADII = (250, 500, 1000, 3000)  # «Рядом»: варианты радиуса (м)
+NEARBY_RADIUS_M = 500                  # радиус по умолчанию
+NEARBY_LIMIT = 10                      # сколько ближайших заявок показывать
+
+# ==== Похожие заявки (дубли) ====
+# Новая заявка, похожая на активную за последние DEDUP_WINDOW секунд, становится
+# её дублем: админам обновляется счётчик на исходной вместо новой рассылки.
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", str(3 * 60 * 60)))
+DEDUP_SIMILARITY = 0.5          # порог сходства текстов (0..1), если обе заявки с координатами
+DEDUP_SIMILARITY_NO_GEO = 0.7   # то же, когда координат нет хотя бы у одной
+DEDUP_RADIUS_M = 300            # заявки дальше друг от друга дублями не считаются
+DEDUP_EDIT_DELAY = 3.0          # счётчик на уведомлении обновляется не чаще, чем раз в столько секунд
+
+# ==== Локальные копии вложений (см. media.py) ====
+# Вложения заявок скачиваются в фоне в FILES_DIR/media и хранятся по sha256.
+# Когда оригиналы занимают больше MEDIA_CACHE_MAX_BYTES, давно не открытые
+# удаляются с диска (хэш и размер остаются в БД); миниатюры не удаляются.
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+MEDIA_MAX_BYTES = 20 * 1024 ** 2      # больше Bot API всё равно не отдаёт
+MEDIA_THUMB_MAX_BYTES = 512 * 1024    # миниатюра скачивается целиком в память
+MEDIA_CHUNK = 256 * 1024              # размер куска при потоковой загрузке
+MEDIA_ATTEMPTS = 5                    # попыток на вложение, потом заявка остаётся без копии
+
+# ==== Архив закрытых заявок (см. archive.py) ====
+# /archive YYYY-MM-DD переносит закрытые заявки старше даты из базы в сжатые
+# файлы по месяцам (FILES_DIR/archive); карточка и экспорт находят их там.
+ARCHIVE_BATCH = 500        # заявок за одну транзакцию
+ARCHIVE_GZIP_LEVEL = 6     # степень сжатия блоков (1–9)
+
+# ==== Массовые операции (чистка, закрытие активных — см. bulk.py) ====
+BULK_BATCH = 500      # заявок за одну транзакцию
+BULK_PAUSE = 0.02     # пауза между порциями, сек: писатель достаётся новым заявкам
+
+# ==== Журнал действий (audit_log, см. audit.py) ====
+AUDIT_BATCH = 200          # сбросить буфер в базу, когда набралось столько событий…
+AUDIT_FLUSH_EVERY = 2.0    # …или прошло столько секунд
+AUDIT_MAX_PENDING = 50000  # если база недоступна — хранить в памяти не больше
+
+# ==== Массовая рассылка ====
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_BATCH = 200          # сколько получателей берём из БД за раз
+BROADCAST_PROGRESS_EVERY = 3.0 # как часто обновлять сообщение с прогрессом (сек)
+
 
 # ==== Маршрутизация по отделам ====
 DEPARTMENTS = {
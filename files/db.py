@@ -1,8 +1,92 @@
 # db.py — async слой БД (SQLite, aiosqlite)
+import asyncio
 import aiosqlite
-from typing import List, Optional, Tuple
-from datetime import datetime
-from config import DB_PATH
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from datetime import datetime, timezone
+from time import monotonic
+from config import DB_PATH, DB_READERS, DEPARTMENTS, QUEUE_CACHE_TTL, SEARCH_CANDIDATES
+from search import index_text
+from geo import bbox_around, haversine_m
+
+# ---- ПУЛ СОЕДИНЕНИЙ ----
+# Раньше каждая функция открывала своё aiosqlite.connect() — это новый поток
+# и файловый дескриптор на каждый запрос. Теперь соединения живут всё время
+# работы бота: один писатель (SQLite всё равно пишет по одному) и несколько
+# читателей. WAL позволяет читателям не ждать писателя.
+# open_db() вызывается в on_startup, close_db() — в on_shutdown.
+WRITER_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+)
+COMMON_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+)
+
+_writer: Optional[aiosqlite.Connection] = None
+_write_lock = asyncio.Lock()
+_readers: Optional[asyncio.Queue] = None
+_open_lock = asyncio.Lock()
+
+async def _connect(pragmas) -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(DB_PATH)
+    for p in pragmas:
+        await conn.execute(p)
+    return conn
+
+async def open_db():
+    """Открыть писателя и пул читателей (повторный вызов ничего не делает)."""
+    global _writer, _readers
+    async with _open_lock:
+        if _writer is not None:
+            return
+        writer = await _connect(WRITER_PRAGMAS + COMMON_PRAGMAS)
+        readers = asyncio.Queue()
+        for _ in range(max(1, DB_READERS)):
+            readers.put_nowait(await _connect(COMMON_PRAGMAS + ("PRAGMA query_only=ON",)))
+        _writer, _readers = writer, readers
+
+async def close_db():
+    """Дождаться текущих запросов и закрыть все соединения."""
+    global _writer, _readers
+    async with _open_lock:
+        if _writer is None:
+            return
+        readers, _readers = _readers, None
+        for _ in range(max(1, DB_READERS)):
+            conn = await readers.get()
+            await conn.close()
+        async with _write_lock:
+            await _writer.close()
+            _writer = None
+
+@asynccontextmanager
+async def write_conn():
+    """Соединение-писатель под замком. Коммит при выходе, откат при ошибке."""
+    if _writer is None:
+        await open_db()
+    async with _write_lock:
+        try:
+            yield _writer
+            await _writer.commit()
+        except BaseException:
+            await _writer.rollback()
+            raise
+
+@asynccontextmanager
+async def read_conn():
+    """Свободное соединение-читатель из пула."""
+    if _readers is None:
+        await open_db()
+    readers = _readers
+    conn = await readers.get()
+    try:
+        yield conn
+    finally:
+        readers.put_nowait(conn)
 
 # ---- SCHEMA ----
 REQUESTS_BASE_COLUMNS = [
@@ -22,8 +106,490 @@ REQUESTS_BASE_COLUMNS = [
     "department TEXT"
 ]
 
+def _iso_to_ms(iso: str) -> int:
+    """ISO-время в UTC (как пишет datetime.utcnow().isoformat()) -> миллисекунды эпохи."""
+    return int(datetime.fromisoformat(iso).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+def _now() -> Tuple[str, int]:
+    """Текущее время: ISO-строка для created_at и миллисекунды для created_ts."""
+    now = datetime.utcnow()
+    return now.isoformat(), int(now.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+# ---- исходящие сообщения (см. outbox.py) ----
+# Сообщение в Telegram кладётся в таблицу outbox той же транзакцией, что и
+# изменение, о котором оно сообщает: функции ниже принимают параметр outbox.
+# (chat_id, метод Bot API, параметры JSON, ключ идемпотентности, приоритет, хук JSON)
+OutboxRow = Tuple[int, str, str, Optional[str], int, Optional[str]]
+
+_outbox_listener: Callable[[], None] = lambda: None
+
+def set_outbox_listener(fn: Callable[[], None]):
+    """fn вызывается после коммита, добавившего сообщения (будит отправителя)."""
+    global _outbox_listener
+    _outbox_listener = fn
+
+async def _outbox_add(db, rows) -> bool:
+    """Добавить сообщения в транзакции писателя; повтор ключа — пропуск."""
+    if not rows:
+        return False
+    now_ms = _now()[1]
+    await db.executemany(
+        "INSERT OR IGNORE INTO outbox(chat_id, method, params, key, priority, hook, next_ts, created_ts) "
+        "VALUES(?,?,?,?,?,?,?,?)",
+        [(*row, now_ms, now_ms) for row in rows]
+    )
+    return True
+
+# ---- МИГРАЦИИ ----
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция — функция,
+# получающая соединение-писатель; её номер = позиция в MIGRATIONS + 1.
+# Новые миграции только дописываются в конец списка, старые не меняются.
+async def _columns(db, table: str) -> set:
+    async with db.execute(f"PRAGMA table_info({table})") as cur:
+        return {r[1] for r in await cur.fetchall()}
+
+async def _m001_base_columns(db):
+    # старые базы создавались с другим набором колонок — доводим до REQUESTS_BASE_COLUMNS
+    have = await _columns(db, "requests")
+    for col in REQUESTS_BASE_COLUMNS:
+        name, decl = col.split(" ", 1)
+        if name not in have:
+            await db.execute(f"ALTER TABLE requests ADD COLUMN {name} {decl.replace(' UNIQUE', '')}")
+
+# миллисекунды эпохи из ISO-строки created_at (для заполнения старых строк)
+_SQL_ISO_TO_MS = "CAST((julianday(created_at) - 2440587.5) * 86400000 AS INTEGER)"
+
+async def _m002_created_ts(db):
+    # целочисленное время создания: сортировки и диапазоны без datetime() на каждую строку
+    for table in ("requests", "replies"):
+        if "created_ts" not in await _columns(db, table):
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN created_ts INTEGER")
+        await db.execute(f"UPDATE {table} SET created_ts={_SQL_ISO_TO_MS} WHERE created_ts IS NULL")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_requests_user_created ON requests(user_id, created_ts)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_requests_status_created ON requests(status, created_ts)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_requests_created ON requests(created_ts)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_replies_ticket_created ON replies(ticket, created_ts)")
+
+async def _m003_broadcasts(db):
+    # рассылки: задание + состояние по каждому получателю (для возобновления после рестарта)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            chat_id INTEGER,
+            message_id INTEGER,
+            text TEXT,
+            status TEXT,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            created_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER,
+            user_id INTEGER,
+            state TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+
+# Счётчики для отчётности: (измерение, значение) -> количество заявок.
+# Поддерживаются триггерами на requests, так что отчёт читает десятки строк
+# вместо COUNT(*) по всей таблице.
+STATS_DIMS = {
+    "total": "''",
+    "status": "COALESCE({r}.status, '')",
+    "category": "COALESCE({r}.category, '')",
+    "department": "COALESCE({r}.department, '')",
+    "urgency": "CAST(COALESCE({r}.urgency, 0) AS TEXT)",
+    "day": "substr({r}.created_at, 1, 10)",
+}
+# эти измерения могут меняться у существующей заявки
+STATS_MUTABLE = ("status", "category", "department", "urgency")
+
+def _stats_values(dims, ref: str, delta: int) -> str:
+    return ", ".join(f"('{d}', {STATS_DIMS[d].format(r=ref)}, {delta})" for d in dims)
+
+async def _m004_request_stats(db):
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS request_stats (
+            dim TEXT,
+            key TEXT,
+            n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dim, key)
+        ) WITHOUT ROWID
+    ''')
+    upsert = "ON CONFLICT(dim, key) DO UPDATE SET n = n + excluded.n"
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_insert AFTER INSERT ON requests BEGIN
+            INSERT INTO request_stats(dim, key, n) VALUES {_stats_values(STATS_DIMS, "NEW", 1)} {upsert};
+        END
+    ''')
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_delete AFTER DELETE ON requests BEGIN
+            INSERT INTO request_stats(dim, key, n) VALUES {_stats_values(STATS_DIMS, "OLD", -1)} {upsert};
+        END
+    ''')
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_stats_update AFTER UPDATE OF {", ".join(STATS_MUTABLE)} ON requests BEGIN
+            INSERT INTO request_stats(dim, key, n) VALUES {_stats_values(STATS_MUTABLE, "OLD", -1)} {upsert};
+            INSERT INTO request_stats(dim, key, n) VALUES {_stats_values(STATS_MUTABLE, "NEW", 1)} {upsert};
+        END
+    ''')
+    # первичное заполнение по уже существующим заявкам
+    await db.execute("DELETE FROM request_stats")
+    for dim, expr in STATS_DIMS.items():
+        await db.execute(
+            f"INSERT INTO request_stats(dim, key, n) "
+            f"SELECT '{dim}', {expr.format(r='requests')}, COUNT(*) FROM requests GROUP BY 2"
+        )
+
+async def _m005_dialogs(db):
+    # активные диалоги оператор <-> житель (переживают рестарт)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS dialogs (
+            ticket TEXT PRIMARY KEY,
+            admin_id INTEGER,
+            user_id INTEGER,
+            started_at TEXT,
+            last_activity_ts INTEGER
+        )
+    ''')
+
+async def _m006_update_inbox(db):
+    # очередь входящих обновлений для режимов ingress/worker
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS update_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            shard INTEGER,
+            payload TEXT,
+            created_ts INTEGER
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_update_inbox_shard ON update_inbox(shard, id)")
+    # версии кэшируемых таблиц: по ним другие процессы понимают, что кэш устарел
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            name TEXT PRIMARY KEY,
+            v INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for table, events in (("admins", ("INSERT", "DELETE")),
+                          ("dialogs", ("INSERT", "DELETE", "UPDATE OF admin_id, user_id"))):
+        await db.execute("INSERT OR IGNORE INTO cache_versions(name, v) VALUES(?, 0)", (table,))
+        for event in events:
+            name = f"trg_cache_{table}_{event.split()[0].lower()}"
+            await db.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table} BEGIN "
+                f"UPDATE cache_versions SET v=v+1 WHERE name='{table}'; END"
+            )
+
+# Полнотекстовый индекс для поиска операторов: строка на заявку (rowid = id),
+# в полях — основы слов из текста, комментария и всех ответов (search.index_text).
+# Основы считает Python, поэтому индекс обновляют сами функции записи —
+# save_request, update_status, save_reply — той же транзакцией (_fts_*).
+# Триггер только удаляет строку вместе с заявкой: в схеме нет функций,
+# которых нет в обычном sqlite3, и база пишется любым инструментом. Правки
+# текста мимо бота индекс не видит — после них rebuild_search_index().
+FTS_REBUILD_BATCH = 5000
+
+async def _fts_add(db, request_id: int, text: Optional[str]):
+    await db.execute(
+        "INSERT INTO requests_fts(rowid, text, admin_comment, replies) VALUES(?, ?, '', '')",
+        (request_id, index_text(text))
+    )
+
+async def _fts_set_comment(db, ticket: str, comment: str):
+    await db.execute(
+        "UPDATE requests_fts SET admin_comment = ? WHERE rowid = (SELECT id FROM requests WHERE ticket = ?)",
+        (index_text(comment), ticket)
+    )
+
+async def _fts_add_reply(db, ticket: str, text: str):
+    await db.execute(
+        "UPDATE requests_fts SET replies = trim(replies || ' ' || ?) WHERE rowid = (SELECT id FROM requests WHERE ticket = ?)",
+        (index_text(text), ticket)
+    )
+
+async def _fts_rebuild(db):
+    await db.execute("DELETE FROM requests_fts")
+    last = 0
+    while True:
+        async with db.execute(
+            """
+            SELECT id, text, admin_comment, (SELECT group_concat(text, ' ') FROM replies WHERE ticket = requests.ticket)
+            FROM requests WHERE id > ? ORDER BY id LIMIT ?
+            """,
+            (last, FTS_REBUILD_BATCH)
+        ) as cur:
+            rows = await cur.fetchall()
+        if not rows:
+            break
+        await db.executemany(
+            "INSERT INTO requests_fts(rowid, text, admin_comment, replies) VALUES(?,?,?,?)",
+            [(i, index_text(t), index_text(c), index_text(r)) for i, t, c, r in rows]
+        )
+        last = rows[-1][0]
+    await db.execute("INSERT INTO requests_fts(requests_fts) VALUES('optimize')")
+
+async def _m007_search(db):
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS requests_fts USING fts5(
+            text, admin_comment, replies,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_fts_requests_delete AFTER DELETE ON requests BEGIN
+            DELETE FROM requests_fts WHERE rowid = OLD.id;
+        END
+    ''')
+    # первичное заполнение по уже существующим заявкам
+    await _fts_rebuild(db)
+
+# Пространственный индекс: R*Tree по (широта, долгота) для заявок с
+# координатами. Границы в R*Tree хранятся как float32 и округляются наружу,
+# поэтому индекс — только предварительный отбор, точные условия проверяются
+# по самой requests. Время в дерево не входит: заявки приходят по порядку
+# времени, и с третьим измерением узлы делились бы по времени, накрывая весь
+# город, — запрос по месту без окна времени обходил бы всё дерево.
+GEO_POINT = "NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude"
+GEO_HAS_POINT = "NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL"
+
+async def _m008_geo(db):
+    await db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS requests_geo USING rtree(
+            id, min_lat, max_lat, min_lon, max_lon
+        )
+    ''')
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_geo_requests_insert AFTER INSERT ON requests
+        WHEN {GEO_HAS_POINT} BEGIN
+            INSERT INTO requests_geo VALUES ({GEO_POINT});
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_geo_requests_delete AFTER DELETE ON requests
+        WHEN OLD.latitude IS NOT NULL AND OLD.longitude IS NOT NULL BEGIN
+            DELETE FROM requests_geo WHERE id = OLD.id;
+        END
+    ''')
+    await db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_geo_requests_update AFTER UPDATE OF latitude, longitude ON requests BEGIN
+            DELETE FROM requests_geo WHERE id = OLD.id;
+            INSERT INTO requests_geo SELECT {GEO_POINT} WHERE {GEO_HAS_POINT};
+        END
+    ''')
+    # первичное заполнение по уже существующим заявкам
+    await db.execute("DELETE FROM requests_geo")
+    await db.execute('''
+        INSERT INTO requests_geo
+        SELECT id, latitude, latitude, longitude, longitude
+        FROM requests WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+    ''')
+
+async def _m009_duplicates(db):
+    # дубли: ссылка на исходную заявку (см. dedup.py)
+    if "duplicate_of" not in await _columns(db, "requests"):
+        await db.execute("ALTER TABLE requests ADD COLUMN duplicate_of INTEGER")
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_requests_duplicate_of ON requests(duplicate_of) WHERE duplicate_of IS NOT NULL"
+    )
+    # какие сообщения о заявке получили админы — чтобы потом их обновить
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS request_notices (
+            request_id INTEGER,
+            chat_id INTEGER,
+            message_id INTEGER,
+            kind TEXT,
+            caption TEXT,
+            PRIMARY KEY (request_id, chat_id)
+        ) WITHOUT ROWID
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_notices_requests_delete AFTER DELETE ON requests BEGIN
+            DELETE FROM request_notices WHERE request_id = OLD.id;
+        END
+    ''')
+
+async def _m010_media(db):
+    # локальные копии вложений (см. media.py): заявка ссылается на файл по sha256
+    have = await _columns(db, "requests")
+    for col, decl in (("thumb_id", "TEXT"), ("media_sha256", "TEXT"), ("thumb_sha256", "TEXT"),
+                      ("media_attempts", "INTEGER NOT NULL DEFAULT 0")):
+        if col not in have:
+            await db.execute(f"ALTER TABLE requests ADD COLUMN {col} {decl}")
+    # заявки, чьё вложение ещё не скачано — очередь загрузки переживает перезапуск
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_requests_media_pending ON requests(id) "
+        "WHERE media_id IS NOT NULL AND media_sha256 IS NULL"
+    )
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            path TEXT NOT NULL,          -- относительно FILES_DIR/media
+            is_thumb INTEGER NOT NULL DEFAULT 0,
+            stored INTEGER NOT NULL DEFAULT 1,   -- 0 — оригинал вытеснен, остались хэш и размер
+            created_ts INTEGER,
+            last_used_ts INTEGER
+        ) WITHOUT ROWID
+    ''')
+    # кандидаты на вытеснение: лежащие на диске оригиналы, давно не нужные — первыми
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_media_lru ON media_files(last_used_ts, size) "
+        "WHERE stored=1 AND is_thumb=0"
+    )
+
+async def _m011_archive(db):
+    # архив закрытых заявок (см. archive.py): сами записи — в сжатых файлах по месяцам,
+    # здесь только оглавление: где лежит блок и какие тикеты в нём
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS archive_blocks (
+            id INTEGER PRIMARY KEY,
+            month TEXT NOT NULL,       -- YYYY-MM по created_at заявок
+            path TEXT NOT NULL,        -- файл месяца относительно папки архива
+            offset INTEGER NOT NULL,   -- блок — отдельный gzip-член файла: смещение и длина
+            length INTEGER NOT NULL,
+            sha256 TEXT NOT NULL,      -- хэш сжатого блока, проверяется при чтении
+            count INTEGER NOT NULL,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            created_at TEXT
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_archive_blocks_ts ON archive_blocks(first_ts, last_ts)")
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS archive_index (
+            ticket TEXT PRIMARY KEY,
+            request_id INTEGER,
+            block_id INTEGER,
+            created_ts INTEGER,
+            status TEXT
+        ) WITHOUT ROWID
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_archive_index_request ON archive_index(request_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_archive_index_created ON archive_index(created_ts, status)")
+
+async def _m012_audit(db):
+    # журнал действий (см. audit.py): время в мс — для сортировки, индекс — для истории заявки
+    if "created_ts" not in await _columns(db, "audit_log"):
+        await db.execute("ALTER TABLE audit_log ADD COLUMN created_ts INTEGER")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_audit_ticket ON audit_log(ticket, created_ts)")
+
+async def _m013_outbox(db):
+    # исходящие сообщения (см. outbox.py); state: 0 ждёт отправки, 1 отправлено, 2 не удалось
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY,
+            key TEXT UNIQUE,               -- ключ идемпотентности: то же событие второй раз не ставится
+            chat_id INTEGER NOT NULL,
+            method TEXT NOT NULL,          -- send_message, send_photo, edit_message_text, …
+            params TEXT NOT NULL,          -- аргументы вызова, JSON
+            priority INTEGER NOT NULL DEFAULT 1,
+            hook TEXT,                     -- что сделать после отправки: JSON [имя, аргументы…]
+            state INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_ts INTEGER NOT NULL,      -- не раньше (мс): повтор с паузой, RetryAfter
+            created_ts INTEGER NOT NULL,
+            sent_ts INTEGER,
+            message_id INTEGER,
+            error TEXT
+        )
+    ''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_chat ON outbox(chat_id, id) WHERE state=0")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(priority, id) WHERE state=0")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_done ON outbox(created_ts) WHERE state<>0")
+
+async def _m014_departments(db):
+    # отделы теперь в БД (см. «Отделы» ниже): config.DEPARTMENTS — только начальный
+    # список. Отдел не удаляется (на него ссылаются заявки), а скрывается из меню
+    if "active" not in await _columns(db, "departments"):
+        await db.execute("ALTER TABLE departments ADD COLUMN active INTEGER NOT NULL DEFAULT 1")
+    await db.executemany(
+        "INSERT OR IGNORE INTO departments(key, name, tg_chat_id) VALUES(?,?,?)",
+        [(key, d.get("name", key), d.get("tg_chat_id")) for key, d in DEPARTMENTS.items()]
+    )
+    await db.execute("INSERT OR IGNORE INTO cache_versions(name, v) VALUES('departments', 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        await db.execute(
+            f"CREATE TRIGGER IF NOT EXISTS trg_cache_departments_{event.lower()} AFTER {event} ON departments BEGIN "
+            f"UPDATE cache_versions SET v=v+1 WHERE name='departments'; END"
+        )
+
+async def _m015_inbox_lease(db):
+    # обновление из update_inbox удаляется только после обработки: при заборе
+    # воркер лишь помечает строку своей (claimed_ts, worker), см. claim_updates
+    have = await _columns(db, "update_inbox")
+    if "claimed_ts" not in have:
+        await db.execute("ALTER TABLE update_inbox ADD COLUMN claimed_ts INTEGER")
+    if "worker" not in have:
+        await db.execute("ALTER TABLE update_inbox ADD COLUMN worker INTEGER")
+    await db.execute("DROP INDEX IF EXISTS idx_update_inbox_shard")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_update_inbox_free ON update_inbox(shard, id) WHERE claimed_ts IS NULL")
+
+async def _m016_search_without_udf(db):
+    # раньше индекс вели триггеры с Python-функцией fts_stems: вне бота (sqlite3,
+    # скрипты) вставка заявки или ответа и правка комментария падали с
+    # «no such function». Теперь индекс ведёт Python (см. _fts_*)
+    for name in ("trg_fts_requests_insert", "trg_fts_requests_update",
+                 "trg_fts_replies_insert", "trg_fts_replies_delete"):
+        await db.execute(f"DROP TRIGGER IF EXISTS {name}")
+    await _fts_rebuild(db)
+
+async def _m017_archive_owner(db):
+    # «Мои обращения» показывают и архивные заявки: автор, дата и начало текста
+    # лежат в оглавлении, чтобы список не распаковывал блоки. Для перенесённых
+    # раньше заявок поля заполняет archive.fill_index при запуске
+    have = await _columns(db, "archive_index")
+    for col, kind in (("user_id", "INTEGER"), ("created_at", "TEXT"), ("summary", "TEXT")):
+        if col not in have:
+            await db.execute(f"ALTER TABLE archive_index ADD COLUMN {col} {kind}")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_archive_index_user ON archive_index(user_id, created_ts)")
+
+async def _m018_media_kind(db):
+    # вид вложения (photo / video / document, см. outbox.MEDIA_METHODS): file_id
+    # отправляется только методом своего вида. У старых заявок вид неизвестен —
+    # NULL, такие вложения отправляются как фото, как раньше
+    if "media_kind" not in await _columns(db, "requests"):
+        await db.execute("ALTER TABLE requests ADD COLUMN media_kind TEXT")
+
+MIGRATIONS = [
+    _m001_base_columns,
+    _m002_created_ts,
+    _m003_broadcasts,
+    _m004_request_stats,
+    _m005_dialogs,
+    _m006_update_inbox,
+    _m007_search,
+    _m008_geo,
+    _m009_duplicates,
+    _m010_media,
+    _m011_archive,
+    _m012_audit,
+    _m013_outbox,
+    _m014_departments,
+    _m015_inbox_lease,
+    _m016_search_without_udf,
+    _m017_archive_owner,
+    _m018_media_kind,
+]
+
+async def migrate(db):
+    async with db.execute("PRAGMA user_version") as cur:
+        version = (await cur.fetchone())[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        await migration(db)
+        await db.execute(f"PRAGMA user_version={number}")
+        await db.commit()
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with write_conn() as db:
         # requests
         await db.execute(f'''
             CREATE TABLE IF NOT EXISTS requests (
@@ -59,40 +625,47 @@ async def init_db():
                 tg_chat_id INTEGER
             )
         ''')
-        await db.commit()
+        # admins
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS admins (
+                user_id INTEGER PRIMARY KEY
+            )
+        ''')
+        await migrate(db)
 
 # ---- USERS/ADMINS ----
 async def create_user(user_id: int, username: Optional[str], first_name: Optional[str]):
     # на будущее можно сделать таблицу users, пока просто создаём записи через requests
     return True
 
-async def list_admins() -> List[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY
-            )
-        ''')
-        await db.commit()
-        cur = await db.execute("SELECT user_id FROM admins")
-        rows = await cur.fetchall()
-        return [r[0] for r in rows]
+# Админы хранятся в памяти: множество загружается один раз при старте
+# (load_admins), set_admin пишет в БД и сразу обновляет множество.
+# Проверка прав — просто `in`, без обращения к БД.
+_ADMINS: set = set()
+
+async def load_admins():
+    async with read_conn() as db:
+        async with db.execute("SELECT user_id FROM admins") as cur:
+            rows = await cur.fetchall()
+    _ADMINS.clear()
+    _ADMINS.update(r[0] for r in rows)
+
+def is_admin_user(user_id: int) -> bool:
+    return user_id in _ADMINS
+
+def list_admins() -> List[int]:
+    return list(_ADMINS)
 
 async def set_admin(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY
-            )
-        ''')
+    async with write_conn() as db:
         await db.execute("INSERT OR IGNORE INTO admins(user_id) VALUES(?)", (user_id,))
-        await db.commit()
+    _ADMINS.add(user_id)
 
 async def list_all_user_ids() -> List[int]:
     # простая выборка авторов из заявок
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT DISTINCT user_id FROM requests ORDER BY user_id")
-        return [r[0] for r in await cur.fetchall()]
+    async with read_conn() as db:
+        async with db.execute("SELECT DISTINCT user_id FROM requests ORDER BY user_id") as cur:
+            return [r[0] for r in await cur.fetchall()]
 
 # ---- REQUESTS ----
 async def save_request(
@@ -104,48 +677,483 @@ async def save_request(
     lon: Optional[float] = None,
     category: Optional[str] = None,
     urgency: int = 0,
-    department: Optional[str] = None
+    department: Optional[str] = None,
+    duplicate_of: Optional[int] = None,
+    thumb_id: Optional[str] = None,
+    outbox: Optional[Callable[[int], List[OutboxRow]]] = None,
+    media_kind: Optional[str] = None
 ):
+    """outbox(id новой заявки) -> сообщения о ней, в той же транзакции. media_kind — вид вложения media_path."""
+    now, now_ms = _now()
+    queued = False
+    async with write_conn() as db:
+        async with db.execute(
+            '''
+            INSERT INTO requests (ticket, user_id, text, media_id, latitude, 
+            longitude, status, admin_comment, created_at, updated_at, category, urgency, department, created_ts,
+            duplicate_of, thumb_id, media_kind)
+            VALUES (?, ?, ?, ?, ?, ?, 'Новый', NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''',
+            (ticket, user_id, text, media_path, lat, lon, now, now, category, urgency, department, now_ms,
+             duplicate_of, thumb_id, media_kind if media_path else None)
+        ) as cur:
+            request_id = cur.lastrowid
+        await _fts_add(db, request_id, text)
+        if outbox is not None:
+            queued = await _outbox_add(db, outbox(request_id))
+    _queue_cache_clear()
+    if queued:
+        _outbox_listener()
+    return request_id
+
+async def _requests_page(
+    columns: str, where: str, args: tuple, limit: int,
+    older_than: Optional[Tuple[int, int]] = None,
+    newer_than: Optional[Tuple[int, int]] = None,
+    source: str = "requests"
+) -> Tuple[List[Tuple], bool, bool]:
+    """
+    Страница заявок, новые сверху. Листание по ключу (created_ts, id) — без OFFSET
+    и без чтения всей выборки; older_than / newer_than — курсор (created_ts, id)
+    соседней страницы. В columns первым идёт id, последним — created_ts;
+    source — таблица или подзапрос с колонками requests.
+    Возвращает (rows, есть_старее, есть_новее).
+    """
+    if newer_than is not None:
+        cursor, cmp, order = newer_than, ">", "ASC"
+    elif older_than is not None:
+        cursor, cmp, order = older_than, "<", "DESC"
+    else:
+        cursor, cmp, order = None, None, "DESC"
+    sql = f"SELECT {columns} FROM {source} WHERE {where}"
+    params = args
+    if cursor is not None:
+        sql += f" AND (created_ts, id) {cmp} (?, ?)"
+        params = args + tuple(cursor)
+    sql += f" ORDER BY created_ts {order}, id {order} LIMIT ?"
+    async with read_conn() as db:
+        async with db.execute(sql, params + (limit + 1,)) as cur:
+            rows = await cur.fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if order == "ASC":
+            rows.reverse()
+        if not rows or cursor is None:
+            return rows, more, False
+        # в обратную сторону достаточно узнать, есть ли хоть одна запись
+        edge, back = (rows[-1], "<") if order == "ASC" else (rows[0], ">")
+        async with db.execute(
+            f"SELECT 1 FROM {source} WHERE {where} AND (created_ts, id) {back} (?, ?) LIMIT 1",
+            args + (edge[-1], edge[0])
+        ) as cur:
+            other = await cur.fetchone() is not None
+    return (rows, other, more) if order == "ASC" else (rows, more, other)
+
+ARCHIVE_SUMMARY = 200  # начало текста в оглавлении архива — столько же показывает список
+# условие user_id=? SQLite переносит внутрь обеих частей UNION ALL — работают индексы по автору
+USER_REQUESTS = f'''(
+    SELECT id, ticket, user_id, status, created_at, substr(text, 1, {ARCHIVE_SUMMARY}) AS text, created_ts FROM requests
+    UNION ALL
+    SELECT request_id, ticket, user_id, status, created_at, summary, created_ts FROM archive_index
+)'''
+
+async def list_user_requests_page(
+    user_id: int,
+    limit: int = 5,
+    older_than: Optional[Tuple[int, int]] = None,
+    newer_than: Optional[Tuple[int, int]] = None
+) -> Tuple[List[Tuple], bool, bool]:
+    """
+    Заявки пользователя вместе с перенесёнными в архив (начало текста — из
+    оглавления архива): (id, ticket, status, created_at, начало текста, created_ts).
+    """
+    return await _requests_page(
+        "id, ticket, status, created_at, text, created_ts",
+        "user_id=?", (user_id,), limit, older_than, newer_than, source=USER_REQUESTS
+    )
+
+# ---- очередь заявок для админов ----
+# Одну и ту же страницу часто смотрят несколько админов подряд — результат
+# держим в памяти QUEUE_CACHE_TTL секунд. Любое изменение заявок через
+# функции этого модуля сбрасывает кэш; правки из других процессов видны
+# не позже, чем через TTL.
+# дубли в очередь не попадают — у исходной заявки показывается их число
+QUEUE_COLUMNS = (
+    "id, ticket, user_id, substr(text, 1, 200), status, created_at, category, urgency, department, "
+    "(SELECT count(*) FROM requests d WHERE d.duplicate_of = requests.id), created_ts"
+)
+_QUEUE_CACHE: dict = {}
+_QUEUE_CACHE_MAX = 256
+
+def _queue_cache_clear():
+    _QUEUE_CACHE.clear()
+
+async def list_queue_page(
+    statuses: Optional[Tuple[str, ...]] = None,
+    category: Optional[str] = None,
+    department: Optional[str] = None,
+    urgency: Optional[int] = None,
+    limit: int = 10,
+    older_than: Optional[Tuple[int, int]] = None,
+    newer_than: Optional[Tuple[int, int]] = None
+) -> Tuple[List[Tuple], bool, bool]:
+    """
+    Страница очереди заявок с фильтрами (None — без фильтра). Строки:
+    (id, ticket, user_id, начало текста, status, created_at, category, urgency,
+    department, число дублей, created_ts).
+    """
+    key = (statuses, category, department, urgency, limit, older_than, newer_than)
+    hit = _QUEUE_CACHE.get(key)
+    now = monotonic()
+    if hit and hit[0] > now:
+        return hit[1]
+
+    where, args = ["duplicate_of IS NULL"], []
+    if statuses:
+        where.append(f"status IN ({','.join('?' * len(statuses))})")
+        args.extend(statuses)
+    for col, value in (("category", category), ("department", department), ("urgency", urgency)):
+        if value is not None:
+            where.append(f"{col}=?")
+            args.append(value)
+    page = await _requests_page(
+        QUEUE_COLUMNS, " AND ".join(where), tuple(args), limit, older_than, newer_than
+    )
+    if len(_QUEUE_CACHE) >= _QUEUE_CACHE_MAX:
+        _QUEUE_CACHE.clear()
+    _QUEUE_CACHE[key] = (now + QUEUE_CACHE_TTL, page)
+    return page
+
+# ---- полнотекстовый поиск (см. search.py) ----
+async def rebuild_search_index():
+    """Пересобрать индекс поиска целиком — после правок базы мимо бота."""
+    async with write_conn() as db:
+        await _fts_rebuild(db)
+
+async def search_requests(
+    match: str, limit: int = 5, offset: int = 0, candidates: int = SEARCH_CANDIDATES
+) -> Tuple[List[Tuple], int, bool]:
+    """
+    Заявки по выражению FTS5 match (search.fts_query), самые подходящие (BM25)
+    первыми. Ранжируются не больше candidates самых свежих совпадений: BM25 по
+    всем совпадениям частого слова на миллионе заявок — это секунды, а старые
+    заявки операторам нужны редко. Возвращает (строки, всего, есть_ещё_старее);
+    строки — (id, ticket, user_id, status, created_at, urgency, text,
+    admin_comment, ответы через перевод строки).
+    """
+    async with read_conn() as db:
+        # граница по rowid: FTS5 идёт по совпадениям от новых к старым без сортировки
+        async with db.execute(
+            "SELECT rowid FROM requests_fts WHERE requests_fts MATCH ? ORDER BY rowid DESC LIMIT 2 OFFSET ?",
+            (match, candidates - 1)
+        ) as cur:
+            edge = await cur.fetchall()
+        floor = edge[0][0] if edge else 0
+        async with db.execute(
+            "SELECT count(*) FROM requests_fts WHERE requests_fts MATCH ? AND rowid >= ?", (match, floor)
+        ) as cur:
+            total = (await cur.fetchone())[0]
+        async with db.execute(
+            '''
+            SELECT rowid FROM requests_fts WHERE requests_fts MATCH ? AND rowid >= ?
+            ORDER BY bm25(requests_fts, 1.0, 0.5, 0.7) LIMIT ? OFFSET ?
+            ''',
+            (match, floor, limit, offset)
+        ) as cur:
+            ids = [r[0] for r in await cur.fetchall()]
+        if not ids:
+            return [], total, len(edge) > 1
+        async with db.execute(
+            f'''
+            SELECT id, ticket, user_id, status, created_at, urgency, text, admin_comment,
+                   (SELECT group_concat(p.text, char(10)) FROM replies p WHERE p.ticket = requests.ticket)
+            FROM requests WHERE id IN ({",".join("?" * len(ids))})
+            ''',
+            ids
+        ) as cur:
+            by_id = {r[0]: r for r in await cur.fetchall()}
+    return [by_id[i] for i in ids if i in by_id], total, len(edge) > 1
+
+# ---- поиск по месту (см. geo.py) ----
+GEO_COLUMNS = "r.id, r.ticket, r.user_id, r.status, r.created_at, substr(r.text, 1, 200), r.urgency, r.latitude, r.longitude, r.created_ts"
+
+async def _geo_candidates(
+    min_lat: float, max_lat: float, min_lon: float, max_lon: float,
+    start_ms: Optional[int] = None, end_ms: Optional[int] = None,
+    statuses: Optional[Tuple[str, ...]] = None, limit: Optional[int] = None
+) -> List[Tuple]:
+    """
+    Заявки в прямоугольнике (и окне времени): отбор по R*Tree + точная проверка
+    по requests. С limit — только limit самых новых.
+    """
+    where = [
+        "g.max_lat >= ? AND g.min_lat <= ? AND g.max_lon >= ? AND g.min_lon <= ?",
+        "r.latitude BETWEEN ? AND ? AND r.longitude BETWEEN ? AND ?",
+    ]
+    args = [min_lat, max_lat, min_lon, max_lon, min_lat, max_lat, min_lon, max_lon]
+    if start_ms is not None:
+        where.append("r.created_ts >= ?")
+        args.append(start_ms)
+    if end_ms is not None:
+        where.append("r.created_ts <= ?")
+        args.append(end_ms)
+    if statuses:
+        where.append(f"r.status IN ({','.join('?' * len(statuses))})")
+        args.extend(statuses)
+    # CROSS JOIN фиксирует порядок: сначала R*Tree, потом requests по id. Иначе
+    # планировщик может пойти по индексу статуса и проверять каждую заявку в R*Tree.
+    sql = f"SELECT {GEO_COLUMNS} FROM requests_geo g CROSS JOIN requests r ON r.id = g.id WHERE {' AND '.join(where)}"
+    if limit is not None:
+        sql += " ORDER BY r.created_ts DESC, r.id DESC LIMIT ?"
+        args.append(limit)
+    async with read_conn() as db:
+        async with db.execute(sql, args) as cur:
+            return await cur.fetchall()
+
+async def list_requests_near(
+    lat: float, lon: float, radius_m: float,
+    statuses: Optional[Tuple[str, ...]] = None,
+    exclude_id: Optional[int] = None,
+    limit: int = 10
+) -> List[Tuple[float, Tuple]]:
+    """
+    Заявки не дальше radius_m метров от точки, ближние первыми: [(метры, строка)].
+    Строка — (id, ticket, user_id, status, created_at, начало текста, urgency,
+    latitude, longitude, created_ts).
+    """
+    rows = await _geo_candidates(*bbox_around(lat, lon, radius_m), statuses=statuses)
+    found = []
+    for row in rows:
+        if row[0] == exclude_id:
+            continue
+        dist = haversine_m(lat, lon, row[7], row[8])
+        if dist <= radius_m:
+            found.append((dist, row))
+    found.sort(key=lambda f: (f[0], -f[1][-1]))
+    return found[:limit]
+
+async def list_requests_in_bbox(
+    min_lat: float, min_lon: float, max_lat: float, max_lon: float,
+    start_ms: Optional[int] = None, end_ms: Optional[int] = None,
+    statuses: Optional[Tuple[str, ...]] = None,
+    limit: int = 500
+) -> List[Tuple]:
+    """Заявки в прямоугольнике и окне времени (мс эпохи, None — без границы), новые первыми."""
+    return await _geo_candidates(min_lat, max_lat, min_lon, max_lon, start_ms, end_ms, statuses, limit)
+
+# ---- дубли (см. dedup.py) ----
+async def list_dedup_heads(after_id: int, since_ms: int) -> List[Tuple]:
+    """Активные не-дубли новее since_ms с id > after_id: (id, ticket, text, created_ts, latitude, longitude)."""
+    # первая загрузка идёт по индексу времени, дальше — по id (только новые строки)
+    key = "id > ? AND created_ts >= ?" if after_id else "created_ts >= ? AND id > ?"
+    args = (after_id, since_ms) if after_id else (since_ms, after_id)
+    async with read_conn() as db:
+        async with db.execute(
+            f'''
+            SELECT id, ticket, text, created_ts, latitude, longitude FROM requests
+            WHERE {key} AND duplicate_of IS NULL AND status IN ('Новый','В обработке')
+            ORDER BY id
+            ''',
+            args
+        ) as cur:
+            return await cur.fetchall()
+
+async def list_dedup_head_ids(since_ms: int) -> Tuple[Set[int], int]:
+    """
+    id активных не-дублей новее since_ms и граница: наибольший id в requests
+    до запроса. Заявок с id выше границы в ответе может не быть — их статус неизвестен.
+    """
+    async with read_conn() as db:
+        async with db.execute("SELECT COALESCE(MAX(id), 0) FROM requests") as cur:
+            top = (await cur.fetchone())[0]
+        async with db.execute(
+            "SELECT id FROM requests WHERE created_ts >= ? AND duplicate_of IS NULL AND status IN ('Новый','В обработке')",
+            (since_ms,)
+        ) as cur:
+            ids = {r[0] for r in await cur.fetchall()}
+    return ids, top
+
+async def duplicate_info(request_id: int) -> Tuple[Optional[Tuple[int, str]], int, Optional[str]]:
+    """(исходная заявка (id, ticket) или None, число дублей этой заявки, тикет последнего дубля)."""
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT o.id, o.ticket FROM requests r JOIN requests o ON o.id = r.duplicate_of WHERE r.id=?",
+            (request_id,)
+        ) as cur:
+            original = await cur.fetchone()
+        async with db.execute(
+            "SELECT count(*), (SELECT ticket FROM requests WHERE duplicate_of=?1 ORDER BY id DESC LIMIT 1) "
+            "FROM requests WHERE duplicate_of=?1",
+            (request_id,)
+        ) as cur:
+            count, last = await cur.fetchone()
+    return (tuple(original) if original else None), count, last
+
+async def close_duplicates(
+    request_id: int, status: str, outbox: Optional[Callable[[List[Tuple[str, int]]], List[OutboxRow]]] = None
+) -> List[Tuple[str, int]]:
+    """
+    Перевести активные дубли заявки в status. Возвращает их (ticket, user_id);
+    outbox(дубли) -> сообщения их авторам, в той же транзакции.
+    """
     now = datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+    queued = False
+    async with write_conn() as db:
+        async with db.execute(
+            "SELECT ticket, user_id FROM requests WHERE duplicate_of=? AND status IN ('Новый','В обработке')",
+            (request_id,)
+        ) as cur:
+            rows = await cur.fetchall()
+        await db.execute(
+            "UPDATE requests SET status=?, updated_at=? WHERE duplicate_of=? AND status IN ('Новый','В обработке')",
+            (status, now, request_id)
+        )
+        if rows and outbox is not None:
+            queued = await _outbox_add(db, outbox(rows))
+    if rows:
+        _queue_cache_clear()
+    if queued:
+        _outbox_listener()
+    return rows
+
+async def save_notice(request_id: int, chat_id: int, message_id: int, kind: str, caption: str):
+    """Запомнить уведомление админу о заявке: kind — text (текст) или caption (подпись к медиа)."""
+    async with write_conn() as db:
         await db.execute(
+            "INSERT OR REPLACE INTO request_notices(request_id, chat_id, message_id, kind, caption) VALUES(?,?,?,?,?)",
+            (request_id, chat_id, message_id, kind, caption)
+        )
+
+async def list_notices(request_id: int) -> List[Tuple[int, int, str, str]]:
+    """Уведомления о заявке: (chat_id, message_id, kind, caption)."""
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT chat_id, message_id, kind, caption FROM request_notices WHERE request_id=?", (request_id,)
+        ) as cur:
+            return await cur.fetchall()
+
+# ---- локальные копии вложений (см. media.py) ----
+MediaFile = Tuple[str, int, str]  # (sha256, размер, путь относительно FILES_DIR/media)
+
+async def list_pending_media(after_id: int, max_attempts: int, limit: int = 100) -> List[Tuple[int, str, Optional[str]]]:
+    """Заявки с нескачанным вложением: (id, media_id, thumb_id), по возрастанию id."""
+    async with read_conn() as db:
+        async with db.execute(
             '''
-            INSERT INTO requests (ticket, user_id, text, media_id, latitude, 
-            longitude, status, admin_comment, created_at, updated_at, category, urgency, department)
-            VALUES (?, ?, ?, ?, ?, ?, 'Новый', NULL, ?, ?, ?, ?, ?)
+            SELECT id, media_id, thumb_id FROM requests
+            WHERE media_id IS NOT NULL AND media_sha256 IS NULL AND id > ? AND media_attempts < ?
+            ORDER BY id LIMIT ?
             ''',
-            (ticket, user_id, text, media_path, lat, lon, now, now, category, urgency, department)
+            (after_id, max_attempts, limit)
+        ) as cur:
+            return await cur.fetchall()
+
+async def record_media(request_id: int, original: MediaFile, thumb: Optional[MediaFile] = None):
+    """Файлы вложения сохранены: учесть их и привязать к заявке."""
+    _, now_ms = _now()
+    files = [original + (0,)] + ([thumb + (1,)] if thumb else [])
+    async with write_conn() as db:
+        # тот же файл уже мог быть (или быть вытеснен) — он снова на диске и только что нужен;
+        # миниатюрой однажды — миниатюрой навсегда (их не вытесняем)
+        await db.executemany(
+            '''
+            INSERT INTO media_files(sha256, size, path, is_thumb, stored, created_ts, last_used_ts)
+            VALUES(?,?,?,?,1,?,?)
+            ON CONFLICT(sha256) DO UPDATE SET
+                stored=1, path=excluded.path, last_used_ts=excluded.last_used_ts,
+                is_thumb=max(is_thumb, excluded.is_thumb)
+            ''',
+            [(sha, size, path, is_thumb, now_ms, now_ms) for sha, size, path, is_thumb in files]
+        )
+        await db.execute(
+            "UPDATE requests SET media_sha256=?, thumb_sha256=? WHERE id=?",
+            (original[0], thumb[0] if thumb else None, request_id)
         )
-        await db.commit()
 
-async def list_user_requests(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
+async def media_failed(request_id: int, add: int = 1) -> int:
+    """Учесть неудачные попытки скачать вложение (add сразу — «больше не пробовать»); возвращает их число."""
+    async with write_conn() as db:
+        await db.execute("UPDATE requests SET media_attempts = media_attempts + ? WHERE id=?", (add, request_id))
+        async with db.execute("SELECT media_attempts FROM requests WHERE id=?", (request_id,)) as cur:
+            row = await cur.fetchone()
+    return row[0] if row else 0
+
+async def get_request_media(request_id: int) -> Optional[Tuple]:
+    """Копия вложения заявки: (sha256, размер, путь, на диске ли, путь миниатюры) или None."""
+    async with read_conn() as db:
+        async with db.execute(
             '''
-            SELECT id, ticket, user_id, text, media_id, latitude, longitude, status, admin_comment, created_at, updated_at, category, urgency, department
-            FROM requests
-            WHERE user_id=?
-            ORDER BY datetime(created_at) DESC
+            SELECT m.sha256, m.size, m.path, m.stored, t.path
+            FROM requests r JOIN media_files m ON m.sha256 = r.media_sha256
+            LEFT JOIN media_files t ON t.sha256 = r.thumb_sha256
+            WHERE r.id=?
             ''',
-            (user_id,)
+            (request_id,)
+        ) as cur:
+            return await cur.fetchone()
+
+async def get_media_kind(request_id: int) -> Optional[str]:
+    """Вид вложения заявки (ключ outbox.MEDIA_METHODS) или None — нет вложения или вид не записан."""
+    async with read_conn() as db:
+        async with db.execute("SELECT media_kind FROM requests WHERE id=?", (request_id,)) as cur:
+            row = await cur.fetchone()
+    return row[0] if row else None
+
+async def touch_media(used: List[Tuple[int, str]]):
+    """Отметить использование файлов: [(время в мс, sha256)]."""
+    async with write_conn() as db:
+        await db.executemany(
+            "UPDATE media_files SET last_used_ts=max(coalesce(last_used_ts, 0), ?) WHERE sha256=?", used
         )
-        return await cur.fetchall()
+
+async def media_usage() -> int:
+    """Сколько байт занимают оригиналы на диске (миниатюры не в счёт)."""
+    async with read_conn() as db:
+        async with db.execute("SELECT coalesce(sum(size), 0) FROM media_files WHERE stored=1 AND is_thumb=0") as cur:
+            return (await cur.fetchone())[0]
+
+async def list_media_lru(limit: int = 100) -> List[MediaFile]:
+    """Оригиналы на диске, давно не использованные — первыми."""
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT sha256, size, path FROM media_files WHERE stored=1 AND is_thumb=0 ORDER BY last_used_ts LIMIT ?",
+            (limit,)
+        ) as cur:
+            return await cur.fetchall()
+
+async def mark_media_evicted(shas: List[str]):
+    async with write_conn() as db:
+        await db.executemany("UPDATE media_files SET stored=0 WHERE sha256=? AND is_thumb=0", [(s,) for s in shas])
 
 async def get_request_by_ticket(ticket: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
+    async with read_conn() as db:
+        async with db.execute(
             '''
             SELECT id, ticket, user_id, text, media_id, latitude, longitude, status, admin_comment, created_at, updated_at, category, urgency, department
             FROM requests
             WHERE ticket=?
             ''',
             (ticket,)
-        )
-        return await cur.fetchone()
+        ) as cur:
+            return await cur.fetchone()
+
+async def get_request_by_id(request_id: int):
+    async with read_conn() as db:
+        async with db.execute(
+            '''
+            SELECT id, ticket, user_id, text, media_id, latitude, longitude, status, admin_comment, created_at, updated_at, category, urgency, department
+            FROM requests
+            WHERE id=?
+            ''',
+            (request_id,)
+        ) as cur:
+            return await cur.fetchone()
 
-async def update_status(ticket: str, status: str, admin_comment: Optional[str] = None):
+async def update_status(
+    ticket: str, status: str, admin_comment: Optional[str] = None, outbox: List[OutboxRow] = ()
+):
     now = datetime.utcnow().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with write_conn() as db:
         await db.execute(
             '''
             UPDATE requests
@@ -154,90 +1162,605 @@ async def update_status(ticket: str, status: str, admin_comment: Optional[str] =
             ''',
             (status, admin_comment, now, ticket)
         )
-        await db.commit()
+        if admin_comment is not None:
+            await _fts_set_comment(db, ticket, admin_comment)
+        queued = await _outbox_add(db, outbox)
+    _queue_cache_clear()
+    if queued:
+        _outbox_listener()
 
-async def save_reply(ticket: str, admin_id: int, text: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def save_reply(ticket: str, admin_id: int, text: str, outbox: List[OutboxRow] = ()):
+    now, now_ms = _now()
+    async with write_conn() as db:
         await db.execute(
-            "INSERT INTO replies(ticket, admin_id, text, created_at) VALUES(?,?,?,?)",
-            (ticket, admin_id, text, datetime.utcnow().isoformat())
+            "INSERT INTO replies(ticket, admin_id, text, created_at, created_ts) VALUES(?,?,?,?,?)",
+            (ticket, admin_id, text, now, now_ms)
         )
-        await db.commit()
+        await _fts_add_reply(db, ticket, text)
+        queued = await _outbox_add(db, outbox)
+    if queued:
+        _outbox_listener()
 
 async def list_replies(ticket: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, text, created_at FROM replies WHERE ticket=? ORDER BY datetime(created_at) ASC",
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT id, text, created_at FROM replies WHERE ticket=? ORDER BY created_ts, id",
             (ticket,)
-        )
-        return await cur.fetchall()
+        ) as cur:
+            return await cur.fetchall()
 
 async def export_requests(start_iso: str, end_iso: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
+    async with read_conn() as db:
+        async with db.execute(
             '''
-            SELECT id, ticket, user_id, text, media_id, latitude, longitude, status, admin_comment, created_at, updated_at, category, urgency, department
+            SELECT id, ticket, user_id, text, media_id, latitude, longitude, status, admin_comment, created_at, updated_at, category, urgency, department, media_sha256
             FROM requests
-            WHERE datetime(created_at) BETWEEN datetime(?) AND datetime(?)
-            ORDER BY datetime(created_at)
+            WHERE created_ts BETWEEN ? AND ?
+            ORDER BY created_ts, id
             ''',
-            (start_iso, end_iso)
+            (_iso_to_ms(start_iso), _iso_to_ms(end_iso))
+        ) as cur:
+            return await cur.fetchall()
+
+async def iter_export_requests(start_iso: str, end_iso: str, chunk: int = 500):
+    """
+    То же, что export_requests, но порциями по chunk строк (async-генератор).
+    Каждая порция — отдельный короткий запрос по (created_ts, id): соединение
+    из пула не держится занятым на весь экспорт и память не растёт.
+    """
+    start_ms, end_ms = _iso_to_ms(start_iso), _iso_to_ms(end_iso)
+    cursor = (start_ms, -1)
+    while True:
+        async with read_conn() as db:
+            async with db.execute(
+                '''
+                SELECT id, ticket, user_id, text, media_id, latitude, longitude, status, admin_comment, created_at, updated_at, category, urgency, department, media_sha256, created_ts
+                FROM requests
+                WHERE created_ts BETWEEN ? AND ? AND (created_ts, id) > (?, ?)
+                ORDER BY created_ts, id
+                LIMIT ?
+                ''',
+                (start_ms, end_ms, cursor[0], cursor[1], chunk)
+            ) as cur:
+                rows = await cur.fetchall()
+        if not rows:
+            return
+        cursor = (rows[-1][15], rows[-1][0])
+        yield [r[:15] for r in rows]
+        if len(rows) < chunk:
+            return
+
+async def export_status_counts(start_iso: str, end_iso: str) -> List[Tuple[str, int]]:
+    """Заявки за период по статусам — вместе с архивными."""
+    async with read_conn() as db:
+        async with db.execute(
+            '''
+            SELECT status, SUM(n) FROM (
+                SELECT status, COUNT(*) AS n FROM requests WHERE created_ts BETWEEN ?1 AND ?2 GROUP BY status
+                UNION ALL
+                SELECT status, COUNT(*) FROM archive_index WHERE created_ts BETWEEN ?1 AND ?2 GROUP BY status
+            ) GROUP BY status
+            ''',
+            (_iso_to_ms(start_iso), _iso_to_ms(end_iso))
+        ) as cur:
+            return await cur.fetchall()
+
+# ---- архив (см. archive.py) ----
+ArchiveWriter = Callable[[str, List[dict]], Awaitable[Tuple[str, int, int, str]]]
+
+async def archive_batch(before_ms: int, limit: int, write_block: ArchiveWriter) -> List[int]:
+    """
+    Перенести в архив до limit закрытых заявок старше before_ms (самые старые
+    первыми) вместе с ответами. write_block(месяц, записи) дописывает блок в
+    файл месяца и возвращает (путь, смещение, длина, sha256). Всё в одной
+    транзакции писателя: если запись файла не удалась, заявки остаются в базе,
+    а недописанный блок в файле никто не найдёт — на него нет ссылки в оглавлении.
+    Возвращает id перенесённых заявок.
+    """
+    async with write_conn() as db:
+        async with db.execute(
+            '''
+            SELECT * FROM requests
+            WHERE created_ts < ? AND status IN ('Завершено','Отклонено')
+            ORDER BY created_ts, id LIMIT ?
+            ''',
+            (before_ms, limit)
+        ) as cur:
+            names = [d[0] for d in cur.description]
+            records = [dict(zip(names, r)) for r in await cur.fetchall()]
+        if not records:
+            return []
+        tickets = [r["ticket"] for r in records]
+        marks = ",".join("?" * len(tickets))
+        replies: Dict[str, list] = {}
+        async with db.execute(
+            f"SELECT ticket, admin_id, text, created_at, created_ts FROM replies WHERE ticket IN ({marks}) ORDER BY created_ts, id",
+            tickets
+        ) as cur:
+            for ticket, admin_id, text, created_at, created_ts in await cur.fetchall():
+                replies.setdefault(ticket, []).append(
+                    {"admin_id": admin_id, "text": text, "created_at": created_at, "created_ts": created_ts}
+                )
+        by_month: Dict[str, List[dict]] = {}
+        for r in records:
+            r["replies"] = replies.get(r["ticket"], [])
+            by_month.setdefault((r["created_at"] or "")[:7] or "unknown", []).append(r)
+
+        now = datetime.utcnow().isoformat()
+        for month, block in by_month.items():
+            path, offset, length, sha = await write_block(month, block)
+            cur = await db.execute(
+                '''
+                INSERT INTO archive_blocks(month, path, offset, length, sha256, count, first_ts, last_ts, created_at)
+                VALUES(?,?,?,?,?,?,?,?,?)
+                ''',
+                (month, path, offset, length, sha, len(block),
+                 min(r["created_ts"] or 0 for r in block), max(r["created_ts"] or 0 for r in block), now)
+            )
+            await db.executemany(
+                '''
+                INSERT OR REPLACE INTO archive_index(ticket, request_id, block_id, created_ts, status, user_id, created_at, summary)
+                VALUES(?,?,?,?,?,?,?,?)
+                ''',
+                [(r["ticket"], r["id"], cur.lastrowid, r["created_ts"], r["status"],
+                  r["user_id"], r["created_at"], (r["text"] or "")[:ARCHIVE_SUMMARY]) for r in block]
+            )
+
+        ids = [r["id"] for r in records]
+        # отчётность считает и архивные заявки: возвращаем то, что вычтет триггер удаления
+        upsert = "ON CONFLICT(dim, key) DO UPDATE SET n = n + excluded.n"
+        for dim, expr in STATS_DIMS.items():
+            await db.execute(
+                f"INSERT INTO request_stats(dim, key, n) SELECT '{dim}', {expr.format(r='requests')}, COUNT(*) "
+                f"FROM requests WHERE id IN ({marks}) GROUP BY 2 {upsert}",
+                ids
+            )
+        await db.executemany("DELETE FROM requests WHERE id=?", [(i,) for i in ids])
+        await db.executemany("DELETE FROM replies WHERE ticket=?", [(t,) for t in tickets])
+    _queue_cache_clear()
+    return ids
+
+async def find_archived(ref) -> Optional[Tuple[str, int, str, int, int, str]]:
+    """Где лежит архивная заявка (ref — id или тикет): (тикет, id, путь, смещение, длина, sha256)."""
+    key = "i.request_id" if isinstance(ref, int) else "i.ticket"
+    async with read_conn() as db:
+        async with db.execute(
+            f'''
+            SELECT i.ticket, i.request_id, b.path, b.offset, b.length, b.sha256
+            FROM archive_index i JOIN archive_blocks b ON b.id = i.block_id
+            WHERE {key} = ?
+            ''',
+            (ref,)
+        ) as cur:
+            return await cur.fetchone()
+
+async def list_unindexed_blocks(after: int, limit: int) -> List[Tuple[int, str, int, int, str]]:
+    """
+    Блоки с id больше after, у заявок которых в оглавлении нет автора
+    (перенесены до _m017): (id, путь, смещение, длина, sha256).
+    """
+    async with read_conn() as db:
+        async with db.execute(
+            '''
+            SELECT id, path, offset, length, sha256 FROM archive_blocks
+            WHERE id > ? AND id IN (SELECT block_id FROM archive_index WHERE user_id IS NULL)
+            ORDER BY id LIMIT ?
+            ''',
+            (after, limit)
+        ) as cur:
+            return await cur.fetchall()
+
+async def set_archive_owners(rows: List[Tuple[int, str, str, str]]):
+    """Дописать в оглавление архива автора, дату и начало текста: [(user_id, created_at, text, ticket)]."""
+    async with write_conn() as db:
+        await db.executemany(
+            "UPDATE archive_index SET user_id=?, created_at=?, summary=? WHERE ticket=?",
+            [(uid, created, (text or "")[:ARCHIVE_SUMMARY], ticket) for uid, created, text, ticket in rows]
         )
-        return await cur.fetchall()
 
-async def cleanup_active_requests() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM replies WHERE ticket IN (SELECT ticket FROM requests WHERE status IN ('Новый','В обработке'))")
-        cur = await db.execute("DELETE FROM requests WHERE status IN ('Новый','В обработке')")
-        await db.commit()
-        return cur.rowcount
+async def list_archive_blocks(start_iso: str, end_iso: str) -> List[Tuple[str, int, int, str]]:
+    """Блоки архива, где могут быть заявки за период: (путь, смещение, длина, sha256)."""
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT path, offset, length, sha256 FROM archive_blocks WHERE first_ts <= ? AND last_ts >= ? ORDER BY first_ts, id",
+            (_iso_to_ms(end_iso), _iso_to_ms(start_iso))
+        ) as cur:
+            return await cur.fetchall()
 
-async def cleanup_all_requests() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM replies")
-        cur = await db.execute("DELETE FROM requests")
-        await db.commit()
-        return cur.rowcount
+async def archive_summary() -> List[Tuple[str, int, int, int]]:
+    """Архив по месяцам: (месяц, блоков, заявок, байт)."""
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT month, COUNT(*), SUM(count), SUM(length) FROM archive_blocks GROUP BY month ORDER BY month"
+        ) as cur:
+            return await cur.fetchall()
 
-async def cleanup_before(date_yyyy_mm_dd: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM replies WHERE ticket IN (SELECT ticket FROM requests WHERE date(created_at) < date(?))", (date_yyyy_mm_dd,))
-        cur = await db.execute("DELETE FROM requests WHERE date(created_at) < date(?)", (date_yyyy_mm_dd,))
-        await db.commit()
-        return cur.rowcount
+# ---- массовые операции порциями (см. bulk.py) ----
+# Порция — короткая транзакция по диапазону id: между порциями писатель
+# свободен, и новые заявки не ждут, пока закончится чистка десятков тысяч строк.
+# NOT INDEXED: идём по первичному ключу, а не сортируем выборку по индексу статуса
+# на каждой порции — так весь проход линейный.
+CLEANUP_SCOPES = {
+    "active": "status IN ('Новый','В обработке')",
+    "all": "1",
+    "before": "created_ts < :before",
+}
 
-async def bulk_close_active_requests() -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("UPDATE requests SET status='Завершено', updated_at=? WHERE status IN ('Новый','В обработке')", (datetime.utcnow().isoformat(),))
-        await db.commit()
-        return cur.rowcount
+def _scope_params(before: Optional[str], **params) -> dict:
+    return dict(params, before=_iso_to_ms(before) if before else None)
+
+async def count_cleanup(scope: str, before: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Сколько заявок попадает под чистку scope (before — дата YYYY-MM-DD для "before")
+    и наибольший id среди них: заявки, созданные позже, операция не трогает.
+    """
+    async with read_conn() as db:
+        async with db.execute(
+            f"SELECT count(*), coalesce(max(id), 0) FROM requests WHERE {CLEANUP_SCOPES[scope]}", _scope_params(before)
+        ) as cur:
+            return tuple(await cur.fetchone())
+
+async def cleanup_batch(
+    scope: str, after_id: int, upto_id: int, limit: int, before: Optional[str] = None
+) -> Tuple[List[int], Optional[int]]:
+    """
+    Удалить до limit заявок scope с id в (after_id, upto_id] вместе с их ответами.
+    Возвращает (id удалённых, последний id порции); последний None — удалять больше нечего.
+    """
+    where = CLEANUP_SCOPES[scope]
+    params = _scope_params(before, after=after_id, upto=upto_id, limit=limit)
+    async with write_conn() as db:
+        async with db.execute(
+            f"SELECT id, ticket FROM requests NOT INDEXED WHERE id > :after AND id <= :upto AND {where} "
+            f"ORDER BY id LIMIT :limit",
+            params
+        ) as cur:
+            rows = await cur.fetchall()
+        if not rows:
+            return [], None
+        await db.execute(
+            f"DELETE FROM requests WHERE id > :after AND id <= :last AND {where}",
+            dict(params, last=rows[-1][0])
+        )
+        await db.executemany("DELETE FROM replies WHERE ticket=?", [(t,) for _, t in rows])
+    _queue_cache_clear()
+    return [i for i, _ in rows], rows[-1][0]
+
+async def close_active_batch(
+    after_id: int, upto_id: int, limit: int, status: str = "Завершено",
+    outbox: Optional[Callable[[List[Tuple[int, str, int]]], List[OutboxRow]]] = None
+) -> Tuple[List[Tuple[int, str, int]], Optional[int]]:
+    """
+    Перевести в status до limit активных заявок с id в (after_id, upto_id].
+    Возвращает (закрытые (id, ticket, user_id), последний id); id None — активных больше нет.
+    outbox(закрытые) -> сообщения авторам, в той же транзакции.
+    """
+    queued = False
+    async with write_conn() as db:
+        async with db.execute(
+            f"SELECT id, ticket, user_id FROM requests NOT INDEXED WHERE id > ? AND id <= ? "
+            f"AND {CLEANUP_SCOPES['active']} ORDER BY id LIMIT ?",
+            (after_id, upto_id, limit)
+        ) as cur:
+            rows = await cur.fetchall()
+        if not rows:
+            return [], None
+        await db.execute(
+            f"UPDATE requests SET status=?, updated_at=? WHERE id > ? AND id <= ? AND {CLEANUP_SCOPES['active']}",
+            (status, datetime.utcnow().isoformat(), after_id, rows[-1][0])
+        )
+        if outbox is not None:
+            queued = await _outbox_add(db, outbox(rows))
+    _queue_cache_clear()
+    if queued:
+        _outbox_listener()
+    return rows, rows[-1][0]
 
 async def get_request_stats() -> Tuple[int, int, int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM requests")
-        total = (await cur.fetchone())[0]
-        cur = await db.execute("SELECT COUNT(*) FROM requests WHERE status='Завершено'")
-        done = (await cur.fetchone())[0]
-        cur = await db.execute("SELECT COUNT(*) FROM requests WHERE status='Отклонено'")
-        declined = (await cur.fetchone())[0]
-        return total, done, declined
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT dim, key, n FROM request_stats WHERE dim='total' OR (dim='status' AND key IN ('Завершено','Отклонено'))"
+        ) as cur:
+            got = {(dim, key): n for dim, key, n in await cur.fetchall()}
+    return got.get(("total", ""), 0), got.get(("status", "Завершено"), 0), got.get(("status", "Отклонено"), 0)
+
+async def get_request_stats_ext(days: int = 7) -> dict:
+    """
+    Расширенная сводка из request_stats: {измерение: [(значение, количество), ...]}.
+    Для 'day' — последние `days` дней, для остальных — по убыванию количества.
+    """
+    result = {}
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT dim, key, n FROM request_stats WHERE dim<>'day' AND n>0 ORDER BY dim, n DESC"
+        ) as cur:
+            for dim, key, n in await cur.fetchall():
+                result.setdefault(dim, []).append((key, n))
+        async with db.execute(
+            "SELECT key, n FROM request_stats WHERE dim='day' AND n>0 ORDER BY key DESC LIMIT ?",
+            (days,)
+        ) as cur:
+            result["day"] = await cur.fetchall()
+    return result
+
+# ---- журнал действий (см. audit.py) ----
+async def save_audit(events: List[Tuple[Optional[str], Optional[int], str, Optional[str], str, int]]):
+    """events: [(ticket, actor_id, action, details, created_at, created_ts)] — одной транзакцией."""
+    async with write_conn() as db:
+        await db.executemany(
+            "INSERT INTO audit_log(ticket, actor_id, action, details, created_at, created_ts) VALUES(?,?,?,?,?,?)",
+            events
+        )
+
+async def list_audit(ticket: str, limit: int = 50):
+    """Последние limit событий заявки по времени: [(actor_id, action, details, created_at, created_ts)]."""
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT actor_id, action, details, created_at, created_ts FROM ("
+            " SELECT id, actor_id, action, details, created_at, created_ts FROM audit_log"
+            " WHERE ticket=? ORDER BY created_ts DESC, id DESC LIMIT ?"
+            ") ORDER BY created_ts, id",
+            (ticket, limit)
+        ) as cur:
+            return await cur.fetchall()
+
+# ---- исходящие сообщения: отправитель (см. outbox.py) ----
+async def enqueue_outbox(rows: List[OutboxRow]):
+    """Сообщения, не привязанные к другому изменению в БД, — отдельной транзакцией."""
+    async with write_conn() as db:
+        queued = await _outbox_add(db, rows)
+    if queued:
+        _outbox_listener()
+
+async def outbox_due(now_ms: int, limit: int) -> List[Tuple[int, int, str, str, Optional[str], int]]:
+    """
+    Готовые к отправке сообщения: из каждого чата только самое раннее неотправленное
+    (порядок внутри чата), срочные первыми. [(id, chat_id, method, params, hook, attempts)]
+    """
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT id, chat_id, method, params, hook, attempts FROM outbox AS o "
+            "WHERE state=0 AND next_ts<=? "
+            "AND id=(SELECT min(id) FROM outbox WHERE state=0 AND chat_id=o.chat_id) "
+            "ORDER BY priority, id LIMIT ?",
+            (now_ms, limit)
+        ) as cur:
+            return await cur.fetchall()
+
+async def outbox_sent(outbox_id: int, message_id: Optional[int]):
+    async with write_conn() as db:
+        await db.execute(
+            "UPDATE outbox SET state=1, sent_ts=?, message_id=?, error=NULL WHERE id=?",
+            (_now()[1], message_id, outbox_id)
+        )
+
+async def outbox_retry(outbox_id: int, next_ts: int, error: str, attempt: bool = True):
+    """Отложить повтор до next_ts; attempt=False — попытка не считается (RetryAfter)."""
+    async with write_conn() as db:
+        await db.execute(
+            "UPDATE outbox SET next_ts=?, error=?, attempts=attempts+? WHERE id=?",
+            (next_ts, error, 1 if attempt else 0, outbox_id)
+        )
+
+async def outbox_failed(outbox_id: int, error: str):
+    async with write_conn() as db:
+        await db.execute("UPDATE outbox SET state=2, attempts=attempts+1, error=? WHERE id=?", (error, outbox_id))
+
+async def outbox_purge(before_ms: int) -> int:
+    """Удалить отправленные и безнадёжные сообщения старше before_ms (ключи им уже не нужны)."""
+    async with write_conn() as db:
+        async with db.execute("DELETE FROM outbox WHERE state<>0 AND created_ts<?", (before_ms,)) as cur:
+            return cur.rowcount
+
+async def outbox_stats() -> Tuple[int, int]:
+    """(ждут отправки, не удалось отправить)."""
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT (SELECT count(*) FROM outbox WHERE state=0), (SELECT count(*) FROM outbox WHERE state=2)"
+        ) as cur:
+            return tuple(await cur.fetchone())
+
+# ---- DIALOGS ----
+async def list_dialogs():
+    async with read_conn() as db:
+        async with db.execute("SELECT ticket, admin_id, user_id, last_activity_ts FROM dialogs") as cur:
+            return await cur.fetchall()
+
+async def save_dialog(ticket: str, admin_id: int, user_id: int, replaced: List[str] = ()):
+    """Записать диалог; replaced — тикеты диалогов, которые он вытесняет (удаляются)."""
+    now, now_ms = _now()
+    async with write_conn() as db:
+        await db.executemany("DELETE FROM dialogs WHERE ticket=?", [(t,) for t in replaced])
+        await db.execute(
+            "INSERT OR REPLACE INTO dialogs(ticket, admin_id, user_id, started_at, last_activity_ts) VALUES(?,?,?,?,?)",
+            (ticket, admin_id, user_id, now, now_ms)
+        )
+
+async def delete_dialogs(tickets: List[str], outbox: List[OutboxRow] = ()):
+    async with write_conn() as db:
+        await db.executemany("DELETE FROM dialogs WHERE ticket=?", [(t,) for t in tickets])
+        queued = await _outbox_add(db, outbox)
+    if queued:
+        _outbox_listener()
+
+async def expire_dialogs(
+    tickets: List[str], deadline: int, outbox: Callable[[List[Tuple]], List[OutboxRow]]
+) -> Tuple[List[Tuple[str, int, int, int]], Dict[str, int]]:
+    """
+    Закрыть из tickets диалоги, у которых и в БД нет активности с deadline (мс).
+    Отметки других процессов попадают только в БД (touch_dialogs) — поэтому
+    время перечитывается в той же транзакции, что и удаление. outbox(закрытые)
+    -> уведомления о них. Возвращает (закрытые [(ticket, admin_id, user_id,
+    last)], {ticket: last} — ещё активные).
+    """
+    marks = ",".join("?" * len(tickets))
+    async with write_conn() as db:
+        async with db.execute(
+            f"SELECT ticket, admin_id, user_id, last_activity_ts FROM dialogs WHERE ticket IN ({marks})", tickets
+        ) as cur:
+            rows = await cur.fetchall()
+        idle = [r for r in rows if (r[3] or 0) < deadline]
+        active = {r[0]: r[3] for r in rows if (r[3] or 0) >= deadline}
+        await db.executemany("DELETE FROM dialogs WHERE ticket=?", [(r[0],) for r in idle])
+        queued = await _outbox_add(db, outbox(idle))
+    if queued:
+        _outbox_listener()
+    return idle, active
+
+async def touch_dialogs(items: List[Tuple[str, int]]):
+    """items: [(ticket, last_activity_ts)] — пачкой, без коммита на каждое сообщение."""
+    async with write_conn() as db:
+        await db.executemany("UPDATE dialogs SET last_activity_ts=? WHERE ticket=?", [(ts, t) for t, ts in items])
+
+# ---- UPDATE INBOX (ingress/worker) ----
+async def enqueue_update(shard: int, payload: str):
+    now_ms = _now()[1]
+    async with write_conn() as db:
+        await db.execute("INSERT INTO update_inbox(shard, payload, created_ts) VALUES(?,?,?)", (shard, payload, now_ms))
+
+# Ingress уже ответил Telegram 200 — второй раз обновление не придёт. Поэтому
+# забранное воркером не удаляется, а помечается (claimed_ts, worker) и
+# удаляется ack_updates() после обработки. Упавший воркер при запуске
+# возвращает свои незавершённые строки в очередь (release_updates) —
+# обновление может обработаться повторно, но не потеряется.
+async def claim_updates(shard: int, worker: int, limit: int = 100) -> List[Tuple[int, str]]:
+    """Пометить своими до limit свободных обновлений доли в порядке поступления."""
+    now_ms = _now()[1]
+    async with write_conn() as db:
+        async with db.execute(
+            "UPDATE update_inbox SET claimed_ts=?, worker=? WHERE id IN "
+            "(SELECT id FROM update_inbox WHERE shard=? AND claimed_ts IS NULL ORDER BY id LIMIT ?) "
+            "RETURNING id, payload",
+            (now_ms, worker, shard, limit)
+        ) as cur:
+            rows = await cur.fetchall()
+    return sorted(rows)
+
+async def ack_updates(ids: List[int]):
+    """Удалить обработанные обновления."""
+    if not ids:
+        return
+    async with write_conn() as db:
+        await db.executemany("DELETE FROM update_inbox WHERE id=?", [(i,) for i in ids])
+
+async def release_updates(shard: int) -> int:
+    """Вернуть в очередь обновления доли, забранные и не обработанные (воркер упал)."""
+    async with write_conn() as db:
+        cur = await db.execute(
+            "UPDATE update_inbox SET claimed_ts=NULL, worker=NULL WHERE shard=? AND claimed_ts IS NOT NULL", (shard,)
+        )
+        return cur.rowcount
+
+async def get_cache_versions() -> dict:
+    async with read_conn() as db:
+        async with db.execute("SELECT name, v FROM cache_versions") as cur:
+            return dict(await cur.fetchall())
+
+# ---- BROADCASTS ----
+async def create_broadcast(admin_id: int, chat_id: int, message_id: int, text: str) -> Tuple[int, int]:
+    """Создать задание рассылки по всем авторам заявок. Возвращает (job_id, total)."""
+    async with write_conn() as db:
+        cur = await db.execute(
+            "INSERT INTO broadcast_jobs(admin_id, chat_id, message_id, text, status, created_at) VALUES(?,?,?,?,'running',?)",
+            (admin_id, chat_id, message_id, text, datetime.utcnow().isoformat())
+        )
+        job_id = cur.lastrowid
+        cur = await db.execute(
+            "INSERT INTO broadcast_recipients(job_id, user_id) SELECT DISTINCT ?, user_id FROM requests",
+            (job_id,)
+        )
+        total = cur.rowcount
+        await db.execute("UPDATE broadcast_jobs SET total=? WHERE id=?", (total, job_id))
+        return job_id, total
+
+async def list_running_broadcasts():
+    async with read_conn() as db:
+        async with db.execute("SELECT id, chat_id, message_id, text FROM broadcast_jobs WHERE status='running'") as cur:
+            return await cur.fetchall()
+
+async def get_broadcast(job_id: int):
+    async with read_conn() as db:
+        async with db.execute("SELECT total, sent, failed, status FROM broadcast_jobs WHERE id=?", (job_id,)) as cur:
+            return await cur.fetchone()
+
+async def broadcast_pending(job_id: int, after_user_id: int, limit: int) -> List[int]:
+    # keyset по user_id: не пересматриваем уже обработанных получателей
+    async with read_conn() as db:
+        async with db.execute(
+            "SELECT user_id FROM broadcast_recipients WHERE job_id=? AND user_id>? AND state='pending' ORDER BY user_id LIMIT ?",
+            (job_id, after_user_id, limit)
+        ) as cur:
+            return [r[0] for r in await cur.fetchall()]
+
+async def broadcast_mark(job_id: int, results: List[Tuple[int, str, Optional[str]]]):
+    """results: [(user_id, 'sent'|'failed', error)] — пишем пачкой одной транзакцией."""
+    sent = sum(1 for _, state, _ in results if state == "sent")
+    async with write_conn() as db:
+        await db.executemany(
+            "UPDATE broadcast_recipients SET state=?, error=?, attempts=attempts+1 WHERE job_id=? AND user_id=?",
+            [(state, err, job_id, uid) for uid, state, err in results]
+        )
+        await db.execute(
+            "UPDATE broadcast_jobs SET sent=sent+?, failed=failed+? WHERE id=?",
+            (sent, len(results) - sent, job_id)
+        )
+
+async def finish_broadcast(job_id: int, status: str):
+    async with write_conn() as db:
+        await db.execute(
+            "UPDATE broadcast_jobs SET status=?, finished_at=? WHERE id=?",
+            (status, datetime.utcnow().isoformat(), job_id)
+        )
 
 # ---- DEPARTMENTS ----
-async def assign_department(ticket: str, dept_key: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+async def assign_department(ticket: str, dept_key: str, outbox: List[OutboxRow] = ()):
+    async with write_conn() as db:
         await db.execute("UPDATE requests SET department=?, updated_at=? WHERE ticket=?", (dept_key, datetime.utcnow().isoformat(), ticket))
-        await db.commit()
+        queued = await _outbox_add(db, outbox)
+    _queue_cache_clear()
+    if queued:
+        _outbox_listener()
+
+# Отделы, как и админы, живут в памяти: load_departments() при старте (и у
+# воркеров — когда другой процесс их поменял), upsert_department и
+# set_department_active пишут в БД и перечитывают кэш. Меню «Направить в
+# отдел» и маршрутизация в БД не ходят. Порядок — порядок добавления (rowid).
+# (key, name, tg_chat_id, active)
+Department = Tuple[str, str, Optional[int], bool]
+_DEPTS: Dict[str, Department] = {}
+_depts_version = 0  # растёт при каждой перезагрузке: по нему сбрасываются собранные из кэша клавиатуры
+
+async def load_departments():
+    global _depts_version
+    async with read_conn() as db:
+        async with db.execute("SELECT key, name, tg_chat_id, active FROM departments ORDER BY rowid") as cur:
+            rows = await cur.fetchall()
+    _DEPTS.clear()
+    _DEPTS.update((key, (key, name or key, chat_id, bool(active))) for key, name, chat_id, active in rows)
+    _depts_version += 1
+
+def get_department(key: str) -> Optional[Department]:
+    return _DEPTS.get(key)
+
+def list_departments(active_only: bool = False) -> List[Department]:
+    return [d for d in _DEPTS.values() if d[3] or not active_only]
+
+def departments_version() -> int:
+    return _depts_version
 
 async def upsert_department(key: str, name: str, tg_chat_id: Optional[int]):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with write_conn() as db:
         await db.execute(
             "INSERT INTO departments(key,name,tg_chat_id) VALUES(?,?,?) "
             "ON CONFLICT(key) DO UPDATE SET name=excluded.name, tg_chat_id=excluded.tg_chat_id",
             (key, name, tg_chat_id)
         )
-        await db.commit()
+    await load_departments()
 
-async def list_departments():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT key, name, tg_chat_id FROM departments ORDER BY name")
-        return await cur.fetchall()
+async def set_department_active(key: str, active: bool) -> bool:
+    """Показать/скрыть отдел в меню. False — такого отдела нет."""
+    async with write_conn() as db:
+        cur = await db.execute("UPDATE departments SET active=? WHERE key=?", (int(active), key))
+        found = cur.rowcount > 0
+    await load_departments()
+    return found
@@ -0,0 +1,308 @@
+# dedup.py
+# Поиск почти одинаковых заявок при создании: когда горит дом, десятки жителей
+# пишут об одном и том же. Новая заявка, похожая на активную, помечается как
+# её дубль (requests.duplicate_of), а админам вместо новой рассылки
+# обновляется счётчик на уведомлении об исходной заявке (см. main.py).
+#
+# Как сравниваются тексты: текст -> основы слов (search.stems) -> шинглы
+# (символьные 3-граммы основ, так опечатки и разные формы слов не мешают) ->
+# MinHash-подпись из NUM_HASHES чисел. Доля совпавших чисел в подписях —
+# оценка сходства Жаккара множеств шинглов. Все NUM_HASHES хэшей шингла
+# берутся из одного дайджеста blake2b (по 16 бит) и кэшируются: набор
+# 3-грамм русских основ невелик, так что подпись — это несколько обращений
+# к кэшу и поэлементный минимум.
+#
+# Подписи активных «головных» заявок (не дублей) за последние DEDUP_WINDOW
+# секунд лежат в памяти в LSH-индексе: подпись режется на BANDS полос, заявки
+# хотя бы с одной совпавшей полосой — кандидаты. Так поиск не зависит от
+# размера активного набора. Кандидат — дубль, если сходство не ниже порога и
+# заявки рядом: расстояние до DEDUP_RADIUS_M, когда координаты есть у обеих;
+# если у одной их нет — порог сходства выше.
+#
+# Поиск — только в памяти, без обращений к БД. Индекс загружается при старте
+# (start_dedup), новые головные заявки процесс добавляет сам, а закрытые и
+# удалённые убирает forget() — смена статуса, массовое закрытие, чистка,
+# архив. Замка нет: между поиском и записью в индекс нет await, а новая
+# головная заявка занимает место в индексе ещё до сохранения — похожая,
+# пришедшая в это время, ждёт её сохранения (и только она), остальные
+# заявки сохраняются параллельно.
+#
+# Если процессов-воркеров несколько, индекс раз в CACHE_SYNC_EVERY секунд
+# догружает чужие головные заявки (id больше последнего загруженного) и
+# убирает закрытые в других процессах.
+
+import asyncio
+import struct
+from collections import deque
+from functools import lru_cache
+from hashlib import blake2b
+from time import time
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import db
+from config import CACHE_SYNC_EVERY, DEDUP_WINDOW, DEDUP_SIMILARITY, DEDUP_SIMILARITY_NO_GEO, DEDUP_RADIUS_M
+from geo import haversine_m
+from search import stems
+
+log = logging.getLogger("bot.dedup")
+
+NUM_HASHES = 32
+BANDS = 8                       # 8 полос по 4 числа: порог срабатывания LSH около 0.6
+ROWS = NUM_HASHES // BANDS
+SHINGLE = 3
+
+_UNPACK = struct.Struct(f"<{NUM_HASHES}H").unpack
+
+Signature = Tuple[int, ...]
+
+
+def shingles(text: Optional[str]) -> Set[str]:
+    out = set()
+    for s in stems(text):
+        w = f"_{s}_"
+        for i in range(max(1, len(w) - SHINGLE + 1)):
+            out.add(w[i:i + SHINGLE])
+    return out
+
+
+@lru_cache(maxsize=65536)
+def _hashes(shingle: str) -> Tuple[int, ...]:
+    # не hash(): он меняется от запуска к запуску, а подписи должны быть стабильны
+    return _UNPACK(blake2b(shingle.encode(), digest_size=2 * NUM_HASHES).digest())
+
+
+def signature(text: Optional[str]) -> Optional[Signature]:
+    """MinHash-подпись текста; None — в тексте нет значимых слов."""
+    sh = shingles(text)
+    if not sh:
+        return None
+    return tuple(map(min, zip(*map(_hashes, sh))))
+
+
+def similarity(s1: Signature, s2: Signature) -> float:
+    return sum(1 for x, y in zip(s1, s2) if x == y) / NUM_HASHES
+
+
+def _bands(sig: Signature) -> List[int]:
+    return [hash(sig[i:i + ROWS]) for i in range(0, NUM_HASHES, ROWS)]
+
+
+class _Entry:
+    __slots__ = ("request_id", "ticket", "created_ms", "lat", "lon", "sig", "keys")
+
+    def __init__(self, request_id, ticket, created_ms, lat, lon, sig):
+        self.request_id = request_id
+        self.ticket = ticket
+        self.created_ms = created_ms
+        self.lat = lat
+        self.lon = lon
+        self.sig = sig
+        self.keys = _bands(sig)
+
+
+class Match:
+    __slots__ = ("request_id", "ticket", "similarity", "distance")
+
+    def __init__(self, request_id: int, ticket: str, similarity: float, distance: Optional[float]):
+        self.request_id = request_id
+        self.ticket = ticket
+        self.similarity = similarity
+        self.distance = distance
+
+
+class DedupIndex:
+    """LSH-индекс подписей активных заявок за скользящее окно времени."""
+
+    def __init__(self, window_s: float = DEDUP_WINDOW):
+        self.window_ms = int(window_s * 1000)
+        self._bands: List[Dict[int, Set[int]]] = [{} for _ in range(BANDS)]
+        self._entries: Dict[int, _Entry] = {}
+        self._order = deque()   # id в порядке создания — для вытеснения по окну
+        # самый новый id, загруженный из БД. Двигает только _sync: заявки,
+        # добавленные процессом сами, не значат, что чужие до них уже загружены
+        self.last_id = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, request_id: int):
+        return request_id in self._entries
+
+    def ids(self) -> List[int]:
+        return list(self._entries)
+
+    def add(self, request_id: int, ticket: str, created_ms: int, lat, lon, sig: Optional[Signature]):
+        if sig is None or request_id in self._entries:
+            return
+        entry = _Entry(request_id, ticket, created_ms, lat, lon, sig)
+        self._entries[request_id] = entry
+        self._order.append(request_id)
+        for band, key in zip(self._bands, entry.keys):
+            band.setdefault(key, set()).add(request_id)
+
+    def remove(self, request_id: int):
+        entry = self._entries.pop(request_id, None)
+        if entry is None:
+            return
+        for band, key in zip(self._bands, entry.keys):
+            bucket = band.get(key)
+            if bucket is not None:
+                bucket.discard(request_id)
+                if not bucket:
+                    del band[key]
+
+    def expire(self, now_ms: int):
+        edge = now_ms - self.window_ms
+        while self._order:
+            entry = self._entries.get(self._order[0])
+            if entry is not None and entry.created_ms >= edge:
+                break
+            request_id = self._order.popleft()
+            if entry is not None:
+                self.remove(request_id)
+
+    def candidates(self, sig: Signature, lat=None, lon=None) -> List[Match]:
+        """Подходящие заявки, самые похожие первыми."""
+        seen: Set[int] = set()
+        for band, key in zip(self._bands, _bands(sig)):
+            bucket = band.get(key)
+            if bucket:
+                seen.update(bucket)
+        found = []
+        for request_id in seen:
+            entry = self._entries[request_id]
+            sim = similarity(sig, entry.sig)
+            distance = None
+            if None not in (lat, lon, entry.lat, entry.lon):
+                distance = haversine_m(lat, lon, entry.lat, entry.lon)
+                if distance > DEDUP_RADIUS_M or sim < DEDUP_SIMILARITY:
+                    continue
+            elif sim < DEDUP_SIMILARITY_NO_GEO:
+                continue
+            found.append(Match(request_id, entry.ticket, sim, distance))
+        found.sort(key=lambda m: (-m.similarity, m.distance or 0.0))
+        return found
+
+
+_INDEX = DedupIndex()
+# новые головные заявки, которые ещё сохраняются: временный id (< 0) в индексе
+# -> будущее (id, тикет) или None, если сохранить не удалось
+_SAVING: Dict[int, asyncio.Future] = {}
+_next_temp = 0
+_loaded = False
+_syncing = False
+_forgotten: Set[int] = set()  # forget() во время _sync: не добавлять их обратно
+_SYNCER: Optional[asyncio.Task] = None
+
+
+async def _sync(prune: bool = False):
+    """Догрузить из БД новые активные головные заявки (prune — и убрать закрытые)."""
+    global _loaded, _syncing
+    now_ms = int(time() * 1000)
+    since = now_ms - _INDEX.window_ms
+    _syncing = True
+    try:
+        rows = await db.list_dedup_heads(_INDEX.last_id, since)
+        for request_id, ticket, text, created_ms, lat, lon in rows:
+            if request_id not in _forgotten:
+                _INDEX.add(request_id, ticket, created_ms or now_ms, lat, lon, signature(text))
+        if rows:
+            _INDEX.last_id = max(_INDEX.last_id, rows[-1][0])
+        if prune:
+            active, top = await db.list_dedup_head_ids(since)
+            for request_id in _INDEX.ids():
+                if 0 < request_id <= top and request_id not in active:
+                    _INDEX.remove(request_id)
+    finally:
+        _syncing = False
+        _forgotten.clear()
+    _INDEX.expire(now_ms)
+    _loaded = True
+
+
+async def _sync_loop():
+    while True:
+        await asyncio.sleep(CACHE_SYNC_EVERY)
+        try:
+            await _sync(prune=True)
+        except Exception:
+            log.exception("Не удалось обновить индекс дублей")
+
+
+async def start_dedup(follow_others: bool = False):
+    """Загрузить индекс; follow_others — подтягивать заявки других процессов."""
+    global _SYNCER
+    await _sync()
+    if follow_others:
+        _SYNCER = asyncio.create_task(_sync_loop())
+
+
+async def stop_dedup():
+    global _SYNCER
+    if _SYNCER:
+        _SYNCER.cancel()
+        await asyncio.gather(_SYNCER, return_exceptions=True)
+        _SYNCER = None
+
+
+def find(sig: Optional[Signature], lat, lon) -> Optional[Match]:
+    """Самая похожая активная заявка рядом — только по индексу в памяти."""
+    if sig is None:
+        return None
+    _INDEX.expire(int(time() * 1000))
+    found = _INDEX.candidates(sig, lat, lon)
+    return found[0] if found else None
+
+
+async def create_or_link(
+    text: Optional[str], lat, lon, save: Callable[[Optional[int]], Awaitable[Tuple[int, str]]]
+) -> Tuple[int, Optional[Match]]:
+    """
+    Найти исходную заявку для нового текста и сохранить новую через
+    save(duplicate_of) -> (id, тикет). Одновременные сообщения об одном пожаре
+    не станут двумя «головными» заявками: вторая дождётся сохранения первой.
+    Возвращает (id новой заявки, исходная заявка или None).
+    """
+    global _next_temp
+    if not _loaded:
+        await _sync()
+    sig = signature(text)
+    while True:
+        match = find(sig, lat, lon)
+        if match is None or match.request_id > 0:
+            break
+        saved = await asyncio.shield(_SAVING[match.request_id])
+        if saved is not None:
+            match = Match(saved[0], saved[1], match.similarity, match.distance)
+            break
+        # та заявка не сохранилась — ищем заново
+    if match is not None or sig is None:
+        request_id, _ticket = await save(match.request_id if match else None)
+        return request_id, match
+
+    # новая головная: место в индексе — до сохранения, без await между поиском и этим
+    _next_temp -= 1
+    temp, now_ms = _next_temp, int(time() * 1000)
+    saving = _SAVING[temp] = asyncio.get_running_loop().create_future()
+    _INDEX.add(temp, "", now_ms, lat, lon, sig)
+    try:
+        request_id, ticket = await save(None)
+    except BaseException:
+        saving.set_result(None)
+        raise
+    else:
+        _INDEX.add(request_id, ticket, now_ms, lat, lon, sig)
+        saving.set_result((request_id, ticket))
+    finally:
+        _INDEX.remove(temp)
+        del _SAVING[temp]
+    return request_id, None
+
+
+def forget(*request_ids: int):
+    """Заявки закрыты или удалены — больше не считаются исходными для новых."""
+    for request_id in request_ids:
+        _INDEX.remove(request_id)
+        if _syncing:
+            _forgotten.add(request_id)
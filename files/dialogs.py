@@ -0,0 +1,167 @@
+# dialogs.py
+# Активные диалоги оператор <-> житель.
+# Раньше это были три словаря в main.py, которые терялись при рестарте.
+# Теперь источник истины — таблица dialogs, а в памяти лежит её копия с
+# индексами по тикету, админу и пользователю: маршрутизация каждого
+# сообщения — просто поиск в словаре, без чтения БД.
+# Изменения (старт/стоп) пишутся в БД сразу (write-through), а отметки
+# «последней активности» копятся в памяти и сбрасываются пачкой раз в минуту.
+# Диалоги без активности дольше DIALOG_IDLE_TIMEOUT закрываются автоматически
+# (это делает только главный процесс, см. IS_PRIMARY). Сообщения диалога могут
+# обрабатывать другие воркеры, поэтому закрытие проверяет время по БД.
+
+import asyncio
+import logging
+from time import time
+from typing import Dict, Optional
+
+import audit
+from config import DIALOG_IDLE_TIMEOUT, DIALOG_SWEEP_EVERY, IS_PRIMARY
+import outbox
+from db import delete_dialogs, expire_dialogs, list_dialogs, save_dialog, touch_dialogs
+
+log = logging.getLogger("bot.dialogs")
+
+_BY_TICKET: Dict[str, dict] = {}   # ticket -> {'admin_id': int, 'user_id': int, 'last': ms}
+_BY_ADMIN: Dict[int, str] = {}     # admin_id -> ticket
+_BY_USER: Dict[int, str] = {}      # user_id -> ticket
+_DIRTY: set = set()                # тикеты с несохранённой отметкой активности
+_SWEEPER: Optional[asyncio.Task] = None
+
+
+def _now_ms() -> int:
+    return int(time() * 1000)
+
+
+def _put(ticket: str, admin_id: int, user_id: int, last: int):
+    _BY_TICKET[ticket] = {"admin_id": admin_id, "user_id": user_id, "last": last}
+    _BY_ADMIN[admin_id] = ticket
+    _BY_USER[user_id] = ticket
+
+
+def _drop(ticket: str) -> Optional[dict]:
+    info = _BY_TICKET.pop(ticket, None)
+    if info:
+        if _BY_ADMIN.get(info["admin_id"]) == ticket:
+            _BY_ADMIN.pop(info["admin_id"], None)
+        if _BY_USER.get(info["user_id"]) == ticket:
+            _BY_USER.pop(info["user_id"], None)
+    _DIRTY.discard(ticket)
+    return info
+
+
+# ---- чтение (без I/O) ----
+def dialog_info(ticket: str) -> Optional[dict]:
+    return _BY_TICKET.get(ticket)
+
+
+def dialog_for_admin(admin_id: int) -> Optional[str]:
+    return _BY_ADMIN.get(admin_id)
+
+
+def dialog_for_user(user_id: int) -> Optional[str]:
+    return _BY_USER.get(user_id)
+
+
+def touch(ticket: str):
+    """Отметить активность в диалоге (в БД попадёт при следующем сбросе)."""
+    info = _BY_TICKET.get(ticket)
+    if info:
+        info["last"] = _now_ms()
+        _DIRTY.add(ticket)
+
+
+# ---- изменения (write-through) ----
+async def start_dialog(ticket: str, admin_id: int, user_id: int):
+    # у админа и у жителя может быть только один активный диалог
+    replaced = {t for t in (_BY_ADMIN.get(admin_id), _BY_USER.get(user_id)) if t and t != ticket}
+    await save_dialog(ticket, admin_id, user_id, replaced=list(replaced))
+    for t in replaced:
+        _drop(t)
+    _drop(ticket)
+    _put(ticket, admin_id, user_id, _now_ms())
+
+
+async def stop_dialog(ticket: str) -> Optional[dict]:
+    if ticket not in _BY_TICKET:
+        return None
+    await delete_dialogs([ticket])
+    return _drop(ticket)
+
+
+async def load_dialogs():
+    """Поднять активные диалоги из БД (при старте и при изменениях из других процессов)."""
+    rows = await list_dialogs()
+    # несохранённые отметки активности не теряем
+    seen = {t: info["last"] for t, info in _BY_TICKET.items()}
+    _BY_TICKET.clear()
+    _BY_ADMIN.clear()
+    _BY_USER.clear()
+    for ticket, admin_id, user_id, last in rows:
+        _put(ticket, admin_id, user_id, max(last or _now_ms(), seen.get(ticket, 0)))
+    _DIRTY.intersection_update(_BY_TICKET)
+    log.info("Активных диалогов: %s", len(_BY_TICKET))
+
+
+async def _flush_touches():
+    if not _DIRTY:
+        return
+    items = [(t, _BY_TICKET[t]["last"]) for t in _DIRTY if t in _BY_TICKET]
+    _DIRTY.clear()
+    await touch_dialogs(items)
+
+
+def _idle_messages(rows) -> list:
+    # уведомления оператору и жителю — в той же транзакции, что и удаление диалогов
+    messages = []
+    for ticket, admin_id, user_id, last in rows:
+        text = f"Диалог по заявке {ticket} завершён из-за отсутствия активности."
+        messages += [outbox.message(chat_id, text, f"dialog-idle:{ticket}:{chat_id}:{last}")
+                     for chat_id in (admin_id, user_id)]
+    return messages
+
+
+async def _expire_idle():
+    if not IS_PRIMARY:
+        return
+    deadline = _now_ms() - int(DIALOG_IDLE_TIMEOUT * 1000)
+    candidates = [t for t, info in _BY_TICKET.items() if info["last"] < deadline]
+    if not candidates:
+        return
+    # сообщения диалога могли обработать другие воркеры: их отметки есть только
+    # в БД (изменение last_activity_ts не меняет cache_versions) — решает БД
+    idle, active = await expire_dialogs(candidates, deadline, _idle_messages)
+    for ticket, last in active.items():
+        _BY_TICKET[ticket]["last"] = max(_BY_TICKET[ticket]["last"], last)
+    for ticket in set(candidates) - active.keys():
+        # закрыт сейчас или уже закрыт другим процессом
+        _drop(ticket)
+    for ticket, admin_id, _user_id, _last in idle:
+        audit.record(audit.DIALOG_TIMEOUT, ticket, admin_id)
+    if idle:
+        log.info("Закрыто неактивных диалогов: %s", len(idle))
+
+
+async def _sweep_loop():
+    while True:
+        await asyncio.sleep(DIALOG_SWEEP_EVERY)
+        try:
+            await _flush_touches()
+            await _expire_idle()
+        except Exception:
+            log.exception("Ошибка при обслуживании диалогов")
+
+
+async def start_dialog_sweeper():
+    global _SWEEPER
+    await _expire_idle()
+    _SWEEPER = asyncio.create_task(_sweep_loop())
+
+
+async def stop_dialog_sweeper():
+    global _SWEEPER
+    if _SWEEPER:
+        _SWEEPER.cancel()
+        await asyncio.gather(_SWEEPER, return_exceptions=True)
+        _SWEEPER = None
+    await _flush_touches()
@@ -0,0 +1,113 @@
+# export.py
+# Экспорт заявок за период в CSV/TXT (опционально .gz).
+# Строки читаются из БД порциями (db.iter_export_requests), а запись в файл
+# идёт в отдельном потоке (asyncio.to_thread) — event loop не блокируется
+# и бот продолжает отвечать остальным, пока готовится большой отчёт.
+# Заявки, перенесённые в архив (archive.py), идут в отчёт следом за остальными.
+
+import asyncio
+import csv
+import gzip
+from datetime import datetime
+from pathlib import Path
+from time import monotonic
+from typing import Awaitable, Callable, Optional
+
+from config import FILES_DIR
+from db import export_status_counts, iter_export_requests
+from archive import iter_rows as iter_archived_rows
+
+EXPORT_HEADERS = ["id", "ticket", "user_id", "text", "media_id", "latitude", "longitude", "status",
+                  "admin_comment", "created_at", "updated_at", "category", "urgency", "department", "media_sha256"]
+EXPORT_CHUNK = 1000
+PROGRESS_EVERY = 3.0  # сек между обновлениями прогресса
+
+Progress = Callable[[int, int], Awaitable[None]]
+
+
+def _open(path: Path, gz: bool, encoding: str):
+    if gz:
+        return gzip.open(path, "wt", encoding=encoding, newline="")
+    return open(path, "w", encoding=encoding, newline="")
+
+
+class _CsvWriter:
+    def __init__(self, path: Path, gz: bool):
+        self.f = _open(path, gz, "utf-8-sig")
+        self.w = csv.writer(self.f, delimiter=";")
+        self.w.writerow(EXPORT_HEADERS)
+
+    def write_rows(self, rows):
+        self.w.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class _TxtWriter:
+    def __init__(self, path: Path, gz: bool, d1: str, d2: str, counts):
+        self.f = _open(path, gz, "utf-8")
+        f = self.f
+        f.write(f"Отчёт по обращениям за период {d1}—{d2}\n")
+        f.write(f"Всего обращений: {sum(n for _, n in counts)}\n")
+        f.write("По статусам:\n")
+        for st, cnt in counts:
+            f.write(f"  - {st}: {cnt}\n")
+        f.write("\nСписок обращений:\n")
+
+    def write_rows(self, rows):
+        f = self.f
+        for r in rows:
+            _id, ticket, uid, text, media, lat, lon, status, comment, created, updated, category, urgency, department, sha = r
+            f.write(f"\n[{ticket}] {created} — {status}\n")
+            f.write(f"Автор: {uid}\n")
+            if category:
+                f.write(f"Категория: {category}\n")
+            if department:
+                f.write(f"Отдел: {department}\n")
+            if urgency:
+                f.write("Экстренность: да\n")
+            if lat is not None and lon is not None:
+                f.write(f"Координаты: {lat:.6f}, {lon:.6f}\n")
+            if media:
+                f.write(f"Медиа (file_id): {media}\n")
+            if sha:
+                f.write(f"Копия медиа (sha256): {sha}\n")
+            if comment:
+                f.write(f"Комментарий админа: {comment}\n")
+            f.write(f"Текст: {text}\n")
+
+    def close(self):
+        self.f.close()
+
+
+async def run_export(
+    fmt: str, d1: str, d2: str, start_iso: str, end_iso: str,
+    gz: bool = False, progress: Optional[Progress] = None
+) -> Path:
+    """Сформировать отчёт и вернуть путь к файлу. progress(готово, всего) — по желанию."""
+    counts = await export_status_counts(start_iso, end_iso)
+    total = sum(n for _, n in counts)
+
+    Path(FILES_DIR).mkdir(parents=True, exist_ok=True)
+    ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    path = Path(FILES_DIR) / f"report_{d1}_{d2}_{ts}.{fmt}{'.gz' if gz else ''}"
+    if fmt == "csv":
+        writer = await asyncio.to_thread(_CsvWriter, path, gz)
+    else:
+        writer = await asyncio.to_thread(_TxtWriter, path, gz, d1, d2, counts)
+
+    done = 0
+    last = monotonic()
+    try:
+        for chunks in (iter_export_requests(start_iso, end_iso, chunk=EXPORT_CHUNK),
+                       iter_archived_rows(start_iso, end_iso)):
+            async for rows in chunks:
+                await asyncio.to_thread(writer.write_rows, rows)
+                done += len(rows)
+                if progress and monotonic() - last >= PROGRESS_EVERY:
+                    last = monotonic()
+                    await progress(done, total)
+    finally:
+        await asyncio.to_thread(writer.close)
+    return path
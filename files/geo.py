@@ -0,0 +1,36 @@
+# geo.py
+# Геометрия для поиска заявок по месту. Координаты заявок лежат в R*Tree
+# (см. db._m008_geo): сначала по индексу берётся прямоугольник вокруг точки
+# (bbox_around), потом точное расстояние по сфере (haversine_m) отсекает
+# углы прямоугольника. Для масштабов города сферы хватает с запасом.
+
+from math import asin, cos, radians, sin, sqrt
+from typing import Tuple
+
+EARTH_RADIUS_M = 6_371_008.8     # средний радиус Земли
+METERS_PER_DEG_LAT = 111_320.0   # длина градуса меридиана (приблизительно)
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Расстояние между точками по поверхности Земли, метры."""
+    p1, p2 = radians(lat1), radians(lat2)
+    dp, dl = p2 - p1, radians(lon2 - lon1)
+    a = sin(dp / 2) ** 2 + cos(p1) * cos(p2) * sin(dl / 2) ** 2
+    return 2 * EARTH_RADIUS_M * asin(min(1.0, sqrt(a)))
+
+
+def bbox_around(lat: float, lon: float, radius_m: float) -> Tuple[float, float, float, float]:
+    """
+    Прямоугольник (min_lat, max_lat, min_lon, max_lon), в который заведомо
+    попадает круг radius_m вокруг точки. Переход через 180-й меридиан не
+    учитывается — городу он не грозит.
+    """
+    dlat = radius_m / METERS_PER_DEG_LAT
+    # у полюса градус долготы стремится к нулю — ограничиваем косинус снизу
+    dlon = radius_m / (METERS_PER_DEG_LAT * max(cos(radians(lat)), 0.01))
+    return (max(-90.0, lat - dlat), min(90.0, lat + dlat),
+            max(-180.0, lon - dlon), min(180.0, lon + dlon))
+
+
+def format_distance(meters: float) -> str:
+    return f"{meters:.0f} м" if meters < 1000 else f"{meters / 1000:.1f} км"
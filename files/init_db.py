@@ -3,10 +3,11 @@
 # Удобно запускать перед стартом бота.
 
 import asyncio
-from db import init_db
+from db import init_db, close_db
 
 async def main():
     await init_db()
+    await close_db()
     print("DB initialized")
 
 if __name__ == "__main__":
@@ -6,13 +6,13 @@
 # — Мягкие подсказки в мастере создания заявки
 # — Кнопка "🛑 Завершить диалог" для админа
 
+import asyncio
 import logging
-import csv
+import re
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Dict, Optional, List, Set, Tuple
 
-import aiosqlite
 from telegram import (
     Update,
     ReplyKeyboardMarkup, KeyboardButton,
@@ -27,16 +27,45 @@ from telegram.ext import (
 from telegram.error import BadRequest
 
 from config import (
-    BOT_TOKEN, ADMIN_SECRET, FILES_DIR, DB_PATH,
-    DEPARTMENTS, CATEGORY_TO_DEPT, EMERGENCY_ROUTE, URGENT_KEYWORDS
+    BOT_TOKEN, ADMIN_SECRET, FILES_DIR, BOT_MODE, IS_PRIMARY, WORKERS_TOTAL, MY_REQUESTS_PAGE, ADMIN_QUEUE_PAGE, SEARCH_PAGE,
+    NEARBY_RADII, NEARBY_RADIUS_M, NEARBY_LIMIT, DEDUP_EDIT_DELAY, TELEGRAM_BASE_URL, TELEGRAM_BASE_FILE_URL,
+    CATEGORY_TO_DEPT, EMERGENCY_ROUTE
 )
 from utils import gen_ticket
+from classifier import match_urgent
+from search import fts_query, best_snippet
+from geo import format_distance
+import dedup
+import media
+import archive
+import audit
+import bulk
+from export import run_export
+import outbox
+from dialogs import (
+    dialog_info, dialog_for_admin, dialog_for_user, touch,
+    start_dialog, stop_dialog, load_dialogs, start_dialog_sweeper, stop_dialog_sweeper
+)
+from webhook import run_server
+from updates import KeyedUpdateProcessor
+from router import Router, Incoming, normalize, set_state, pop_state
+from callbacks import (
+    CallbackRegistry, Ref, ref, pack, STATUS,
+    OP_OPEN_USER, OP_OPEN_USER_PAGED, OP_MY_PAGE, OP_CATEGORY, OP_ROUTE_MENU, OP_ROUTE, OP_BROADCAST_OK, OP_BROADCAST_STOP,
+    OP_BROADCAST_CANCEL, OP_CLEAN_ACTIVE, OP_BULKCLOSE, OP_DANGER_CANCEL, OP_OPEN,
+    OP_OPEN_PAGED, OP_QUEUE_PAGE, OP_QUEUE_FILTER, OP_QUEUE_SET, OP_SEARCH_PAGE, OP_OPEN_FOUND, OP_NEARBY, OP_OPEN_NEARBY,
+    OP_DIALOG_START, OP_DIALOG_STOP, OP_STATUS, OP_REPLY, OP_NOOP, OP_HISTORY
+)
+from broadcast import start_broadcast, cancel_broadcast, resume_broadcasts, stop_broadcasts
 from db import (
-    init_db, create_user, set_admin, list_admins,
-    save_request, list_user_requests, get_request_by_ticket, update_status,
-    save_reply, list_replies, export_requests,
-    cleanup_active_requests, cleanup_all_requests, cleanup_before, bulk_close_active_requests,
-    list_all_user_ids, get_request_stats, assign_department
+    init_db, open_db, close_db, create_user, set_admin, list_admins,
+    load_admins, is_admin_user,
+    load_departments, get_department, list_departments, departments_version, upsert_department, set_department_active,
+    save_request, list_user_requests_page, list_queue_page, get_request_by_ticket, get_request_by_id, update_status,
+    search_requests, list_requests_near,
+    duplicate_info, close_duplicates, save_notice, list_notices,
+    save_reply, list_replies, get_media_kind,
+    get_request_stats, get_request_stats_ext, assign_department, archive_summary, outbox_stats
 )
 
 # ========= ЛОГИ =========
@@ -63,11 +92,6 @@ except Exception:
         return (s if len(s) <= width else s[:max(0, width - len(placeholder))] + placeholder)
 
 
-# ========= ГЛОБАЛЬНЫЕ ДИАЛОГИ =========
-ACTIVE_DIALOGS_BY_TICKET = {}   # ticket -> {'admin_id': int, 'user_id': int}
-ACTIVE_DIALOGS_BY_ADMIN = {}    # admin_id -> ticket
-ACTIVE_DIALOGS_BY_USER = {}     # user_id -> ticket
-
 # ========= КНОПКИ =========
 BTN_CREATE = "📝 Создать обращение"
 BTN_MY = "📂 Мои обращения"
@@ -77,9 +101,11 @@ BTN_CANCEL = "❌ Отмена"
 BTN_CHOOSE_CATEGORY = "🏷️ Выбрать категорию"
 
 # внутри админ-меню
-BTN_ADMIN_NEW = "🆕 Последние заявки (5)"
+BTN_ADMIN_NEW = "🆕 Последние заявки"
+BTN_ADMIN_NEW_OLD = "🆕 Последние заявки (5)"  # так кнопка называлась раньше — у кого-то клавиатура ещё старая
 BTN_ADMIN_ACTIVE = "🔥 Активные заявки"
 BTN_ADMIN_FIND = "🔎 Открыть по тикету"
+BTN_ADMIN_SEARCH = "🔍 Поиск по тексту"
 BTN_ADMIN_SERVICE = "📊 Сервис и отчёты"
 BTN_BACK = "⬅️ В главное меню"
 
@@ -97,9 +123,6 @@ BTN_CLEAN_BEFORE = "🗓️ Удалить до даты…"
 BTN_DANGER_BACK = "⬅️ Назад"
 
 # ========= УТИЛИТЫ ФОРМАТИРОВАНИЯ =========
-def normalize(text: Optional[str]) -> str:
-    return (text or "").strip().lower()
-
 def esc(s: object) -> str:
     """Простейший HTML-эскейп (достаточно для телеграма)."""
     t = str(s if s is not None else "")
@@ -114,7 +137,7 @@ def status_badge(status: str) -> str:
     }
     return m.get(status, esc(status))
 
-def ticket_card_for_admin(row, dialog_info=None, last_reply=None) -> str:
+def ticket_card_for_admin(row, dialog_info=None, last_reply=None, note: str = "") -> str:
     # row из SELECT ... requests: 14 полей
     _id, ticket, user_id, text, media, lat, lon, status, admin_comment, created, updated, category, urgency, department = row
     lines = []
@@ -130,6 +153,8 @@ def ticket_card_for_admin(row, dialog_info=None, last_reply=None) -> str:
         lines.append("⚠️ Отмечена как <b>экстренная</b>")
     if dialog_info:
         lines.append(f"Диалог: 🟢 активен (оператор <code>{dialog_info.get('admin_id')}</code>)")
+    if note:
+        lines.append(note)
     if lat is not None and lon is not None:
         lines.append(f"Координаты: <code>{lat:.6f}, {lon:.6f}</code>")
     if admin_comment:
@@ -140,7 +165,7 @@ def ticket_card_for_admin(row, dialog_info=None, last_reply=None) -> str:
     lines.append(esc(text))
     return "\n".join(lines)
 
-def ticket_card_for_user(row, last_reply=None) -> str:
+def ticket_card_for_user(row, last_reply=None, note: str = "") -> str:
     _id, ticket, user_id, text, media, lat, lon, status, admin_comment, created, updated, category, urgency, department = row
     lines = []
     lines.append(f"<b>Заявка {esc(ticket)}</b>")
@@ -152,6 +177,8 @@ def ticket_card_for_user(row, last_reply=None) -> str:
         lines.append(f"Направлена в отдел: <code>{esc(department)}</code>")
     if urgency:
         lines.append("⚠️ Отмечена как <b>экстренная</b>")
+    if note:
+        lines.append(note)
     if lat is not None and lon is not None:
         lines.append(f"Координаты: <code>{lat:.6f}, {lon:.6f}</code>")
     if admin_comment:
@@ -162,6 +189,276 @@ def ticket_card_for_user(row, last_reply=None) -> str:
     lines.append(esc(text))
     return "\n".join(lines)
 
+STATS_SECTIONS = [
+    ("status", "По статусам"),
+    ("urgency", "Экстренность"),
+    ("category", "По категориям"),
+    ("department", "По отделам"),
+    ("day", "По дням (последние 7)"),
+]
+
+def stats_details(ext: dict) -> str:
+    """Расширенная часть отчётности (из get_request_stats_ext)."""
+    lines = []
+    for dim, title in STATS_SECTIONS:
+        items = ext.get(dim) or []
+        if not items:
+            continue
+        lines.append(f"\n<b>{title}:</b>")
+        for key, n in items:
+            if dim == "status":
+                label = status_badge(key)
+            elif dim == "urgency":
+                label = "🚨 экстренные" if key == "1" else "обычные"
+            else:
+                label = esc(key) if key else "не указано"
+            lines.append(f"— {label}: {n}")
+    return "\n".join(lines)
+
+def updates_details(processor) -> str:
+    """Состояние очереди входящих обновлений (метрики KeyedUpdateProcessor)."""
+    if not isinstance(processor, KeyedUpdateProcessor):
+        return ""
+    m = processor.snapshot()
+    return (
+        f"\n<b>Обработка обновлений:</b>\n"
+        f"— Выполняется: {m['running']} из {processor.concurrency}, ждут: {m['waiting']}\n"
+        f"— Макс. очередь одного чата: {m['max_depth']}\n"
+        f"— Ожидание: ср. {m['wait_avg']:.2f} с, макс. {m['wait_max']:.2f} с"
+    )
+
+def routes_details(stats: List[dict], top: int = 5) -> str:
+    """Самые затратные маршруты сообщений (из Router.stats())."""
+    if not stats:
+        return ""
+    lines = ["\n<b>Время обработки (топ разделов):</b>"]
+    for r in stats[:top]:
+        lines.append(f"— {esc(r['name'])}: {r['count']} раз, ср. {r['avg'] * 1000:.0f} мс, макс. {r['max'] * 1000:.0f} мс")
+    return "\n".join(lines)
+
+# ---- «Мои обращения»: одна страница в одном сообщении ----
+PAGE_FIRST, PAGE_OLDER, PAGE_NEWER = "f", "o", "n"
+
+async def my_requests_page(user_id: int, direction: str = PAGE_FIRST, cursor=(0, 0)):
+    """Текст и кнопки страницы заявок пользователя; None — заявок нет."""
+    if direction == PAGE_OLDER:
+        rows, has_older, has_newer = await list_user_requests_page(user_id, MY_REQUESTS_PAGE, older_than=cursor)
+    elif direction == PAGE_NEWER:
+        rows, has_older, has_newer = await list_user_requests_page(user_id, MY_REQUESTS_PAGE, newer_than=cursor)
+    else:
+        rows = None
+    if not rows:
+        # первая страница (или соседняя опустела — например, заявки удалили)
+        rows, has_older, has_newer = await list_user_requests_page(user_id, MY_REQUESTS_PAGE)
+    if not rows:
+        return None
+
+    # «К списку» из карточки вернёт на эту же страницу: всё, что не новее первой строки
+    first_id, first_ts = rows[0][0], rows[0][5]
+    lines = ["<b>Мои обращения</b>"]
+    details = []
+    for n, (request_id, ticket, status, created, rtext, _ts) in enumerate(rows, 1):
+        snippet = s_short(rtext, width=160, placeholder="…")
+        lines.append(
+            f"\n<b>{n}. {esc(ticket)}</b> — {status_badge(status)}\n"
+            f"<i>{esc(created)}</i>\n"
+            f"{esc(snippet)}"
+        )
+        details.append(InlineKeyboardButton(f"📄 {n}", callback_data=pack(OP_OPEN_USER_PAGED, request_id, first_ts, first_id + 1)))
+    keyboard = [details]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("◀ Новее", callback_data=pack(OP_MY_PAGE, PAGE_NEWER, first_ts, first_id)))
+    if has_older:
+        nav.append(InlineKeyboardButton("Старее ▶", callback_data=pack(OP_MY_PAGE, PAGE_OLDER, rows[-1][5], rows[-1][0])))
+    if nav:
+        keyboard.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+# ---- Очередь заявок для админа: одна страница в одном сообщении ----
+# Фильтр хранится в user_data["queue"]: поле -> код значения, "*" — любое.
+#   s — статус: "a" активные, иначе код из callbacks.STATUS
+#   c — категория, d — отдел (ключи), u — экстренность "1"/"0"
+ANY = "*"
+QUEUE_ACTIVE = {"s": "a", "c": ANY, "d": ANY, "u": ANY}
+QUEUE_RECENT = {"s": ANY, "c": ANY, "d": ANY, "u": ANY}
+ACTIVE_STATUSES = ("Новый", "В обработке")
+QUEUE_FIELDS = {"s": "Статус", "c": "Категория", "d": "Отдел", "u": "Экстренность"}
+
+def queue_options(field: str) -> List[Tuple[str, str]]:
+    """Варианты фильтра: [(код, подпись)], первым — «все»."""
+    if field == "s":
+        return [(ANY, "Все"), ("a", "Активные")] + [(code, status_badge(st)) for st, code in STATUS.to_code.items()]
+    if field == "c":
+        return [(ANY, "Все")] + list(CATEGORY_LABELS.items())
+    if field == "d":
+        return [(ANY, "Все")] + [(key, name) for key, name, _chat, _active in list_departments()]
+    return [(ANY, "Все"), ("1", "🚨 Экстренные"), ("0", "Обычные")]
+
+def queue_label(field: str, code: str) -> str:
+    return dict(queue_options(field)).get(code, code)
+
+def queue_filter(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    return context.user_data.setdefault("queue", dict(QUEUE_ACTIVE))
+
+async def queue_view(flt: dict, direction: str = PAGE_FIRST, cursor=(0, 0)):
+    """Текст и кнопки страницы очереди по фильтру."""
+    s_code = flt.get("s", ANY)
+    if s_code == "a":
+        statuses = ACTIVE_STATUSES
+    elif s_code in STATUS.from_code:
+        statuses = (STATUS.decode(s_code),)
+    else:
+        statuses = None
+    query = dict(
+        statuses=statuses,
+        category=None if flt.get("c", ANY) == ANY else flt["c"],
+        department=None if flt.get("d", ANY) == ANY else flt["d"],
+        urgency=None if flt.get("u", ANY) == ANY else int(flt["u"]),
+        limit=ADMIN_QUEUE_PAGE,
+    )
+    rows = None
+    if direction == PAGE_OLDER:
+        rows, has_older, has_newer = await list_queue_page(older_than=cursor, **query)
+    elif direction == PAGE_NEWER:
+        rows, has_older, has_newer = await list_queue_page(newer_than=cursor, **query)
+    if not rows:
+        rows, has_older, has_newer = await list_queue_page(**query)
+
+    summary = " · ".join(f"{title}: {queue_label(f, flt.get(f, ANY))}" for f, title in QUEUE_FIELDS.items())
+    lines = [f"<b>Очередь заявок</b>\n<i>{esc(summary)}</i>"]
+    if not rows:
+        lines.append("\nЗаявок по фильтру нет.")
+    opens = []
+    anchor = (rows[0][-1], rows[0][0] + 1) if rows else (0, 0)
+    for n, (request_id, ticket, uid, rtext, status, created, _cat, urgency, _dept, dups, _ts) in enumerate(rows, 1):
+        snippet = s_short(rtext, width=120, placeholder="…")
+        dial = " 🟢 Диалог" if dialog_info(ticket) else ""
+        urgent = "🚨 " if urgency else ""
+        same = f" 🔁 +{dups}" if dups else ""
+        lines.append(
+            f"\n<b>{n}. {urgent}{esc(ticket)}</b> — {status_badge(status)}{same}{dial}\n"
+            f"Автор: <code>{uid}</code> · <code>{esc(created)}</code>\n"
+            f"{esc(snippet)}"
+        )
+        opens.append(InlineKeyboardButton(str(n), callback_data=pack(OP_OPEN_PAGED, request_id, *anchor)))
+
+    keyboard = [opens[i:i + 5] for i in range(0, len(opens), 5)]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("◀ Новее", callback_data=pack(OP_QUEUE_PAGE, PAGE_NEWER, rows[0][-1], rows[0][0])))
+    nav.append(InlineKeyboardButton("🔄", callback_data=pack(OP_QUEUE_PAGE, PAGE_OLDER, *anchor) if rows else pack(OP_QUEUE_PAGE, PAGE_FIRST, 0, 0)))
+    if has_older:
+        nav.append(InlineKeyboardButton("Старее ▶", callback_data=pack(OP_QUEUE_PAGE, PAGE_OLDER, rows[-1][-1], rows[-1][0])))
+    keyboard.append(nav)
+    fields = [InlineKeyboardButton(f"⚙️ {title}", callback_data=pack(OP_QUEUE_FILTER, f)) for f, title in QUEUE_FIELDS.items()]
+    keyboard += [fields[:2], fields[2:]]
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+def queue_filter_keyboard(field: str) -> InlineKeyboardMarkup:
+    buttons = [InlineKeyboardButton(label, callback_data=pack(OP_QUEUE_SET, field, code)) for code, label in queue_options(field)]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    rows.append([InlineKeyboardButton("⬅️ Назад", callback_data=pack(OP_QUEUE_PAGE, PAGE_FIRST, 0, 0))])
+    return InlineKeyboardMarkup(rows)
+
+async def send_queue(update: Update, context: ContextTypes.DEFAULT_TYPE, flt: dict):
+    context.user_data["queue"] = flt
+    text, buttons = await queue_view(flt)
+    await update.message.reply_text(text, reply_markup=buttons, parse_mode="HTML")
+
+# ---- Поиск по тексту (admin): страница результатов в одном сообщении ----
+# Текст запроса в callback_data не помещается: последние SEARCH_KEEP запросов
+# лежат в user_data["searches"] под номерами, кнопки ссылаются на номер.
+SEARCH_KEEP = 5
+# индекс FTS — в базе, а архив (/archive) в файлах: перенесённые заявки поиск не находит
+SEARCH_ARCHIVE_NOTE = "\n<i>Заявки из архива (/archive) в поиск не входят — их открывают по номеру.</i>"
+
+def remember_search(context: ContextTypes.DEFAULT_TYPE, text: str) -> int:
+    seq = context.user_data.get("search_seq", 0) + 1
+    context.user_data["search_seq"] = seq
+    searches = context.user_data.setdefault("searches", {})
+    searches[seq] = text
+    for old in sorted(searches)[:-SEARCH_KEEP]:
+        del searches[old]
+    return seq
+
+async def search_view(text: str, seq: int, page: int = 0):
+    """Текст и кнопки страницы результатов поиска (page — с нуля)."""
+    match = fts_query(text)
+    if match is None:
+        return "Запрос пустой: укажите хотя бы одно значимое слово.", None
+    prefix = False
+    rows, total, capped = await search_requests(match, SEARCH_PAGE, page * SEARCH_PAGE)
+    if not total:
+        # точных совпадений нет — пробуем слова запроса как начало слова («водокан» -> «водоканал»)
+        prefix = True
+        rows, total, capped = await search_requests(fts_query(text, prefix=True), SEARCH_PAGE, page * SEARCH_PAGE)
+    if not rows and page:
+        return await search_view(text, seq, 0)
+
+    lines = [f"<b>🔍 Поиск:</b> {esc(text)}"]
+    if not rows:
+        lines.append("\nНичего не найдено.")
+        lines.append(SEARCH_ARCHIVE_NOTE)
+        return "\n".join(lines), None
+    pages = (total + SEARCH_PAGE - 1) // SEARCH_PAGE
+    found = f"больше {total}, показаны лучшие среди последних {total}" if capped else str(total)
+    lines.append(f"<i>Найдено: {found} · стр. {page + 1} из {pages}</i>")
+    opens = []
+    for n, (request_id, ticket, _uid, status, created, urgency, rtext, comment, replies) in enumerate(rows, page * SEARCH_PAGE + 1):
+        fields = (("", rtext), ("📝 Комментарий: ", comment), ("💬 Ответ: ", replies))
+        snippet = best_snippet(fields, text, prefix) or esc(s_short(rtext, width=120, placeholder="…"))
+        urgent = "🚨 " if urgency else ""
+        lines.append(
+            f"\n<b>{n}. {urgent}{esc(ticket)}</b> — {status_badge(status)}\n"
+            f"<code>{esc(created)}</code>\n{snippet}"
+        )
+        opens.append(InlineKeyboardButton(str(n), callback_data=pack(OP_OPEN_FOUND, request_id, seq, page)))
+
+    if page + 1 >= pages:
+        lines.append(SEARCH_ARCHIVE_NOTE)
+
+    keyboard = [opens]
+    nav = []
+    if page:
+        nav.append(InlineKeyboardButton("◀ Назад", callback_data=pack(OP_SEARCH_PAGE, seq, page - 1)))
+    if page + 1 < pages:
+        nav.append(InlineKeyboardButton("Дальше ▶", callback_data=pack(OP_SEARCH_PAGE, seq, page + 1)))
+    if nav:
+        keyboard.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def send_search(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    seq = remember_search(context, text)
+    msg, buttons = await search_view(text, seq)
+    await update.message.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
+
+# ---- Активные заявки рядом с заявкой (admin) ----
+async def nearby_view(origin, radius: int):
+    """Текст и кнопки: активные заявки в radius метрах от заявки origin (строка requests)."""
+    origin_id, origin_ticket, lat, lon = origin[0], origin[1], origin[5], origin[6]
+    found = await list_requests_near(lat, lon, radius, statuses=ACTIVE_STATUSES, exclude_id=origin_id, limit=NEARBY_LIMIT)
+    lines = [f"<b>📍 Активные заявки в радиусе {format_distance(radius)} от {esc(origin_ticket)}</b>"]
+    if not found:
+        lines.append("\nРядом активных заявок нет.")
+    opens = []
+    for n, (dist, (request_id, ticket, _uid, status, created, rtext, urgency, *_)) in enumerate(found, 1):
+        urgent = "🚨 " if urgency else ""
+        lines.append(
+            f"\n<b>{n}. {urgent}{esc(ticket)}</b> — {status_badge(status)} · {format_distance(dist)}\n"
+            f"<code>{esc(created)}</code>\n{esc(s_short(rtext, width=120, placeholder='…'))}"
+        )
+        opens.append(InlineKeyboardButton(str(n), callback_data=pack(OP_OPEN_NEARBY, request_id, origin_id, radius)))
+
+    keyboard = [opens[i:i + 5] for i in range(0, len(opens), 5)]
+    keyboard.append([
+        InlineKeyboardButton(f"• {format_distance(r)}" if r == radius else format_distance(r),
+                             callback_data=pack(OP_NEARBY, origin_id, r))
+        for r in NEARBY_RADII
+    ])
+    keyboard.append([InlineKeyboardButton("⬅️ К заявке", callback_data=pack(OP_OPEN, origin_id))])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
 # ========= КЛАВИАТУРЫ =========
 MAIN_KEYBOARD = ReplyKeyboardMarkup(
     [[KeyboardButton(BTN_CREATE)],
@@ -189,6 +486,7 @@ def admin_keyboard() -> ReplyKeyboardMarkup:
             [KeyboardButton(BTN_ADMIN_NEW)],
             [KeyboardButton(BTN_ADMIN_ACTIVE)],
             [KeyboardButton(BTN_ADMIN_FIND)],
+            [KeyboardButton(BTN_ADMIN_SEARCH)],
             [KeyboardButton(BTN_ADMIN_SERVICE)],
             [KeyboardButton(BTN_BACK)],
         ],
@@ -218,30 +516,94 @@ def danger_keyboard() -> ReplyKeyboardMarkup:
         resize_keyboard=True
     )
 
-def admin_dialog_inline_keyboard(ticket: str) -> InlineKeyboardMarkup:
+def admin_dialog_inline_keyboard(r: Ref) -> InlineKeyboardMarkup:
     """Инлайн-кнопки для админа прямо в чате во время активного диалога."""
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🛑 Завершить диалог", callback_data=f"dialog:stop:{ticket}")],
-        [InlineKeyboardButton("📄 Открыть карточку", callback_data=f"open:{ticket}")]
+        [InlineKeyboardButton("🛑 Завершить диалог", callback_data=pack(OP_DIALOG_STOP, r))],
+        [InlineKeyboardButton("📄 Открыть карточку", callback_data=pack(OP_OPEN, r))]
     ])
 
+async def card_note(request_id: int) -> Tuple[str, Optional[int]]:
+    """Строки карточки о дублях и копии вложения; id исходной заявки (если эта — дубль)."""
+    lines, original_id = [], None
+    original, count, last = await duplicate_info(request_id)
+    if original:
+        lines.append(f"🔁 Дубль заявки <code>{esc(original[1])}</code>")
+        original_id = original[0]
+    elif count:
+        lines.append(f"🔁 Похожих заявок: <b>{count}</b> (последняя <code>{esc(last)}</code>)")
+    copy = await media.local_copy(request_id)
+    if copy:
+        sha, size, path, _thumb = copy
+        kept = "сохранено" if path else "вытеснено с диска (хэш сохранён)"
+        lines.append(f"📎 Вложение {kept}: {size / 1024 ** 2:.1f} МБ, sha256 <code>{sha[:16]}…</code>")
+    return "\n".join(lines), original_id
+
+async def archived_card(r: Ref, user_id: Optional[int] = None) -> Optional[str]:
+    """
+    Карточка заявки из архива (только просмотр) или None, если там её нет.
+    user_id — карточка для жителя: только его заявка, без служебных полей.
+    """
+    try:
+        record = await archive.lookup(r)
+    except Exception as e:
+        log.warning("Не удалось прочитать заявку %s из архива: %s", r, e)
+        return f"Заявка {esc(r)} в архиве, но прочитать её не удалось: {esc(e)}"
+    if not record or (user_id is not None and record.get("user_id") != user_id):
+        return None
+    replies = record.get("replies") or []
+    last = (None, replies[-1]["text"], replies[-1]["created_at"]) if replies else None
+    if user_id is not None:
+        return ticket_card_for_user(archive.as_row(record), last_reply=last, note="📦 Заявка в архиве")
+    note = f"📦 В архиве (ответов: {len(replies)}) — только просмотр"
+    return ticket_card_for_admin(archive.as_row(record), last_reply=last, note=note)
+
+def admin_card_buttons(row, dinfo, admin_id: int, back=None, original: Optional[int] = None) -> InlineKeyboardMarkup:
+    """
+    Кнопки управления под карточкой заявки; back — callback_data кнопки «К списку»
+    (очередь, поиск), original — id исходной заявки, если эта — её дубль.
+    """
+    request_id, status = row[0], row[7]
+    back_row = [[InlineKeyboardButton("🕓 История", callback_data=pack(OP_HISTORY, request_id))]]
+    if back:
+        back_row.append([InlineKeyboardButton("⬅️ К списку", callback_data=back)])
+    if original is not None:
+        back_row.insert(0, [InlineKeyboardButton("🔁 Исходная заявка", callback_data=pack(OP_OPEN, original))])
+    if row[5] is not None and row[6] is not None:
+        back_row.insert(0, [InlineKeyboardButton("📍 Активные рядом", callback_data=pack(OP_NEARBY, request_id, NEARBY_RADIUS_M))])
+    if status in ("Завершено", "Отклонено"):
+        return InlineKeyboardMarkup([[InlineKeyboardButton("Ответить пользователю", callback_data=pack(OP_REPLY, request_id))]] + back_row)
+    if dinfo and dinfo.get("admin_id") == admin_id:
+        dialog_row = [InlineKeyboardButton("Завершить диалог", callback_data=pack(OP_DIALOG_STOP, request_id))]
+    elif dinfo:
+        dialog_row = [InlineKeyboardButton("Диалог ведёт другой оператор", callback_data=pack(OP_NOOP, request_id))]
+    else:
+        dialog_row = [InlineKeyboardButton("Начать диалог", callback_data=pack(OP_DIALOG_START, request_id))]
+    return InlineKeyboardMarkup([
+        dialog_row,
+        [InlineKeyboardButton("Ответить (разово)", callback_data=pack(OP_REPLY, request_id))],
+        [InlineKeyboardButton("Направить в отдел", callback_data=pack(OP_ROUTE_MENU, request_id))],
+        [InlineKeyboardButton("Завершено", callback_data=pack(OP_STATUS, request_id, STATUS.encode("Завершено"))),
+         InlineKeyboardButton("Отклонено", callback_data=pack(OP_STATUS, request_id, STATUS.encode("Отклонено")))]
+    ] + back_row)
+
+# Категории в порядке и раскладке клавиатуры выбора: (ключ, подпись)
+CATEGORY_ROWS = [
+    [("emerg_fire", "🚨 Пожар"), ("emerg_murder", "🚨 Убийство/Нападение")],
+    [("emerg_bomb", "🚨 Бомба/Заминировано"), ("emerg_flood", "🚨 Наводнение/Потоп")],
+    [("emerg_uav", "🚨 Атака БПЛА")],
+    [("police", "👮 Полиция"), ("fire", "🔥 Пожарная часть")],
+    [("housing", "🏠 ЖКХ"), ("roads", "🛣️ Дороги")],
+    [("lighting", "💡 Освещение"), ("water", "🚰 Водоканал")],
+    [("heat", "🔥 Теплосети"), ("gas", "🧯 Газ")],
+]
+CATEGORY_LABELS = {key: label for row in CATEGORY_ROWS for key, label in row}
+
 def build_category_keyboard():
-    rows = [
-        [InlineKeyboardButton("🚨 Пожар", callback_data="cat:emerg_fire"),
-         InlineKeyboardButton("🚨 Убийство/Нападение", callback_data="cat:emerg_murder")],
-        [InlineKeyboardButton("🚨 Бомба/Заминировано", callback_data="cat:emerg_bomb"),
-         InlineKeyboardButton("🚨 Наводнение/Потоп", callback_data="cat:emerg_flood")],
-        [InlineKeyboardButton("🚨 Атака БПЛА", callback_data="cat:emerg_uav")],
-        [InlineKeyboardButton("👮 Полиция", callback_data="cat:police"),
-         InlineKeyboardButton("🔥 Пожарная часть", callback_data="cat:fire")],
-        [InlineKeyboardButton("🏠 ЖКХ", callback_data="cat:housing"),
-         InlineKeyboardButton("🛣️ Дороги", callback_data="cat:roads")],
-        [InlineKeyboardButton("💡 Освещение", callback_data="cat:lighting"),
-         InlineKeyboardButton("🚰 Водоканал", callback_data="cat:water")],
-        [InlineKeyboardButton("🔥 Теплосети", callback_data="cat:heat"),
-         InlineKeyboardButton("🧯 Газ", callback_data="cat:gas")],
-    ]
-    return InlineKeyboardMarkup(rows)
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=pack(OP_CATEGORY, key)) for key, label in row]
+        for row in CATEGORY_ROWS
+    ])
 
 def build_create_flow_keyboard() -> ReplyKeyboardMarkup:
     return ReplyKeyboardMarkup(
@@ -253,34 +615,6 @@ def build_create_flow_keyboard() -> ReplyKeyboardMarkup:
         one_time_keyboard=False
     )
 
-# ========= МАЛЫЕ SQL-ХЭЛПЕРЫ ДЛЯ АДМИНА =========
-async def admin_recent_requests(limit: int = 5) -> List[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT ticket, user_id, text, status, created_at
-            FROM requests
-            ORDER BY datetime(created_at) DESC
-            LIMIT ?
-            """,
-            (limit,)
-        )
-        return await cur.fetchall()
-
-async def admin_active_requests(limit: int = 20) -> List[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            """
-            SELECT ticket, user_id, text, status, created_at
-            FROM requests
-            WHERE status IN ('Новый', 'В обработке')
-            ORDER BY datetime(created_at) DESC
-            LIMIT ?
-            """,
-            (limit,)
-        )
-        return await cur.fetchall()
-
 # ========= СЛУЖЕБНОЕ =========
 def private_only(update: Update) -> bool:
     chat = update.effective_chat
@@ -289,8 +623,7 @@ def private_only(update: Update) -> bool:
 async def ensure_user_and_admin(update: Update) -> tuple[bool, ReplyKeyboardMarkup]:
     user = update.effective_user
     await create_user(user.id, user.username, user.first_name)
-    admins = await list_admins()
-    is_admin = user.id in admins
+    is_admin = is_admin_user(user.id)
     return is_admin, make_keyboard(is_admin)
 
 # ========= КОМАНДЫ =========
@@ -300,8 +633,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     user = update.effective_user
     await create_user(user.id, user.username, user.first_name)
-    admins = await list_admins()
-    is_admin = user.id in admins
+    is_admin = is_admin_user(user.id)
     await update.message.reply_text(
         "<b>Привет!</b> Я бот для обращений по ЖКХ/благоустройству.\n\n"
         "Нажмите «📝 Создать обращение», чтобы оставить заявку.\n"
@@ -323,6 +655,7 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     code = args[1].strip()
     if code == ADMIN_SECRET:
         await set_admin(user.id)
+        audit.record(audit.ADMIN, actor_id=user.id)
         await update.message.reply_text("Готово! У вас права администратора.", reply_markup=make_keyboard(True))
     else:
         await update.message.reply_text("Код неверный.", reply_markup=MAIN_KEYBOARD)
@@ -333,21 +666,25 @@ async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эта команда доступна только в личном чате.")
         return
     user = update.effective_user
-    admins = await list_admins()
-    if user.id not in admins:
+    if not is_admin_user(user.id):
         await update.message.reply_text("Доступ запрещён.")
         return
 
-    parts = (update.message.text or "").split()
-    if len(parts) != 4 or parts[1] not in ("csv", "txt"):
+    await start_export(update, context, (update.message.text or "").split()[1:])
+
+async def start_export(update: Update, context: ContextTypes.DEFAULT_TYPE, args: List[str]):
+    """Проверить параметры (csv|txt D1 D2 [gz]) и запустить экспорт в фоне."""
+    if len(args) not in (3, 4) or args[0] not in ("csv", "txt") or (len(args) == 4 and args[3] != "gz"):
         await update.message.reply_text(
-            "Использование:\n<code>/export csv 2025-11-01 2025-11-10</code>\nили\n<code>/export txt 2025-11-01 2025-11-10</code>",
+            "Использование:\n<code>/export csv 2025-11-01 2025-11-10</code>\nили\n<code>/export txt 2025-11-01 2025-11-10</code>\n"
+            "Добавьте <code>gz</code> в конце, чтобы получить сжатый файл.",
             reply_markup=service_keyboard(),
             parse_mode="HTML"
         )
         return
 
-    fmt, d1, d2 = parts[1], parts[2], parts[3]
+    fmt, d1, d2 = args[0], args[1], args[2]
+    gz = len(args) == 4
     try:
         start = datetime.strptime(d1, "%Y-%m-%d")
         end = datetime.strptime(d2, "%Y-%m-%d")
@@ -357,50 +694,31 @@ async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Неверный формат дат. Нужен YYYY-MM-DD YYYY-MM-DD.", reply_markup=service_keyboard())
         return
 
-    rows = await export_requests(start_iso, end_iso)
+    # Большой отчёт готовится в фоне — хэндлер сразу освобождается
+    status_msg = await update.message.reply_text("⏳ Готовлю отчёт…")
+    context.application.create_task(
+        export_job(context.bot, status_msg, fmt, d1, d2, start_iso, end_iso, gz)
+    )
 
-    Path(FILES_DIR).mkdir(parents=True, exist_ok=True)
-    ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    if fmt == "csv":
-        filename = Path(FILES_DIR) / f"report_{d1}_{d2}_{ts}.csv"
-        headers = ["id","ticket","user_id","text","media_id","latitude","longitude","status","admin_comment","created_at","updated_at","category","urgency","department"]
-        with open(filename, "w", encoding="utf-8-sig", newline="") as f:
-            writer = csv.writer(f, delimiter=";")
-            writer.writerow(headers)
-            for r in rows:
-                writer.writerow(list(r))
-        await update.message.reply_document(document=str(filename), caption=f"CSV-отчёт за период {d1}—{d2}")
-    else:
-        filename = Path(FILES_DIR) / f"report_{d1}_{d2}_{ts}.txt"
-        by_status = {}
-        for r in rows:
-            by_status[r[7]] = by_status.get(r[7], 0) + 1
-        total = len(rows)
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(f"Отчёт по обращениям за период {d1}—{d2}\n")
-            f.write(f"Всего обращений: {total}\n")
-            f.write("По статусам:\n")
-            for st, cnt in by_status.items():
-                f.write(f"  - {st}: {cnt}\n")
-            f.write("\nСписок обращений:\n")
-            for r in rows:
-                _id,ticket,uid,text,media,lat,lon,status,comment,created,updated,category,urgency,department = r
-                f.write(f"\n[{ticket}] {created} — {status}\n")
-                f.write(f"Автор: {uid}\n")
-                if category:
-                    f.write(f"Категория: {category}\n")
-                if department:
-                    f.write(f"Отдел: {department}\n")
-                if urgency:
-                    f.write(f"Экстренность: да\n")
-                if lat is not None and lon is not None:
-                    f.write(f"Координаты: {lat:.6f}, {lon:.6f}\n")
-                if media:
-                    f.write(f"Медиа (file_id): {media}\n")
-                if comment:
-                    f.write(f"Комментарий админа: {comment}\n")
-                f.write(f"Текст: {text}\n")
-        await update.message.reply_document(document=str(filename), caption=f"TXT-отчёт за период {d1}—{d2}")
+async def export_job(bot, status_msg, fmt, d1, d2, start_iso, end_iso, gz):
+    async def progress(done: int, total: int):
+        try:
+            await status_msg.edit_text(f"⏳ Готовлю отчёт… {done} из {total}")
+        except BadRequest:
+            pass
+
+    try:
+        filename = await run_export(fmt, d1, d2, start_iso, end_iso, gz=gz, progress=progress)
+    except Exception as e:
+        log.exception("Экспорт не удался")
+        await status_msg.edit_text(f"Не удалось сформировать отчёт: {esc(e)}")
+        return
+    caption = f"{fmt.upper()}-отчёт за период {d1}—{d2}"
+    await bot.send_document(chat_id=status_msg.chat_id, document=str(filename), caption=caption)
+    try:
+        await status_msg.edit_text("✅ Отчёт готов.")
+    except BadRequest:
+        pass
 
 # ---- CLEANUP ----
 async def cleanup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -408,8 +726,7 @@ async def cleanup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эта команда доступна только в личном чате.")
         return
     user = update.effective_user
-    admins = await list_admins()
-    if user.id not in admins:
+    if not is_admin_user(user.id):
         await update.message.reply_text("Доступ запрещён.")
         return
 
@@ -419,18 +736,22 @@ async def cleanup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Использование:\n"
             "/cleanup active\n"
             "/cleanup all\n"
-            "/cleanup before 2025-10-01",
+            "/cleanup before 2025-10-01\n\n"
+            "Удаление безвозвратно. Чтобы сохранить историю закрытых заявок, используйте /archive.",
             reply_markup=danger_keyboard()
         )
         return
 
     sub = parts[1]
+    chat_id = update.effective_chat.id
     if sub == "active":
-        n = await cleanup_active_requests()
-        await update.message.reply_text(f"Удалено активных заявок: {n}", reply_markup=service_keyboard())
+        await start_bulk(context, chat_id, "Удаляю активные заявки",
+                         lambda progress: bulk.cleanup("active", progress=progress, actor_id=update.effective_user.id),
+                         "Удалено активных заявок")
     elif sub == "all":
-        n = await cleanup_all_requests()
-        await update.message.reply_text(f"Полностью очищено заявок: {n}", reply_markup=service_keyboard())
+        await start_bulk(context, chat_id, "Удаляю все заявки",
+                         lambda progress: bulk.cleanup("all", progress=progress, actor_id=update.effective_user.id),
+                         "Полностью очищено заявок")
     elif sub == "before":
         if len(parts) != 3:
             await update.message.reply_text("Укажите дату: /cleanup before YYYY-MM-DD", reply_markup=danger_keyboard())
@@ -440,22 +761,209 @@ async def cleanup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except ValueError:
             await update.message.reply_text("Неверный формат даты. Нужен YYYY-MM-DD", reply_markup=danger_keyboard())
             return
-        n = await cleanup_before(parts[2])
-        await update.message.reply_text(f"Удалено заявок до {parts[2]}: {n}", reply_markup=service_keyboard())
+        await start_bulk(context, chat_id, f"Удаляю заявки до {parts[2]}",
+                         lambda progress: bulk.cleanup("before", parts[2], progress, update.effective_user.id),
+                         f"Удалено заявок до {parts[2]}")
     else:
         await update.message.reply_text("Неизвестный параметр. active | all | before YYYY-MM-DD", reply_markup=danger_keyboard())
 
+async def start_bulk(context: ContextTypes.DEFAULT_TYPE, chat_id: int, title: str, run, done: str, status_msg=None):
+    """
+    Запустить массовую операцию (bulk.py) в фоне: run(progress) -> число заявок.
+    Прогресс — правкой status_msg (или нового сообщения), итог — «done: N».
+    """
+    if bulk.busy():
+        await context.bot.send_message(chat_id=chat_id, text="Уже идёт другая массовая операция — дождитесь её окончания.")
+        return
+    if status_msg is not None:
+        try:
+            await status_msg.edit_text(f"⏳ {title}…")
+        except BadRequest:
+            status_msg = None
+    if status_msg is None:
+        status_msg = await context.bot.send_message(chat_id=chat_id, text=f"⏳ {title}…")
+    context.application.create_task(bulk_job(status_msg, title, run, done))
+
+async def bulk_job(status_msg, title: str, run, done: str):
+    async def progress(n: int, total: int):
+        try:
+            await status_msg.edit_text(f"⏳ {title}… {n} из {total}")
+        except BadRequest:
+            pass
+
+    try:
+        n = await run(progress)
+    except Exception as e:
+        log.exception("Массовая операция не удалась: %s", title)
+        await status_msg.edit_text(f"Операция прервана: {esc(e)}")
+        return
+    await status_msg.edit_text(f"✅ {done}: {n}")
+
+# ---- ARCHIVE ----
+async def archive_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not private_only(update):
+        await update.message.reply_text("Эта команда доступна только в личном чате.")
+        return
+    user = update.effective_user
+    if not is_admin_user(user.id):
+        await update.message.reply_text("Доступ запрещён.")
+        return
+
+    parts = (update.message.text or "").split()
+    if len(parts) == 1:
+        months = await archive_summary()
+        lines = ["<b>Архив закрытых заявок</b>"]
+        for month, blocks, count, size in months:
+            lines.append(f"{esc(month)}: {count} заявок, {size / 1024:.0f} КБ (блоков: {blocks})")
+        if not months:
+            lines.append("Пока пуст.")
+        lines.append("\nПеренести закрытые заявки, созданные до даты: <code>/archive 2025-10-01</code>")
+        await update.message.reply_text("\n".join(lines), reply_markup=service_keyboard(), parse_mode="HTML")
+        return
+    try:
+        datetime.strptime(parts[1], "%Y-%m-%d")
+    except ValueError:
+        await update.message.reply_text("Неверный формат даты. Нужен YYYY-MM-DD", reply_markup=service_keyboard())
+        return
+
+    # перенос большой базы идёт в фоне, как экспорт
+    status_msg = await update.message.reply_text("⏳ Переношу закрытые заявки в архив…")
+    context.application.create_task(archive_job(status_msg, parts[1], user.id))
+
+async def archive_job(status_msg, date: str, actor_id: int):
+    async def progress(done: int):
+        try:
+            await status_msg.edit_text(f"⏳ Переношу закрытые заявки в архив… {done}")
+        except BadRequest:
+            pass
+
+    try:
+        n = await archive.archive_before(date, progress=progress)
+    except Exception as e:
+        log.exception("Архивация не удалась")
+        await status_msg.edit_text(f"Архивация прервана: {esc(e)}")
+        return
+    audit.record(audit.ARCHIVE, actor_id=actor_id, before=date, moved=n)
+    await status_msg.edit_text(
+        f"✅ В архив перенесено закрытых заявок до {date}: {n}.\n"
+        f"Они по-прежнему открываются по номеру, видны жителям в «Мои обращения» и попадают в экспорт, "
+        f"но не в /search."
+    )
+
 async def bulkclose_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not private_only(update):
         await update.message.reply_text("Эта команда доступна только в личном чате.")
         return
     user = update.effective_user
-    admins = await list_admins()
-    if user.id not in admins:
+    if not is_admin_user(user.id):
         await update.message.reply_text("Доступ запрещён.")
         return
-    n = await bulk_close_active_requests()
-    await update.message.reply_text(f"Закрыто активных заявок: {n}", reply_markup=service_keyboard())
+    await start_bulk(context, update.effective_chat.id, "Закрываю активные заявки",
+                     lambda progress: bulk.close_active(progress, actor_id=update.effective_user.id),
+                     "Закрыто активных заявок")
+
+# ---- SEARCH ----
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда: /search <текст>. Без текста — ждёт запрос следующим сообщением."""
+    if not private_only(update):
+        await update.message.reply_text("Эта команда доступна только в личном чате.")
+        return
+    user = update.effective_user
+    if not is_admin_user(user.id):
+        await update.message.reply_text("Доступ запрещён.")
+        return
+
+    text = (update.message.text or "").split(maxsplit=1)
+    if len(text) < 2 or not text[1].strip():
+        await ask_search(update, context)
+        return
+    await send_search(update, context, text[1].strip())
+
+# ---- HISTORY ----
+HISTORY_LIMIT = 30  # событий в сообщении: больше не влезет в лимит Telegram
+
+async def history_text(ticket: str) -> str:
+    events = await audit.history(ticket, HISTORY_LIMIT)
+    if not events:
+        return f"По заявке <code>{esc(ticket)}</code> в журнале действий записей нет."
+    lines = [f"🕓 <b>История заявки</b> <code>{esc(ticket)}</code>"]
+    for actor_id, action, details, created_at in events:
+        who = f" · {actor_id}" if actor_id else ""
+        lines.append(f"<code>{created_at[:16].replace('T', ' ')}</code> {esc(audit.describe(action, details))}{who}")
+    return "\n".join(lines)
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда: /history <тикет> — журнал действий по заявке (в том числе удалённой или архивной)."""
+    if not private_only(update):
+        await update.message.reply_text("Эта команда доступна только в личном чате.")
+        return
+    user = update.effective_user
+    if not is_admin_user(user.id):
+        await update.message.reply_text("Доступ запрещён.")
+        return
+    parts = (update.message.text or "").split()
+    if len(parts) != 2:
+        await update.message.reply_text("Использование: /history T202511101523120010100")
+        return
+    await update.message.reply_text(await history_text(parts[1].strip()), parse_mode="HTML")
+
+# ---- ОТДЕЛЫ ----
+DEPT_KEY_RE = re.compile(r"^[a-z0-9_]{1,32}$")
+DEPT_USAGE = (
+    "Добавить или изменить: <code>/dept ключ chat_id Название</code>\n"
+    "Скрыть из меню / вернуть: <code>/dept off ключ</code>, <code>/dept on ключ</code>"
+)
+
+def departments_text() -> str:
+    lines = ["<b>Отделы</b>"]
+    for key, name, chat_id, active in list_departments():
+        lines.append(
+            f"<code>{esc(key)}</code> — {esc(name)}, чат <code>{chat_id if chat_id is not None else '—'}</code>"
+            + ("" if active else " (скрыт)")
+        )
+    if len(lines) == 1:
+        lines.append("Пока нет ни одного.")
+    lines.append("")
+    lines.append(DEPT_USAGE)
+    return "\n".join(lines)
+
+async def dept_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда: /dept — отделы для «Направить в отдел»; меняются без перезапуска бота."""
+    if not private_only(update):
+        await update.message.reply_text("Эта команда доступна только в личном чате.")
+        return
+    user = update.effective_user
+    if not is_admin_user(user.id):
+        await update.message.reply_text("Доступ запрещён.")
+        return
+
+    parts = (update.message.text or "").split(maxsplit=3)
+    if len(parts) == 1:
+        await update.message.reply_text(departments_text(), parse_mode="HTML")
+        return
+    if parts[1] in ("on", "off") and len(parts) == 3:
+        key, active = parts[2], parts[1] == "on"
+        if not await set_department_active(key, active):
+            await update.message.reply_text(f"Отдел <code>{esc(key)}</code> не найден.", parse_mode="HTML")
+            return
+        audit.record(audit.DEPARTMENT, actor_id=user.id, key=key, active=active)
+        await update.message.reply_text(departments_text(), parse_mode="HTML")
+        return
+    if len(parts) < 4:
+        await update.message.reply_text(DEPT_USAGE, parse_mode="HTML")
+        return
+    key, chat, name = parts[1], parts[2], parts[3].strip()
+    if not DEPT_KEY_RE.match(key) or key in ("on", "off"):
+        await update.message.reply_text("Ключ отдела — латиница в нижнем регистре, цифры и _, до 32 символов.")
+        return
+    try:
+        chat_id = int(chat)
+    except ValueError:
+        await update.message.reply_text("chat_id — число, например -1001234567890.")
+        return
+    await upsert_department(key, name, chat_id)
+    audit.record(audit.DEPARTMENT, actor_id=user.id, key=key, name=name, chat_id=chat_id)
+    await update.message.reply_text(departments_text(), parse_mode="HTML")
 
 # ---- BROADCAST ----
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -464,8 +972,7 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Эта команда доступна только в личном чате.")
         return
     user = update.effective_user
-    admins = await list_admins()
-    if user.id not in admins:
+    if not is_admin_user(user.id):
         await update.message.reply_text("Доступ запрещён.")
         return
 
@@ -483,12 +990,31 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["broadcast_preview"] = payload
 
     kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("✅ Отправить всем", callback_data="broadcast:confirm")],
-        [InlineKeyboardButton("✖ Отмена", callback_data="broadcast:cancel")]
+        [InlineKeyboardButton("✅ Отправить всем", callback_data=pack(OP_BROADCAST_OK))],
+        [InlineKeyboardButton("✖ Отмена", callback_data=pack(OP_BROADCAST_CANCEL))]
     ])
     await update.message.reply_text(f"Предпросмотр рассылки:\n\n{esc(payload)}", reply_markup=kb, parse_mode="HTML")
 
 # ========= СОЗДАНИЕ ЗАЯВКИ =========
+def new_ticket_messages(request_id, ticket, chat_id, caption, buttons, media_id, media_kind, lat, lon, urgent):
+    """Сообщения одному админу о новой заявке (уходят по порядку); первое запоминается для правок."""
+    prio = outbox.PRIORITY_URGENT if urgent else outbox.PRIORITY_NORMAL
+    key = f"new:{ticket}:{chat_id}"
+    hook = ("notice", request_id, caption)
+    if media_id and media_kind in outbox.MEDIA_METHODS:
+        rows = [outbox.media(chat_id, media_kind, media_id, caption, key, prio, hook=hook, reply_markup=buttons)]
+    else:
+        rows = [outbox.message(chat_id, caption, key, prio, hook=hook, reply_markup=buttons)]
+    if lat is not None and lon is not None:
+        rows.append(outbox.call(chat_id, "send_location", f"{key}:loc", prio, latitude=lat, longitude=lon))
+    return rows
+
+@outbox.on_sent("notice")
+async def remember_notice(chat_id: int, msg, request_id: int, caption: str):
+    # сообщение с фото/видео/файлом правится через подпись, а не текст
+    kind = "text" if msg.text is not None else "caption"
+    await save_notice(request_id, chat_id, msg.message_id, kind, caption)
+
 async def create_ticket_and_notify(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -498,32 +1024,65 @@ async def create_ticket_and_notify(
     lat: Optional[float] = None,
     lon: Optional[float] = None,
     category: Optional[str] = None,
-    urgency: int = 0
+    urgency: int = 0,
+    thumb_id: Optional[str] = None
 ):
     user = update.effective_user
     ticket = gen_ticket()
 
-    # Автодетекция экстренности по ключевым словам (теперь без авто-роутинга)
+    # Автодетекция экстренности по ключевым словам (теперь без авто-роутинга).
+    # Берём категорию с наибольшим числом совпадений.
     if not category:
-        low_text = (text or '').lower()
-        for kw, cat in URGENT_KEYWORDS.items():
-            if kw in low_text:
-                category = cat
-                urgency = 1
-                break
-
-    await save_request(
-        ticket=ticket,
-        user_id=user.id,
-        text=text,
-        media_path=media_id,
-        lat=lat,
-        lon=lon,
-        category=category,
-        urgency=urgency
-    )
+        ranked = match_urgent(text)
+        if ranked:
+            category = ranked[0][0]
+            urgency = 1
 
+    # Уведомления администраторам (без авто-отправки в отделы) пишутся в outbox
+    # вместе с заявкой — автор их не ждёт. Дублю уведомления не нужны.
+    caption = f"Новая заявка {ticket} от @{user.username or user.id}\n\n{text}"
+
+    def notices(request_id: int):
+        buttons = InlineKeyboardMarkup([[InlineKeyboardButton("Открыть заявку", callback_data=pack(OP_OPEN, request_id))]])
+        return [row for admin_id in list_admins() for row in new_ticket_messages(
+            request_id, ticket, admin_id, caption, buttons, media_id, media_kind, lat, lon, urgency
+        )]
+
+    async def save(duplicate_of: Optional[int]):
+        request_id = await save_request(
+            ticket=ticket,
+            user_id=user.id,
+            text=text,
+            media_path=media_id,
+            media_kind=media_kind,
+            lat=lat,
+            lon=lon,
+            category=category,
+            urgency=urgency,
+            duplicate_of=duplicate_of,
+            thumb_id=thumb_id,
+            outbox=notices if duplicate_of is None else None
+        )
+        return request_id, ticket
+
+    # Похожая активная заявка рядом уже есть — новая становится её дублем:
+    # админам не шлём ещё одно уведомление, а обновляем счётчик на старом.
+    request_id, original = await dedup.create_or_link(text, lat, lon, save)
+    audit.record(audit.CREATED, ticket, user.id, duplicate_of=original.ticket if original else None)
+    # копия вложения скачивается в фоне — подтверждение жителю её не ждёт
+    media.submit(request_id, media_id, thumb_id)
     prefix = "🚨 " if urgency else ""
+    if original is not None:
+        await update.message.reply_text(
+            f"{prefix}🎟️ <b>Заявка принята!</b>\nВаш номер: <code>{esc(ticket)}</code>\n"
+            f"Похожая заявка <code>{esc(original.ticket)}</code> уже зарегистрирована — операторы в курсе. "
+            f"Ваше обращение добавлено к ней, о решении мы сообщим.",
+            reply_markup=(await ensure_user_and_admin(update))[1],
+            parse_mode="HTML"
+        )
+        schedule_duplicate_counter(original.request_id, urgent=bool(urgency))
+        return
+
     await update.message.reply_text(
         f"{prefix}🎟️ <b>Заявка принята!</b>\nВаш номер: <code>{esc(ticket)}</code>\n"
         f"Оператор проверит и направит в нужный отдел.",
@@ -531,26 +1090,409 @@ async def create_ticket_and_notify(
         parse_mode="HTML"
     )
 
-    # ТОЛЬКО уведомления администраторам (без авто-отправки в отделы)
-    admins = await list_admins()
-    caption = f"Новая заявка {ticket} от @{user.username or user.id}\n\n{text}"
-    buttons = InlineKeyboardMarkup([[InlineKeyboardButton("Открыть заявку", callback_data=f"open:{ticket}")]])
-    for admin_id in admins:
-        try:
-            if media_id and media_kind == "photo":
-                await context.bot.send_photo(chat_id=admin_id, photo=media_id, caption=caption, reply_markup=buttons)
-            elif media_id and media_kind == "video":
-                await context.bot.send_video(chat_id=admin_id, video=media_id, caption=caption, reply_markup=buttons)
-            elif media_id and media_kind == "document":
-                await context.bot.send_document(chat_id=admin_id, document=media_id, caption=caption, reply_markup=buttons)
-            else:
-                await context.bot.send_message(chat_id=admin_id, text=caption, reply_markup=buttons)
-            if lat is not None and lon is not None:
-                await context.bot.send_location(chat_id=admin_id, latitude=lat, longitude=lon)
-        except Exception as e:
-            log.warning("Не удалось уведомить админа %s: %s", admin_id, e)
+# ---- Дубли: счётчик похожих заявок на уведомлении об исходной ----
+# Правка откладывается на DEDUP_EDIT_DELAY: при массовом происшествии дубли
+# идут десятками, а сообщение админа правится один раз на всю пачку.
+# При остановке бота ожидающие правки не теряются: flush_duplicate_counters
+# ставит их в outbox сразу, без паузы.
+_COUNTER_TASKS: Dict[int, Tuple[asyncio.Task, bool]] = {}  # request_id -> (задача, срочная)
+_COUNTER_RUNNING: Set[asyncio.Task] = set()  # все задачи счётчика, включая уже отправляющие
+MAX_CAPTION = 1024  # лимит Telegram на подпись к медиа
+
+def counter_edit(chat_id, message_id, kind, text, buttons, key, urgent):
+    prio = outbox.PRIORITY_URGENT if urgent else outbox.PRIORITY_NORMAL
+    if kind == "caption":
+        return outbox.call(chat_id, "edit_message_caption", key, prio, message_id=message_id, caption=text, reply_markup=buttons)
+    return outbox.call(chat_id, "edit_message_text", key, prio, message_id=message_id, text=text, reply_markup=buttons)
+
+def schedule_duplicate_counter(request_id: int, urgent: bool = False):
+    if request_id not in _COUNTER_TASKS:
+        task = asyncio.create_task(update_duplicate_counter(request_id, urgent))
+        _COUNTER_TASKS[request_id] = (task, urgent)
+        _COUNTER_RUNNING.add(task)
+        task.add_done_callback(_COUNTER_RUNNING.discard)
+
+async def update_duplicate_counter(request_id: int, urgent: bool = False, delay: Optional[float] = None):
+    try:
+        await asyncio.sleep(DEDUP_EDIT_DELAY if delay is None else delay)
+        # дубли, пришедшие после этой строки, запланируют следующую правку
+        _COUNTER_TASKS.pop(request_id, None)
+        _original, count, last = await duplicate_info(request_id)
+        if not count:
+            return
+        line = f"🔁 Похожих заявок: {count} (последняя {last})"
+        buttons = InlineKeyboardMarkup([[InlineKeyboardButton("Открыть заявку", callback_data=pack(OP_OPEN, request_id))]])
+        edits = []
+        for chat_id, message_id, kind, caption in await list_notices(request_id):
+            if kind == "caption":
+                room = MAX_CAPTION - len(line) - 2
+                caption = caption if len(caption) <= room else caption[:room - 1] + "…"
+            edits.append(counter_edit(
+                chat_id, message_id, kind, f"{caption}\n\n{line}", buttons, f"dups:{request_id}:{chat_id}:{count}", urgent
+            ))
+        await outbox.send(edits)
+    except Exception as e:
+        log.warning("Не удалось обновить счётчик дублей заявки %s: %s", request_id, e)
+    finally:
+        if _COUNTER_TASKS.get(request_id, (None,))[0] is asyncio.current_task():
+            del _COUNTER_TASKS[request_id]
+
+async def flush_duplicate_counters():
+    """Ожидающие правки счётчика дублей — в outbox сейчас (перед остановкой бота)."""
+    waiting = list(_COUNTER_TASKS.items())
+    _COUNTER_TASKS.clear()
+    for task, _urgent in (v for _id, v in waiting):
+        task.cancel()
+    # уже отправляющие дописывают свою правку, пока база открыта
+    await asyncio.gather(*_COUNTER_RUNNING, return_exceptions=True)
+    for request_id, (_task, urgent) in waiting:
+        await update_duplicate_counter(request_id, urgent, delay=0)
+
+# ========= МАРШРУТЫ СООБЩЕНИЙ =========
+# Кнопки меню и режимы ожидания ввода (см. router.py). Обработчик получает
+# Incoming: роль, клавиатуру, текст и его нормализованную форму.
+ROUTER = Router()
+
+# режимы ожидания ввода
+ST_OPEN_TICKET = "open_ticket"      # админ вводит номер тикета
+ST_REPLY = "reply"                  # админ пишет разовый ответ (аргумент — тикет)
+ST_CLEANUP_DATE = "cleanup_date"    # дата для удаления «до даты»
+ST_EXPORT = "export_params"         # параметры экспорта
+ST_BROADCAST = "broadcast_text"     # текст рассылки
+ST_CREATE = "create"                # житель создаёт заявку
+ST_SEARCH = "search"                # админ вводит поисковый запрос
+
+CREATE_KEYS = ("pending_media_id", "pending_media_kind", "pending_thumb_id", "pending_lat", "pending_lon")
+
+
+# ---- режимы ожидания ввода ----
+@ROUTER.state(ST_OPEN_TICKET, admin=True)
+async def open_ticket_input(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    pop_state(context.user_data)
+    ticket = m.text.strip()
+    row = await get_request_by_ticket(ticket)
+    if not row:
+        msg = await archived_card(ticket)
+        if msg:
+            await update.message.reply_text(msg, reply_markup=admin_keyboard(), parse_mode="HTML")
+        else:
+            await update.message.reply_text(f"Заявка {ticket} не найдена.", reply_markup=admin_keyboard())
+        return
+
+    replies = await list_replies(ticket)
+    last = replies[-1] if replies else None
+    dinfo = dialog_info(ticket)
+    note, original = await card_note(row[0])
+    msg = ticket_card_for_admin(row, dialog_info=dinfo, last_reply=last, note=note)
+    buttons = admin_card_buttons(row, dinfo, update.effective_user.id, original=original)
+    await update.message.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
+
+@ROUTER.state(ST_SEARCH, admin=True)
+async def search_input(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    pop_state(context.user_data)
+    await send_search(update, context, m.text.strip())
+
+# режим разового ответа оператором (без диалога)
+@ROUTER.state(ST_REPLY, admin=True)
+async def reply_input(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    ticket = pop_state(context.user_data)
+    req = await get_request_by_ticket(ticket)
+    if not req:
+        await update.message.reply_text("Заявка не найдена.", reply_markup=m.kb)
+        return
+    _, ticket, author_id, *_ = req
+    await save_reply(ticket, update.effective_user.id, m.text, outbox=[outbox.message(
+        author_id, f"Ответ по вашей заявке {ticket}:\n\n{m.text}", key=relay_key(update)
+    )])
+    audit.record(audit.REPLY, ticket, update.effective_user.id)
+    await update.message.reply_text(f"Ответ отправлен пользователю (заявка {ticket}).", reply_markup=m.kb)
+
+# ожидание даты для опасного удаления
+@ROUTER.state(ST_CLEANUP_DATE, admin=True)
+async def cleanup_date_input(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    pop_state(context.user_data)
+    date_str = m.text.strip()
+    try:
+        datetime.strptime(date_str, "%Y-%m-%d")
+    except ValueError:
+        await update.message.reply_text("Неверный формат. Введите дату как YYYY-MM-DD.", reply_markup=danger_keyboard())
+        return
+    await update.message.reply_text("Запускаю удаление.", reply_markup=service_keyboard())
+    await start_bulk(context, update.effective_chat.id, f"Удаляю заявки до {date_str}",
+                     lambda progress: bulk.cleanup("before", date_str, progress, update.effective_user.id),
+                     f"Удалено заявок до {date_str}")
+
+# ожидание параметров экспорта
+@ROUTER.state(ST_EXPORT, admin=True)
+async def export_input(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    pop_state(context.user_data)
+    args = m.text.split()
+    if len(args) not in (3, 4) or args[0] not in ("csv", "txt"):
+        await update.message.reply_text("Формат: csv|txt YYYY-MM-DD YYYY-MM-DD [gz]", reply_markup=service_keyboard())
+        return
+    await start_export(update, context, args)
+
+# ожидание текста для рассылки
+@ROUTER.state(ST_BROADCAST, admin=True)
+async def broadcast_input(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    pop_state(context.user_data)
+    payload = m.text.strip()
+    if not payload:
+        await update.message.reply_text("Пустое сообщение. Отправьте текст для рассылки.", reply_markup=service_keyboard())
+        return
+    context.user_data["broadcast_preview"] = payload
+    kb_inline = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Отправить всем", callback_data=pack(OP_BROADCAST_OK))],
+        [InlineKeyboardButton("✖ Отмена", callback_data=pack(OP_BROADCAST_CANCEL))]
+    ])
+    await update.message.reply_text(f"Предпросмотр рассылки:\n\n{esc(payload)}", reply_markup=kb_inline, parse_mode="HTML")
+
+# ====== ПРОЦЕСС СОЗДАНИЯ ЗАЯВКИ ======
+CANCEL_WORDS = frozenset(("отмена", normalize(BTN_CANCEL)))
+
+@ROUTER.state(ST_CREATE)
+async def create_input(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    text = m.text
+    if update.message.location:
+        context.user_data["pending_lat"] = update.message.location.latitude
+        context.user_data["pending_lon"] = update.message.location.longitude
+        await update.message.reply_text(
+            "📍 Геолокация добавлена.\n"
+            "Теперь отправьте <b>текст проблемы</b> одним сообщением. "
+            "Можно приложить фото/видео с подписью.",
+            reply_markup=build_create_flow_keyboard(),
+            parse_mode="HTML"
+        )
+        return
+
+    media_id = None
+    media_kind = None
+    thumb_id = None  # миниатюра для локальной копии (см. media.py)
+    if update.message.photo:
+        media_id = update.message.photo[-1].file_id
+        media_kind = "photo"
+        if len(update.message.photo) > 1:
+            thumb_id = update.message.photo[0].file_id
+        if update.message.caption:
+            text = update.message.caption
+    elif update.message.video:
+        media_id = update.message.video.file_id
+        media_kind = "video"
+        thumb_id = update.message.video.thumbnail and update.message.video.thumbnail.file_id
+        if update.message.caption:
+            text = update.message.caption
+    elif update.message.document:
+        media_id = update.message.document.file_id
+        media_kind = "document"
+        thumb_id = update.message.document.thumbnail and update.message.document.thumbnail.file_id
+        if update.message.caption:
+            text = update.message.caption
+
+    if media_id and not text:
+        context.user_data["pending_media_id"] = media_id
+        context.user_data["pending_media_kind"] = media_kind
+        context.user_data["pending_thumb_id"] = thumb_id
+        await update.message.reply_text("📎 Медиа получено. Теперь, пожалуйста, опишите проблему <b>текстом</b>.", parse_mode="HTML")
+        return
+
+    if m.low in CANCEL_WORDS:
+        pop_state(context.user_data)
+        for key in CREATE_KEYS:
+            context.user_data.pop(key, None)
+        await update.message.reply_text("Создание заявки отменено.", reply_markup=m.kb)
+        return
+
+    if text:
+        lat = context.user_data.pop("pending_lat", None)
+        lon = context.user_data.pop("pending_lon", None)
+        if not media_id:
+            media_id = context.user_data.pop("pending_media_id", None)
+            media_kind = context.user_data.pop("pending_media_kind", None)
+            thumb_id = context.user_data.pop("pending_thumb_id", None)
+        pop_state(context.user_data)
+
+        cat = context.user_data.pop("pending_category", None)
+        urgent = 1 if context.user_data.pop("pending_urgent", 0) else 0
+        await create_ticket_and_notify(
+            update, context, text=text,
+            media_id=media_id, media_kind=media_kind, thumb_id=thumb_id,
+            lat=lat, lon=lon,
+            category=cat, urgency=urgent
+        )
+        return
+
+    await update.message.reply_text(
+        "Опишите проблему <b>текстом одним сообщением</b>. "
+        "Можно приложить фото/видео с подписью и/или отправить геолокацию.",
+        reply_markup=build_create_flow_keyboard(),
+        parse_mode="HTML"
+    )
+
+# ====== КНОПКИ ГЛАВНОГО МЕНЮ ======
+@ROUTER.button(BTN_CREATE)
+async def create_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    set_state(context.user_data, ST_CREATE)
+    context.user_data.pop("pending_category", None)
+    context.user_data.pop("pending_urgent", None)
+    kb_inline = build_category_keyboard()
+    await update.message.reply_text(
+        "<b>Шаг 1 из 3.</b>\nВыберите <b>категорию</b> проблемы (можно экстренную):",
+        reply_markup=kb_inline,
+        parse_mode="HTML"
+    )
+
+@ROUTER.button(BTN_MY)
+async def my_requests_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    page = await my_requests_page(update.effective_user.id)
+    if not page:
+        await update.message.reply_text("У вас пока нет заявок.", reply_markup=m.kb)
+        return
+    text, buttons = page
+    await update.message.reply_text(text, reply_markup=buttons, parse_mode="HTML")
+
+@ROUTER.button(BTN_HELP)
+async def help_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await update.message.reply_text(
+        "<b>Как пользоваться ботом</b>\n"
+        "1) «📝 Создать обращение» — текст одним сообщением (можно фото/видео с подписью и геолокацию).\n"
+        "2) После отправки бот пришлёт номер заявки. Оператор проверит и при необходимости свяжется с вами.\n"
+        "3) «📂 Мои обращения» — список ваших заявок со статусами и кнопкой «Подробнее».",
+        reply_markup=m.kb,
+        parse_mode="HTML"
+    )
+
+# === АДМИН-МЕНЮ ===
+@ROUTER.button(BTN_ADMIN, admin=True)
+async def admin_menu_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await update.message.reply_text("Админ-меню:", reply_markup=admin_keyboard())
+
+@ROUTER.button(BTN_ADMIN_NEW, BTN_ADMIN_NEW_OLD, admin=True)
+async def admin_new_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await send_queue(update, context, dict(QUEUE_RECENT))
+
+@ROUTER.button(BTN_ADMIN_ACTIVE, admin=True)
+async def admin_active_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await send_queue(update, context, dict(QUEUE_ACTIVE))
+
+@ROUTER.button(BTN_ADMIN_FIND, admin=True)
+async def admin_find_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    set_state(context.user_data, ST_OPEN_TICKET)
+    await update.message.reply_text("Введите номер тикета (например: <code>T202511101523120010100</code>):", reply_markup=admin_keyboard(), parse_mode="HTML")
+
+@ROUTER.button(BTN_ADMIN_SEARCH, admin=True)
+async def admin_search_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await ask_search(update, context)
+
+async def ask_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_state(context.user_data, ST_SEARCH)
+    await update.message.reply_text(
+        "Введите слова для поиска по тексту заявок, комментариям и ответам "
+        "(например: <code>течь крыша Ленина</code>):",
+        reply_markup=admin_keyboard(), parse_mode="HTML"
+    )
+
+@ROUTER.button(BTN_BACK, admin=True)
+async def back_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await update.message.reply_text("Возврат в главное меню.", reply_markup=m.kb)
+
+# --- Подменю «Сервис/Отчёты» ---
+@ROUTER.button(BTN_ADMIN_SERVICE, admin=True)
+async def service_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await update.message.reply_text("Сервис и отчётность:", reply_markup=service_keyboard())
+
+@ROUTER.button(BTN_SERVICE_BACK, admin=True)
+async def service_back_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await update.message.reply_text("Возврат в админ-меню.", reply_markup=admin_keyboard())
+
+@ROUTER.button(BTN_EXPORT, admin=True)
+async def export_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    set_state(context.user_data, ST_EXPORT)
+    await update.message.reply_text(
+        "Экспорт отчёта.\nОтправьте: <code>csv|txt YYYY-MM-DD YYYY-MM-DD [gz]</code>\nНапример: <code>csv 2025-11-01 2025-11-10</code>",
+        reply_markup=service_keyboard(),
+        parse_mode="HTML"
+    )
+
+@ROUTER.button(BTN_BROADCAST, admin=True)
+async def broadcast_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    set_state(context.user_data, ST_BROADCAST)
+    await update.message.reply_text(
+        "Массовая рассылка.\nОтправьте ТЕКСТ сообщения — будет предпросмотр и подтверждение.",
+        reply_markup=service_keyboard()
+    )
+
+@ROUTER.button(BTN_STATS, admin=True)
+async def stats_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    total, done, declined = await get_request_stats()
+    ext = await get_request_stats_ext(days=7)
+    waiting, failed = await outbox_stats()
+    await update.message.reply_text(
+        f"<b>Отчётность:</b>\n"
+        f"— Всего заявок: {total}\n"
+        f"— Завершено: {done}\n"
+        f"— Отклонено: {declined}\n"
+        + stats_details(ext)
+        + updates_details(context.application.update_processor)
+        + f"\n<b>Исходящие сообщения:</b> ждут отправки {waiting}, не доставлено {failed}\n"
+        + routes_details(ROUTER.stats()),
+        reply_markup=service_keyboard(),
+        parse_mode="HTML"
+    )
+
+@ROUTER.button(BTN_ADMIN_DANGER, admin=True)
+async def danger_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await update.message.reply_text("⚠️ Опасные операции. Будьте осторожны.", reply_markup=danger_keyboard())
+
+# --- Подменю «ОПАСНО» ---
+@ROUTER.button(BTN_CLEAN_ACTIVE, admin=True)
+async def clean_active_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    kb_inline = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Да, удалить активные", callback_data=pack(OP_CLEAN_ACTIVE))],
+        [InlineKeyboardButton("✖ Отмена", callback_data=pack(OP_DANGER_CANCEL))]
+    ])
+    await update.message.reply_text("Удалить <b>все активные</b> заявки (Новый/В обработке)?", reply_markup=kb_inline, parse_mode="HTML")
+
+@ROUTER.button(BTN_BULKCLOSE_ACTIVE, admin=True)
+async def bulkclose_active_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    kb_inline = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ Да, закрыть активные", callback_data=pack(OP_BULKCLOSE))],
+        [InlineKeyboardButton("✖ Отмена", callback_data=pack(OP_DANGER_CANCEL))]
+    ])
+    await update.message.reply_text("Перевести <b>все активные</b> заявки в статус «Завершено»?", reply_markup=kb_inline, parse_mode="HTML")
+
+@ROUTER.button(BTN_CLEAN_BEFORE, admin=True)
+async def clean_before_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    set_state(context.user_data, ST_CLEANUP_DATE)
+    await update.message.reply_text(
+        "Введите дату в формате YYYY-MM-DD (всё, что <b>строго раньше</b> этой даты, будет удалено):",
+        reply_markup=danger_keyboard(),
+        parse_mode="HTML"
+    )
+
+@ROUTER.button(BTN_DANGER_BACK, admin=True)
+async def danger_back_button(update: Update, context: ContextTypes.DEFAULT_TYPE, m: Incoming):
+    await update.message.reply_text("Возврат в «Сервис и отчёты».", reply_markup=service_keyboard())
 
 # ========= ОСНОВНОЙ ХЭНДЛЕР СООБЩЕНИЙ =========
+def relay_key(update: Update) -> str:
+    """Ключ для сообщения, вызванного входящим: повторная доставка того же обновления не продублирует его."""
+    return f"msg:{update.effective_chat.id}:{update.message.message_id}"
+
+def relay_message(update: Update, chat_id: int, text_prefix: str, caption_prefix: str):
+    """Переслать сообщение из диалога в chat_id (текст или фото/видео/документ); None — тип не поддержан."""
+    msg = update.message
+    if msg.text:
+        return outbox.message(chat_id, f"{text_prefix}{msg.text}", key=relay_key(update))
+    if msg.photo:
+        kind, fid = "photo", msg.photo[-1].file_id
+    elif msg.video:
+        kind, fid = "video", msg.video.file_id
+    elif msg.document:
+        kind, fid = "document", msg.document.file_id
+    else:
+        return None
+    return outbox.media(chat_id, kind, fid, f"{caption_prefix}{msg.caption or ''}", key=relay_key(update))
+
 async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message:
         return
@@ -561,725 +1503,467 @@ async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # ===== Сообщения АДМИНА при активном диалоге =====
     if is_admin and private_only(update):
         admin_id = update.effective_user.id
-        ticket = ACTIVE_DIALOGS_BY_ADMIN.get(admin_id)
+        ticket = dialog_for_admin(admin_id)
         if ticket:
-            req = await get_request_by_ticket(ticket)
-            if not req:
-                ACTIVE_DIALOGS_BY_ADMIN.pop(admin_id, None)
-                ACTIVE_DIALOGS_BY_TICKET.pop(ticket, None)
-            else:
-                _, t, author_id, *_ = req
-                try:
-                    if update.message.text:
-                        await context.bot.send_message(
-                            chat_id=author_id,
-                            text=f"Сообщение от оператора по заявке {t}:\n\n{update.message.text}"
-                        )
-                        await save_reply(t, admin_id, update.message.text)
-                    elif update.message.photo:
-                        fid = update.message.photo[-1].file_id
-                        cap = update.message.caption or ""
-                        await context.bot.send_photo(chat_id=author_id, photo=fid,
-                                                     caption=f"От оператора (заявка {t}):\n{cap}")
-                        if cap:
-                            await save_reply(t, admin_id, cap)
-                    elif update.message.video:
-                        fid = update.message.video.file_id
-                        cap = update.message.caption or ""
-                        await context.bot.send_video(chat_id=author_id, video=fid,
-                                                     caption=f"От оператора (заявка {t}):\n{cap}")
-                        if cap:
-                            await save_reply(t, admin_id, cap)
-                    elif update.message.document:
-                        fid = update.message.document.file_id
-                        cap = update.message.caption or ""
-                        await context.bot.send_document(chat_id=author_id, document=fid,
-                                                        caption=f"От оператора (заявка {t}):\n{cap}")
-                        if cap:
-                            await save_reply(t, admin_id, cap)
-                    else:
-                        await update.message.reply_text(
-                            "Тип сообщения не поддержан в диалоге.",
-                            reply_markup=admin_dialog_inline_keyboard(ticket)
-                        )
-                        return
-                    await update.message.reply_text(
-                        "Сообщение отправлено пользователю.",
-                        reply_markup=admin_dialog_inline_keyboard(ticket)
-                    )
-                except Exception as e:
-                    log.warning("Не удалось отправить автору: %s", e)
-                    await update.message.reply_text(
-                        "Не удалось отправить сообщение пользователю.",
-                        reply_markup=admin_dialog_inline_keyboard(ticket)
-                    )
+            # автор берётся из сессии диалога — без чтения БД на каждое сообщение
+            t, author_id = ticket, dialog_info(ticket)["user_id"]
+            touch(ticket)
+            relay = relay_message(update, author_id, f"Сообщение от оператора по заявке {t}:\n\n",
+                                  f"От оператора (заявка {t}):\n")
+            if relay is None:
+                await update.message.reply_text(
+                    "Тип сообщения не поддержан в диалоге.",
+                    reply_markup=admin_dialog_inline_keyboard(ticket)
+                )
                 return
+            # ответ оператора сохраняется вместе с сообщением автору — одной транзакцией
+            said = update.message.text or update.message.caption
+            if said:
+                await save_reply(t, admin_id, said, outbox=[relay])
+            else:
+                await outbox.send([relay])
+            await update.message.reply_text(
+                "Сообщение отправлено пользователю.",
+                reply_markup=admin_dialog_inline_keyboard(ticket)
+            )
+            return
 
     # ===== Сообщения ПОЛЬЗОВАТЕЛЯ при активном диалоге =====
     if (not is_admin) and private_only(update):
         user_id = update.effective_user.id
-        ticket = ACTIVE_DIALOGS_BY_USER.get(user_id)
+        ticket = dialog_for_user(user_id)
         if ticket:
-            info = ACTIVE_DIALOGS_BY_TICKET.get(ticket)
+            info = dialog_info(ticket)
             admin_id = info["admin_id"] if info else None
             if admin_id:
-                try:
-                    if update.message.text:
-                        await context.bot.send_message(
-                            chat_id=admin_id,
-                            text=f"Сообщение от пользователя по заявке {ticket}:\n\n{update.message.text}"
-                        )
-                    elif update.message.photo:
-                        fid = update.message.photo[-1].file_id
-                        cap = update.message.caption or ""
-                        await context.bot.send_photo(chat_id=admin_id, photo=fid,
-                                                     caption=f"От пользователя (заявка {ticket}):\n{cap}")
-                    elif update.message.video:
-                        fid = update.message.video.file_id
-                        cap = update.message.caption or ""
-                        await context.bot.send_video(chat_id=admin_id, video=fid,
-                                                     caption=f"От пользователя (заявка {ticket}):\n{cap}")
-                    elif update.message.document:
-                        fid = update.message.document.file_id
-                        cap = update.message.caption or ""
-                        await context.bot.send_document(chat_id=admin_id, document=fid,
-                                                        caption=f"От пользователя (заявка {ticket}):\n{cap}")
-                    else:
-                        await update.message.reply_text("Сообщение получено. Напишите текст или приложите файл.")
-                        return
-                    await update.message.reply_text("Сообщение отправлено оператору.")
-                except Exception as e:
-                    log.warning("Не удалось отправить админу: %s", e)
-                    await update.message.reply_text("Не удалось доставить сообщение оператору.")
+                touch(ticket)
+                relay = relay_message(update, admin_id, f"Сообщение от пользователя по заявке {ticket}:\n\n",
+                                      f"От пользователя (заявка {ticket}):\n")
+                if relay is None:
+                    await update.message.reply_text("Сообщение получено. Напишите текст или приложите файл.")
+                    return
+                await outbox.send([relay])
+                await update.message.reply_text("Сообщение отправлено оператору.")
                 return
 
     if not private_only(update):
         await update.message.reply_text("Обращения принимаются только в личном чате. Напишите мне напрямую.")
         return
 
-    text = update.message.text or ""
-    low = normalize(text)
-
-    # ожидание ввода тикета (админ)
-    if context.user_data.get("expect_ticket_to_open"):
-        context.user_data.pop("expect_ticket_to_open", None)
-        ticket = text.strip()
-        row = await get_request_by_ticket(ticket)
-        if not row:
-            await update.message.reply_text(f"Заявка {ticket} не найдена.", reply_markup=admin_keyboard() if is_admin else kb)
-            return
-
-        replies = await list_replies(ticket)
-        last = replies[-1] if replies else None
-        dialog_info = ACTIVE_DIALOGS_BY_TICKET.get(ticket)
-        msg = ticket_card_for_admin(row, dialog_info=dialog_info, last_reply=last)
-        # Кнопки управления
-        if row[7] in ("Завершено", "Отклонено"):
-            buttons = InlineKeyboardMarkup([[InlineKeyboardButton("Ответить пользователю", callback_data=f"reply:{ticket}")]])
-        else:
-            if dialog_info and dialog_info.get("admin_id") == update.effective_user.id:
-                dialog_row = [InlineKeyboardButton("Завершить диалог", callback_data=f"dialog:stop:{ticket}")]
-            elif dialog_info:
-                dialog_row = [InlineKeyboardButton("Диалог ведёт другой оператор", callback_data=f"noop:{ticket}")]
-            else:
-                dialog_row = [InlineKeyboardButton("Начать диалог", callback_data=f"dialog:start:{ticket}")]
-            buttons = InlineKeyboardMarkup([
-                dialog_row,
-                [InlineKeyboardButton("Ответить (разово)", callback_data=f"reply:{ticket}")],
-                [InlineKeyboardButton("Направить в отдел", callback_data=f"route_menu:{ticket}")],
-                [InlineKeyboardButton("Завершено", callback_data=f"status:{ticket}:Завершено"),
-                 InlineKeyboardButton("Отклонено", callback_data=f"status:{ticket}:Отклонено")]
-            ])
-        await update.message.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
-        return
-
-    # режим разового ответа оператором (без диалога)
-    if context.user_data.get("reply_to_ticket"):
-        if is_admin:
-            ticket = context.user_data.pop("reply_to_ticket")
-            req = await get_request_by_ticket(ticket)
-            if not req:
-                await update.message.reply_text("Заявка не найдена.", reply_markup=kb)
-                return
-            _, ticket, author_id, *_ = req
-            await save_reply(ticket, update.effective_user.id, text)
-            try:
-                await context.bot.send_message(chat_id=author_id, text=f"Ответ по вашей заявке {ticket}:\n\n{text}")
-            except Exception as e:
-                log.warning("Не удалось отправить ответ пользователю: %s", e)
-            await update.message.reply_text(f"Ответ отправлен пользователю (заявка {ticket}).", reply_markup=kb)
-            return
-        else:
-            context.user_data.pop("reply_to_ticket", None)
-
-    # ожидание даты для опасного удаления
-    if is_admin and context.user_data.get("expect_cleanup_date"):
-        context.user_data.pop("expect_cleanup_date", None)
-        date_str = text.strip()
-        try:
-            datetime.strptime(date_str, "%Y-%m-%d")
-        except ValueError:
-            await update.message.reply_text("Неверный формат. Введите дату как YYYY-MM-DD.", reply_markup=danger_keyboard())
-            return
-        n = await cleanup_before(date_str)
-        await update.message.reply_text(f"Удалено заявок до {date_str}: {n}", reply_markup=service_keyboard())
+    m = Incoming(is_admin, kb, update.message.text or "")
+    if await ROUTER.dispatch(update, context, m):
         return
 
-    # ожидание параметров экспорта
-    if is_admin and context.user_data.get("expect_export_params"):
-        context.user_data.pop("expect_export_params", None)
-        parts = text.split()
-        if len(parts) != 3 or parts[0] not in ("csv", "txt"):
-            await update.message.reply_text("Формат: csv|txt YYYY-MM-DD YYYY-MM-DD", reply_markup=service_keyboard())
-            return
-        fake_cmd = f"/export {parts[0]} {parts[1]} {parts[2]}"
-        update.message.text = fake_cmd
-        await export_command(update, context)
-        return
+    await update.message.reply_text(
+        "Нажмите «📝 Создать обращение» чтобы оставить заявку, "
+        "или «📂 Мои обращения» чтобы посмотреть статусы.",
+        reply_markup=kb
+    )
 
-    # ожидание текста для рассылки
-    if is_admin and context.user_data.get("expect_broadcast_text"):
-        context.user_data.pop("expect_broadcast_text", None)
-        payload = text.strip()
-        if not payload:
-            await update.message.reply_text("Пустое сообщение. Отправьте текст для рассылки.", reply_markup=service_keyboard())
-            return
-        context.user_data["broadcast_preview"] = payload
-        kb_inline = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Отправить всем", callback_data="broadcast:confirm")],
-            [InlineKeyboardButton("✖ Отмена", callback_data="broadcast:cancel")]
-        ])
-        await update.message.reply_text(f"Предпросмотр рассылки:\n\n{esc(payload)}", reply_markup=kb_inline, parse_mode="HTML")
-        return
+# ========= CALLBACK-КНОПКИ =========
+# Действия инлайн-кнопок по коду (см. callbacks.py). Заявка в аргументах —
+# её id, а в старых кнопках и кнопках диалога — тикет.
+CALLBACKS = CallbackRegistry()
+FINAL_STATUSES = ("Завершено", "Отклонено")
 
-    # ====== ПРОЦЕСС СОЗДАНИЯ ЗАЯВКИ ======
-    if context.user_data.get("awaiting_request"):
-        if update.message.location:
-            context.user_data["pending_lat"] = update.message.location.latitude
-            context.user_data["pending_lon"] = update.message.location.longitude
-            await update.message.reply_text(
-                "📍 Геолокация добавлена.\n"
-                "Теперь отправьте <b>текст проблемы</b> одним сообщением. "
-                "Можно приложить фото/видео с подписью.",
-                reply_markup=build_create_flow_keyboard(),
-                parse_mode="HTML"
-            )
-            return
+async def load_request(r: Ref):
+    return await (get_request_by_id(r) if isinstance(r, int) else get_request_by_ticket(r))
 
-        media_id = None
-        media_kind = None
-        if update.message.photo:
-            media_id = update.message.photo[-1].file_id
-            media_kind = "photo"
-            if update.message.caption:
-                text = update.message.caption
-        elif update.message.video:
-            media_id = update.message.video.file_id
-            media_kind = "video"
-            if update.message.caption:
-                text = update.message.caption
-        elif update.message.document:
-            media_id = update.message.document.file_id
-            media_kind = "document"
-            if update.message.caption:
-                text = update.message.caption
-
-        if media_id and not text:
-            context.user_data["pending_media_id"] = media_id
-            context.user_data["pending_media_kind"] = media_kind
-            await update.message.reply_text("📎 Медиа получено. Теперь, пожалуйста, опишите проблему <b>текстом</b>.", parse_mode="HTML")
-            return
+async def edit_or_send(query, context: ContextTypes.DEFAULT_TYPE, text: str, **kwargs):
+    """Заменить текст сообщения с кнопкой, а если нельзя — прислать новое."""
+    try:
+        await query.edit_message_text(text, **kwargs)
+    except BadRequest:
+        await context.bot.send_message(chat_id=query.message.chat_id, text=text, **kwargs)
 
-        if low in ("отмена", normalize(BTN_CANCEL)):
-            context.user_data.pop("awaiting_request", None)
-            context.user_data.pop("pending_media_id", None)
-            context.user_data.pop("pending_media_kind", None)
-            context.user_data.pop("pending_lat", None)
-            context.user_data.pop("pending_lon", None)
-            await update.message.reply_text("Создание заявки отменено.", reply_markup=(await ensure_user_and_admin(update))[1])
-            return
+async def show_page(query, context: ContextTypes.DEFAULT_TYPE, text: str, buttons):
+    """Перерисовать сообщение-список на месте."""
+    try:
+        await query.edit_message_text(text, reply_markup=buttons, parse_mode="HTML")
+    except BadRequest as e:
+        # «message is not modified» — страница не изменилась, это не ошибка
+        if "not modified" not in str(e).lower():
+            await context.bot.send_message(chat_id=query.message.chat_id, text=text, reply_markup=buttons, parse_mode="HTML")
 
-        if text:
-            lat = context.user_data.pop("pending_lat", None)
-            lon = context.user_data.pop("pending_lon", None)
-            media_id = media_id or context.user_data.pop("pending_media_id", None)
-            media_kind = media_kind or context.user_data.pop("pending_media_kind", None)
-            context.user_data.pop("awaiting_request", None)
-
-            cat = context.user_data.pop("pending_category", None)
-            urgent = 1 if context.user_data.pop("pending_urgent", 0) else 0
-            await create_ticket_and_notify(
-                update, context, text=text,
-                media_id=media_id, media_kind=media_kind,
-                lat=lat, lon=lon,
-                category=cat, urgency=urgent
-            )
-            return
+async def reply_in_chat(query, context: ContextTypes.DEFAULT_TYPE, text: str):
+    await context.bot.send_message(chat_id=query.message.chat_id, text=text)
 
-        await update.message.reply_text(
-            "Опишите проблему <b>текстом одним сообщением</b>. "
-            "Можно приложить фото/видео с подписью и/или отправить геолокацию.",
-            reply_markup=build_create_flow_keyboard(),
-            parse_mode="HTML"
-        )
+# --- Пользователь: открыть свою карточку заявки ---
+async def show_user_card(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref, back=None):
+    query = update.callback_query
+    buttons = None
+    if back:
+        buttons = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К списку", callback_data=pack(OP_MY_PAGE, PAGE_OLDER, *back))]])
+    row = await load_request(r)
+    if not row:
+        # «Мои обращения» показывают и архивные заявки — карточка тоже из архива
+        msg = await archived_card(r, user_id=update.effective_user.id)
+        if msg:
+            await edit_or_send(query, context, msg, reply_markup=buttons, parse_mode="HTML")
+        else:
+            await reply_in_chat(query, context, "Заявка не найдена.")
         return
-
-    # ====== ОБРАБОТКА КНОПОК ГЛАВНОГО МЕНЮ ======
-    if low == normalize(BTN_CREATE):
-        context.user_data["awaiting_request"] = True
-        context.user_data.pop("pending_category", None)
-        context.user_data.pop("pending_urgent", None)
-        kb_inline = build_category_keyboard()
-        await update.message.reply_text(
-            "<b>Шаг 1 из 3.</b>\nВыберите <b>категорию</b> проблемы (можно экстренную):",
-            reply_markup=kb_inline,
-            parse_mode="HTML"
-        )
+    # Проверим, что это его заявка
+    if row[2] != update.effective_user.id:
+        await reply_in_chat(query, context, "Это не ваша заявка.")
         return
+    replies = await list_replies(row[1])
+    last = replies[-1] if replies else None
+    await edit_or_send(query, context, ticket_card_for_user(row, last_reply=last), reply_markup=buttons, parse_mode="HTML")
 
-    if low == normalize(BTN_MY):
-        rows = await list_user_requests(update.effective_user.id)
-        if not rows:
-            await update.message.reply_text("У вас пока нет заявок.", reply_markup=kb)
-            return
-        # Покажем аккуратный список + кнопки «Подробнее»
-        for r in rows[:10]:
-            _id, ticket, _uid, rtext, _mp, _lat, _lon, status, _cmt, created, _upd, _cat, _urg, _dept = r
-            snippet = s_short(rtext, width=160, placeholder="…")
-            msg = (
-                f"<b>{esc(ticket)}</b> — {status_badge(status)}\n"
-                f"<i>{esc(created)}</i>\n"
-                f"{esc(snippet)}"
-            )
-            buttons = InlineKeyboardMarkup([[InlineKeyboardButton("📄 Подробнее", callback_data=f"openuser:{ticket}")]])
-            await update.message.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
-        await update.message.reply_text("Показаны последние заявки.", reply_markup=kb)
+@CALLBACKS.action(OP_OPEN_USER, ref)
+async def cb_open_user(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    await show_user_card(update, context, r)
+
+@CALLBACKS.action(OP_OPEN_USER_PAGED, int, int, int)
+async def cb_open_user_paged(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: int, ts: int, anchor: int):
+    await show_user_card(update, context, request_id, back=(ts, anchor))
+
+# --- Пользователь: листание «Мои обращения» ---
+@CALLBACKS.action(OP_MY_PAGE, str, int, int)
+async def cb_my_page(update: Update, context: ContextTypes.DEFAULT_TYPE, direction: str, ts: int, request_id: int):
+    query = update.callback_query
+    page = await my_requests_page(update.effective_user.id, direction, (ts, request_id))
+    if not page:
+        await edit_or_send(query, context, "У вас пока нет заявок.")
         return
+    await show_page(query, context, *page)
 
-    if low == normalize(BTN_HELP):
-        await update.message.reply_text(
-            "<b>Как пользоваться ботом</b>\n"
-            "1) «📝 Создать обращение» — текст одним сообщением (можно фото/видео с подписью и геолокацию).\n"
-            "2) После отправки бот пришлёт номер заявки. Оператор проверит и при необходимости свяжется с вами.\n"
-            "3) «📂 Мои обращения» — список ваших заявок со статусами и кнопкой «Подробнее».",
-            reply_markup=kb,
+# --- Выбор категории пользователем ---
+@CALLBACKS.action(OP_CATEGORY, str)
+async def cb_category(update: Update, context: ContextTypes.DEFAULT_TYPE, key: str):
+    query = update.callback_query
+    context.user_data["pending_category"] = key
+    context.user_data["pending_urgent"] = 1 if key.startswith("emerg_") else 0
+    try:
+        await query.edit_message_text(
+            f"Категория установлена: <b>{key}</b>\nТеперь отправьте текст проблемы одним сообщением. Можно прикрепить фото/видео и геолокацию.",
             parse_mode="HTML"
         )
+    except BadRequest:
+        await reply_in_chat(query, context, f"Категория установлена: {key}. Теперь отправьте текст проблемы одним сообщением.")
+
+# --- Меню направить в отдел (админ) ---
+# Раскладка меню (активные отделы по два в ряд) собирается один раз и
+# пересобирается, только когда список отделов изменился (departments_version)
+_ROUTE_MENU: Tuple[int, List[List[Tuple[str, str]]]] = (0, [])
+
+def route_menu_rows() -> List[List[Tuple[str, str]]]:
+    """Ряды меню отделов: [[(название, ключ), …], …]."""
+    global _ROUTE_MENU
+    if _ROUTE_MENU[0] != departments_version():
+        depts = [(name, key) for key, name, _chat, _active in list_departments(active_only=True)]
+        _ROUTE_MENU = (departments_version(), [depts[i:i + 2] for i in range(0, len(depts), 2)])
+    return _ROUTE_MENU[1]
+
+@CALLBACKS.action(OP_ROUTE_MENU, ref, admin=True)
+async def cb_route_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    query = update.callback_query
+    rows = [[InlineKeyboardButton(name, callback_data=pack(OP_ROUTE, r, key)) for name, key in row]
+            for row in route_menu_rows()]
+    rows.append([InlineKeyboardButton("Отмена", callback_data=pack(OP_NOOP, r))])
+    await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(rows))
+
+# --- Направление в отдел (админ) ---
+@CALLBACKS.action(OP_ROUTE, ref, str, admin=True)
+async def cb_route(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref, key: str):
+    query = update.callback_query
+    row = await load_request(r)
+    if not row:
+        await reply_in_chat(query, context, "Заявка не найдена.")
         return
-
-    # === АДМИН-МЕНЮ ===
-    if is_admin and low == normalize(BTN_ADMIN):
-        await update.message.reply_text("Админ-меню:", reply_markup=admin_keyboard())
-        return
-
-    if is_admin and low == normalize(BTN_ADMIN_NEW):
-        rows = await admin_recent_requests(limit=5)
-        if not rows:
-            await update.message.reply_text("Заявок пока нет.", reply_markup=admin_keyboard())
-            return
-        for ticket, uid, rtext, status, created in rows:
-            snippet = s_short(rtext, width=220, placeholder="…")
-            dial = " 🟢 Диалог" if ticket in ACTIVE_DIALOGS_BY_TICKET else ""
-            msg = f"<b>Заявка {esc(ticket)}</b>\nСТАТУС: {status_badge(status)}{dial}\nАвтор: <code>{uid}</code>\nСоздана: <code>{esc(created)}</code>\n\n{esc(snippet)}"
-            buttons = InlineKeyboardMarkup([[InlineKeyboardButton("Открыть", callback_data=f"open:{ticket}")]])
-            await update.message.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
-        await update.message.reply_text("Готово.", reply_markup=admin_keyboard())
-        return
-
-    if is_admin and low == normalize(BTN_ADMIN_ACTIVE):
-        rows = await admin_active_requests(limit=20)
-        if not rows:
-            await update.message.reply_text("Активных заявок нет.", reply_markup=admin_keyboard())
-            return
-        for ticket, uid, rtext, status, created in rows:
-            snippet = s_short(rtext, width=220, placeholder="…")
-            dial = " 🟢 Диалог" if ticket in ACTIVE_DIALOGS_BY_TICKET else ""
-            msg = f"<b>Заявка {esc(ticket)}</b>\nСТАТУС: {status_badge(status)}{dial}\nАвтор: <code>{uid}</code>\nСоздана: <code>{esc(created)}</code>\n\n{esc(snippet)}"
-            buttons = InlineKeyboardMarkup([[InlineKeyboardButton("Открыть", callback_data=f"open:{ticket}")]])
-            await update.message.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
-        await update.message.reply_text("Готово.", reply_markup=admin_keyboard())
+    request_id, ticket, author_id, text, media_id, lat, lon, *_ = row
+    dept = get_department(key)
+    if not dept:
+        await reply_in_chat(query, context, "Отдел не найден.")
         return
-
-    if is_admin and low == normalize(BTN_ADMIN_FIND):
-        context.user_data["expect_ticket_to_open"] = True
-        await update.message.reply_text("Введите номер тикета (например: <code>T20251110152312001</code>):", reply_markup=admin_keyboard(), parse_mode="HTML")
+    _key, name, chat_id, _active = dept
+    messages = []
+    if chat_id:
+        route_key = f"route:{ticket}:{key}:{query.id}"
+        # сначала текст, потом вложение: если вложение не отправится,
+        # текст заявки отдел всё равно получит
+        messages.append(outbox.message(chat_id, f"Заявка {ticket} ({name})\n\n{text}", route_key))
+        if media_id:
+            # вид не записан только у заявок до _m018 — тогда фото, как раньше
+            kind = await get_media_kind(request_id) or "photo"
+            messages.append(outbox.media(chat_id, kind, media_id, f"Заявка {ticket}", f"{route_key}:media"))
+        if lat is not None and lon is not None:
+            messages.append(outbox.call(chat_id, "send_location", f"{route_key}:loc", latitude=lat, longitude=lon))
+    await assign_department(ticket, key, outbox=messages)
+    audit.record(audit.ROUTE, ticket, update.effective_user.id, dept=key)
+    await edit_or_send(query, context, f"Заявка {ticket} направлена в отдел: {name}")
+
+# --- Рассылка: подтверждение/отмена ---
+@CALLBACKS.action(OP_BROADCAST_OK, admin=True)
+async def cb_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    payload = context.user_data.get("broadcast_preview")
+    if not payload:
+        await reply_in_chat(query, context, "Нет текста для рассылки.")
         return
+    context.user_data.pop("broadcast_preview", None)
+    # Рассылка идёт в фоне, это сообщение превращается в индикатор прогресса
+    try:
+        await query.edit_message_text("📣 Рассылка запускается…")
+        progress = query.message
+    except BadRequest:
+        progress = await context.bot.send_message(chat_id=query.message.chat_id, text="📣 Рассылка запускается…")
+    await start_broadcast(context.bot, update.effective_user.id, progress.chat_id, progress.message_id, payload)
+    audit.record(audit.BROADCAST, actor_id=update.effective_user.id, chars=len(payload))
+
+@CALLBACKS.action(OP_BROADCAST_STOP, int, admin=True)
+async def cb_broadcast_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, job_id: int):
+    if not cancel_broadcast(job_id):
+        await reply_in_chat(update.callback_query, context, "Рассылка уже завершена.")
+
+@CALLBACKS.action(OP_BROADCAST_CANCEL, admin=True)
+async def cb_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop("broadcast_preview", None)
+    await edit_or_send(update.callback_query, context, "Рассылка отменена.")
+
+# --- Опасные операции: подтверждения ---
+@CALLBACKS.action(OP_CLEAN_ACTIVE, admin=True)
+async def cb_clean_active(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await start_bulk(context, query.message.chat_id, "Удаляю активные заявки",
+                     lambda progress: bulk.cleanup("active", progress=progress, actor_id=update.effective_user.id),
+                     "Удалено активных заявок",
+                     status_msg=query.message)
 
-    # --- Подменю «Сервис/Отчёты» ---
-    if is_admin and low == normalize(BTN_ADMIN_SERVICE):
-        await update.message.reply_text("Сервис и отчётность:", reply_markup=service_keyboard())
-        return
+@CALLBACKS.action(OP_BULKCLOSE, admin=True)
+async def cb_bulkclose(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await start_bulk(context, query.message.chat_id, "Закрываю активные заявки",
+                     lambda progress: bulk.close_active(progress, actor_id=update.effective_user.id),
+                     "Закрыто активных заявок",
+                     status_msg=query.message)
 
-    if is_admin and low == normalize(BTN_SERVICE_BACK):
-        await update.message.reply_text("Возврат в админ-меню.", reply_markup=admin_keyboard())
-        return
+@CALLBACKS.action(OP_DANGER_CANCEL, admin=True)
+async def cb_danger_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await edit_or_send(update.callback_query, context, "Операция отменена.")
 
-    if is_admin and low == normalize(BTN_EXPORT):
-        context.user_data["expect_export_params"] = True
-        await update.message.reply_text(
-            "Экспорт отчёта.\nОтправьте: <code>csv|txt YYYY-MM-DD YYYY-MM-DD</code>\nНапример: <code>csv 2025-11-01 2025-11-10</code>",
-            reply_markup=service_keyboard(),
-            parse_mode="HTML"
-        )
+# --- Открыть карточку заявки (админ) ---
+async def show_admin_card(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref, back=None):
+    query = update.callback_query
+    row = await load_request(r)
+    if not row:
+        msg = await archived_card(r)
+        if not msg:
+            await reply_in_chat(query, context, "Заявка не найдена.")
+            return
+        buttons = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ К списку", callback_data=back)]]) if back else None
+        await edit_or_send(query, context, msg, reply_markup=buttons, parse_mode="HTML")
         return
 
-    if is_admin and low == normalize(BTN_BROADCAST):
-        context.user_data["expect_broadcast_text"] = True
-        await update.message.reply_text(
-            "Массовая рассылка.\nОтправьте ТЕКСТ сообщения — будет предпросмотр и подтверждение.",
-            reply_markup=service_keyboard()
-        )
-        return
+    ticket = row[1]
+    replies = await list_replies(ticket)
+    last = replies[-1] if replies else None
+    dinfo = dialog_info(ticket)
+    note, original = await card_note(row[0])
+    msg = ticket_card_for_admin(row, dialog_info=dinfo, last_reply=last, note=note)
+    buttons = admin_card_buttons(row, dinfo, update.effective_user.id, back=back, original=original)
 
-    if is_admin and low == normalize(BTN_STATS):
-        total, done, declined = await get_request_stats()
-        await update.message.reply_text(
-            f"Отчётность:\n"
-            f"— Всего заявок: {total}\n"
-            f"— Завершено: {done}\n"
-            f"— Отклонено: {declined}",
-            reply_markup=service_keyboard()
-        )
-        return
+    msg_obj = query.message
+    try:
+        if msg_obj and (msg_obj.photo or msg_obj.video or msg_obj.document):
+            await msg_obj.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
+        else:
+            await query.edit_message_text(msg, reply_markup=buttons, parse_mode="HTML")
+    except BadRequest:
+        await context.bot.send_message(chat_id=query.message.chat_id, text=msg, reply_markup=buttons, parse_mode="HTML")
 
-    if is_admin and low == normalize(BTN_ADMIN_DANGER):
-        await update.message.reply_text("⚠️ Опасные операции. Будьте осторожны.", reply_markup=danger_keyboard())
-        return
+@CALLBACKS.action(OP_OPEN, ref, admin=True)
+async def cb_open(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    await show_admin_card(update, context, r)
 
-    # --- Подменю «ОПАСНО» ---
-    if is_admin and low == normalize(BTN_CLEAN_ACTIVE):
-        kb_inline = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Да, удалить активные", callback_data="danger:clean_active:confirm")],
-            [InlineKeyboardButton("✖ Отмена", callback_data="danger:cancel")]
-        ])
-        await update.message.reply_text("Удалить <b>все активные</b> заявки (Новый/В обработке)?", reply_markup=kb_inline, parse_mode="HTML")
-        return
+@CALLBACKS.action(OP_OPEN_PAGED, int, int, int, admin=True)
+async def cb_open_paged(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: int, ts: int, anchor: int):
+    await show_admin_card(update, context, request_id, back=pack(OP_QUEUE_PAGE, PAGE_OLDER, ts, anchor))
 
-    if is_admin and low == normalize(BTN_BULKCLOSE_ACTIVE):
-        kb_inline = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ Да, закрыть активные", callback_data="danger:bulkclose_active:confirm")],
-            [InlineKeyboardButton("✖ Отмена", callback_data="danger:cancel")]
-        ])
-        await update.message.reply_text("Перевести <b>все активные</b> заявки в статус «Завершено»?", reply_markup=kb_inline, parse_mode="HTML")
-        return
+# --- Очередь заявок: листание и фильтры ---
+@CALLBACKS.action(OP_QUEUE_PAGE, str, int, int, admin=True)
+async def cb_queue_page(update: Update, context: ContextTypes.DEFAULT_TYPE, direction: str, ts: int, request_id: int):
+    text, buttons = await queue_view(queue_filter(context), direction, (ts, request_id))
+    await show_page(update.callback_query, context, text, buttons)
 
-    if is_admin and low == normalize(BTN_CLEAN_BEFORE):
-        context.user_data["expect_cleanup_date"] = True
-        await update.message.reply_text(
-            "Введите дату в формате YYYY-MM-DD (всё, что <b>строго раньше</b> этой даты, будет удалено):",
-            reply_markup=danger_keyboard(),
-            parse_mode="HTML"
-        )
+@CALLBACKS.action(OP_QUEUE_FILTER, str, admin=True)
+async def cb_queue_filter(update: Update, context: ContextTypes.DEFAULT_TYPE, field: str):
+    if field not in QUEUE_FIELDS:
         return
+    await update.callback_query.edit_message_reply_markup(reply_markup=queue_filter_keyboard(field))
 
-    if is_admin and low == normalize(BTN_DANGER_BACK):
-        await update.message.reply_text("Возврат в «Сервис и отчёты».", reply_markup=service_keyboard())
+@CALLBACKS.action(OP_QUEUE_SET, str, str, admin=True)
+async def cb_queue_set(update: Update, context: ContextTypes.DEFAULT_TYPE, field: str, code: str):
+    if field not in QUEUE_FIELDS or code not in dict(queue_options(field)):
         return
-
-    if is_admin and low == normalize(BTN_BACK):
-        await update.message.reply_text("Возврат в главное меню.", reply_markup=kb)
+    queue_filter(context)[field] = code
+    text, buttons = await queue_view(queue_filter(context))
+    await show_page(update.callback_query, context, text, buttons)
+
+# --- Поиск по тексту: листание и карточки ---
+@CALLBACKS.action(OP_SEARCH_PAGE, int, int, admin=True)
+async def cb_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, seq: int, page: int):
+    text = context.user_data.get("searches", {}).get(seq)
+    if text is None:
+        await reply_in_chat(update.callback_query, context, "Результаты поиска устарели — повторите поиск.")
         return
+    msg, buttons = await search_view(text, seq, page)
+    await show_page(update.callback_query, context, msg, buttons)
 
-    await update.message.reply_text(
-        "Нажмите «📝 Создать обращение» чтобы оставить заявку, "
-        "или «📂 Мои обращения» чтобы посмотреть статусы.",
-        reply_markup=kb
-    )
+@CALLBACKS.action(OP_OPEN_FOUND, int, int, int, admin=True)
+async def cb_open_found(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: int, seq: int, page: int):
+    await show_admin_card(update, context, request_id, back=pack(OP_SEARCH_PAGE, seq, page))
 
-# ========= CALLBACK-КНОПКИ =========
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# --- Активные заявки рядом ---
+@CALLBACKS.action(OP_NEARBY, int, int, admin=True)
+async def cb_nearby(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: int, radius: int):
     query = update.callback_query
-    if not query:
+    row = await get_request_by_id(request_id)
+    if not row or row[5] is None or row[6] is None:
+        await reply_in_chat(query, context, "У заявки нет координат.")
         return
-    try:
-        await query.answer()
-    except BadRequest:
-        pass
-
-    data = (query.data or "").strip()
-    user = update.effective_user
-
-    # --- Пользователь: открыть свою карточку заявки ---
-    if data.startswith("openuser:"):
-        ticket = data.split(":", 1)[1]
-        row = await get_request_by_ticket(ticket)
-        if not row:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Заявка не найдена.")
-            return
-        # Проверим, что это его заявка
-        if row[2] != user.id:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Это не ваша заявка.")
-            return
-        replies = await list_replies(ticket)
-        last = replies[-1] if replies else None
-        msg = ticket_card_for_user(row, last_reply=last)
-        try:
-            await query.edit_message_text(msg, parse_mode="HTML")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=msg, parse_mode="HTML")
+    text, buttons = await nearby_view(row, min(max(radius, 1), max(NEARBY_RADII)))
+    if query.message and (query.message.photo or query.message.video or query.message.document):
+        await query.message.reply_text(text, reply_markup=buttons, parse_mode="HTML")
         return
+    await show_page(query, context, text, buttons)
 
-    # --- Выбор категории пользователем ---
-    if data.startswith("cat:"):
-        key = data.split(":", 1)[1]
-        context.user_data["pending_category"] = key
-        context.user_data["pending_urgent"] = 1 if key.startswith("emerg_") else 0
-        try:
-            await query.edit_message_text(
-                f"Категория установлена: <b>{key}</b>\nТеперь отправьте текст проблемы одним сообщением. Можно прикрепить фото/видео и геолокацию.",
-                parse_mode="HTML"
-            )
-        except BadRequest:
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"Категория установлена: {key}. Теперь отправьте текст проблемы одним сообщением."
-            )
-        return
+@CALLBACKS.action(OP_OPEN_NEARBY, int, int, int, admin=True)
+async def cb_open_nearby(update: Update, context: ContextTypes.DEFAULT_TYPE, request_id: int, origin_id: int, radius: int):
+    await show_admin_card(update, context, request_id, back=pack(OP_NEARBY, origin_id, radius))
 
-    # --- Меню направить в отдел (админ) ---
-    if data.startswith("route_menu:"):
-        ticket = data.split(":", 1)[1]
-        rows = []
-        pair = []
-        for key, d in DEPARTMENTS.items():
-            name = d.get("name", key)
-            pair.append(InlineKeyboardButton(name, callback_data=f"route:{ticket}:{key}"))
-            if len(pair) == 2:
-                rows.append(pair)
-                pair = []
-        if pair:
-            rows.append(pair)
-        rows.append([InlineKeyboardButton("Отмена", callback_data=f"noop:{ticket}")])
-        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    # --- Направление в отдел (админ) ---
-    if data.startswith("route:"):
-        _, ticket, key = data.split(":", 2)
-        await assign_department(ticket, key)
-        dept = DEPARTMENTS.get(key) or {}
-        name = dept.get("name", key)
-        chat_id = dept.get("tg_chat_id")
-        row = await get_request_by_ticket(ticket)
-        if row:
-            _id, t, author_id, text, media_id, lat, lon, *_ = row
-            try:
-                if chat_id:
-                    if media_id:
-                        try:
-                            await context.bot.send_photo(chat_id=chat_id, photo=media_id, caption=f"Заявка {t} ({name})\n\n{text}")
-                        except Exception:
-                            await context.bot.send_message(chat_id=chat_id, text=f"Заявка {t} ({name})\n\n{text}")
-                    else:
-                        await context.bot.send_message(chat_id=chat_id, text=f"Заявка {t} ({name})\n\n{text}")
-                    if lat is not None and lon is not None:
-                        await context.bot.send_location(chat_id=chat_id, latitude=lat, longitude=lon)
-            except Exception as e:
-                log.warning("Не удалось отправить в отдел %s: %s", key, e)
-        try:
-            await query.edit_message_text(f"Заявка {ticket} направлена в отдел: {name}")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Заявка {ticket} направлена в отдел: {name}")
+# --- ДИАЛОГ: старт/стоп ---
+@CALLBACKS.action(OP_DIALOG_START, ref, admin=True)
+async def cb_dialog_start(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    query = update.callback_query
+    row = await load_request(r)
+    if not row:
+        await reply_in_chat(query, context, "Заявка не найдена.")
         return
-
-    # --- Дальше: только админам ---
-    admins = await list_admins()
-    if user.id not in admins:
-        await context.bot.send_message(chat_id=query.message.chat_id, text="Доступ запрещён.")
+    request_id, ticket, author_id, *_ = row
+    status = row[7]
+    if status in FINAL_STATUSES:
+        await reply_in_chat(query, context, "Заявка уже в финальном статусе. Диалог недоступен.")
         return
 
-    # --- Рассылка: подтверждение/отмена ---
-    if data == "broadcast:confirm":
-        payload = context.user_data.get("broadcast_preview")
-        if not payload:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Нет текста для рассылки.")
-            return
-        user_ids = await list_all_user_ids()
-        ok = 0
-        fail = 0
-        for uid in user_ids:
-            try:
-                await context.bot.send_message(chat_id=uid, text=payload)
-                ok += 1
-            except Exception:
-                fail += 1
-        context.user_data.pop("broadcast_preview", None)
-        try:
-            await query.edit_message_text(f"Рассылка завершена.\nДоставлено: {ok}\nОшибок: {fail}")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Рассылка завершена. Доставлено: {ok}, ошибок: {fail}")
-        return
+    await update_status(ticket, status="В обработке", outbox=[outbox.message(
+        author_id,
+        f"Оператор подключился к вашей заявке {ticket}. Можете отвечать прямо здесь — сообщения уйдут оператору.",
+        key=f"dialog:{ticket}:{query.id}"
+    )])
+
+    admin_id = update.effective_user.id
+    await start_dialog(ticket, admin_id, author_id)
+    if status != "В обработке":
+        audit.record(audit.STATUS, ticket, admin_id, was=status, to="В обработке")
+    audit.record(audit.DIALOG_START, ticket, admin_id)
+
+    await context.bot.send_message(
+        chat_id=query.message.chat_id,
+        text=f"Диалог по заявке {ticket} включён. Пишите сообщения — они уйдут автору.\nНажмите «Завершить диалог», когда уточнения будут собраны.",
+        reply_markup=admin_dialog_inline_keyboard(request_id)
+    )
 
-    if data == "broadcast:cancel":
-        context.user_data.pop("broadcast_preview", None)
-        try:
-            await query.edit_message_text("Рассылка отменена.")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Рассылка отменена.")
-        return
+@CALLBACKS.action(OP_DIALOG_STOP, ref, admin=True)
+async def cb_dialog_stop(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    query = update.callback_query
+    if isinstance(r, int):
+        row = await get_request_by_id(r)
+        ticket = row[1] if row else None
+    else:
+        ticket = r
+    info = dialog_info(ticket) if ticket else None
+    if info and info.get("admin_id") == update.effective_user.id:
+        await stop_dialog(ticket)
+        audit.record(audit.DIALOG_STOP, ticket, update.effective_user.id)
+        await reply_in_chat(
+            query, context,
+            f"Диалог по заявке {ticket} завершён. Можете закрыть заявку кнопками «Завершено» / «Отклонено»."
+        )
+    else:
+        await reply_in_chat(query, context, "Диалог не активен или управляется другим оператором.")
 
-    # --- Опасные операции: подтверждения ---
-    if data == "danger:clean_active:confirm":
-        n = await cleanup_active_requests()
-        try:
-            await query.edit_message_text(f"Удалено активных заявок: {n}")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Удалено активных заявок: {n}")
+# --- Поменять статус заявки ---
+@CALLBACKS.action(OP_STATUS, ref, STATUS.decode, admin=True)
+async def cb_status(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref, new_status: str):
+    query = update.callback_query
+    if new_status not in STATUS.to_code:
+        await reply_in_chat(query, context, "Некорректные данные статуса.")
         return
 
-    if data == "danger:bulkclose_active:confirm":
-        n = await bulk_close_active_requests()
-        try:
-            await query.edit_message_text(f"Закрыто активных заявок: {n}")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Закрыто активных заявок: {n}")
+    row = await load_request(r)
+    if not row:
+        await reply_in_chat(query, context, "Заявка не найдена.")
         return
-
-    if data == "danger:cancel":
-        try:
-            await query.edit_message_text("Операция отменена.")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Операция отменена.")
+    ticket = row[1]
+    current_status = row[7]
+    if current_status in FINAL_STATUSES:
+        await reply_in_chat(query, context, f"Заявка {ticket} уже в финальном статусе ({current_status}). Менять нельзя.")
         return
 
-    # --- Открыть карточку заявки (админ) ---
-    if data.startswith("open:"):
-        ticket = data.split(":", 1)[1]
-        row = await get_request_by_ticket(ticket)
-        if not row:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Заявка не найдена.")
-            return
-
-        replies = await list_replies(ticket)
-        last = replies[-1] if replies else None
-        dialog_info = ACTIVE_DIALOGS_BY_TICKET.get(ticket)
-        msg = ticket_card_for_admin(row, dialog_info=dialog_info, last_reply=last)
-
-        if row[7] in ("Завершено", "Отклонено"):
-            buttons = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Ответить пользователю", callback_data=f"reply:{ticket}")]
-            ])
-        else:
-            if dialog_info and dialog_info.get("admin_id") == update.effective_user.id:
-                dialog_row = [InlineKeyboardButton("Завершить диалог", callback_data=f"dialog:stop:{ticket}")]
-            elif dialog_info:
-                dialog_row = [InlineKeyboardButton("Диалог ведёт другой оператор", callback_data=f"noop:{ticket}")]
-            else:
-                dialog_row = [InlineKeyboardButton("Начать диалог", callback_data=f"dialog:start:{ticket}")]
-            buttons = InlineKeyboardMarkup([
-                dialog_row,
-                [InlineKeyboardButton("Ответить (разово)", callback_data=f"reply:{ticket}")],
-                [InlineKeyboardButton("Направить в отдел", callback_data=f"route_menu:{ticket}")],
-                [InlineKeyboardButton("Завершено", callback_data=f"status:{ticket}:Завершено"),
-                 InlineKeyboardButton("Отклонено", callback_data=f"status:{ticket}:Отклонено")]
-            ])
-
-        msg_obj = query.message
-        try:
-            if msg_obj and (msg_obj.photo or msg_obj.video or msg_obj.document):
-                await msg_obj.reply_text(msg, reply_markup=buttons, parse_mode="HTML")
-            else:
-                await query.edit_message_text(msg, reply_markup=buttons, parse_mode="HTML")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=msg, reply_markup=buttons, parse_mode="HTML")
+    # уведомление автору — в той же транзакции, что и смена статуса
+    await update_status(ticket, status=new_status, outbox=[outbox.message(
+        row[2], f"Статус вашей заявки {ticket} изменён: {new_status}", key=f"status:{ticket}:{new_status}"
+    )])
+    audit.record(audit.STATUS, ticket, update.effective_user.id, was=current_status, to=new_status)
+
+    # Финальный статус исходной заявки получают и её дубли
+    same = []
+    if new_status in FINAL_STATUSES:
+        dedup.forget(row[0])
+        same = await close_duplicates(row[0], new_status, outbox=lambda dups: [outbox.message(
+            dup_user, f"Статус вашей заявки {dup_ticket} изменён: {new_status} (вместе с {ticket})",
+            key=f"status:{dup_ticket}:{new_status}"
+        ) for dup_ticket, dup_user in dups])
+        for dup_ticket, _dup_user in same:
+            audit.record(audit.STATUS, dup_ticket, update.effective_user.id, to=new_status, original=ticket)
+
+    tail = f" (и похожих: {len(same)})" if same else ""
+    await edit_or_send(query, context, f"Статус заявки {ticket} изменён на: {new_status}{tail}")
+
+# --- Разовый ответ ---
+@CALLBACKS.action(OP_REPLY, ref, admin=True)
+async def cb_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    query = update.callback_query
+    row = await load_request(r)
+    if not row:
+        await reply_in_chat(query, context, "Заявка не найдена.")
         return
+    ticket = row[1]
+    set_state(context.user_data, ST_REPLY, ticket)
+    await edit_or_send(query, context, f"Введите текст ответа для заявки {ticket} (разовый).")
 
-    # --- ДИАЛОГ: старт/стоп ---
-    if data.startswith("dialog:start:"):
-        ticket = data.split(":", 2)[2]
-        row = await get_request_by_ticket(ticket)
-        if not row:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Заявка не найдена.")
-            return
-        _id, t, author_id, *_ = row
-        status = row[7]
-        if status in ("Завершено", "Отклонено"):
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Заявка уже в финальном статусе. Диалог недоступен.")
-            return
-
-        await update_status(ticket, status="В обработке")
-
-        admin_id = update.effective_user.id
-        ACTIVE_DIALOGS_BY_TICKET[ticket] = {"admin_id": admin_id, "user_id": author_id}
-        ACTIVE_DIALOGS_BY_ADMIN[admin_id] = ticket
-        ACTIVE_DIALOGS_BY_USER[author_id] = ticket
-
-        await context.bot.send_message(
-            chat_id=query.message.chat_id,
-            text=f"Диалог по заявке {ticket} включён. Пишите сообщения — они уйдут автору.\nНажмите «Завершить диалог», когда уточнения будут собраны.",
-            reply_markup=admin_dialog_inline_keyboard(ticket)
-        )
-        try:
-            await context.bot.send_message(
-                chat_id=author_id,
-                text=f"Оператор подключился к вашей заявке {ticket}. Можете отвечать прямо здесь — сообщения уйдут оператору."
-            )
-        except Exception as e:
-            log.warning("Не удалось уведомить пользователя о старте диалога: %s", e)
-        return
-
-    if data.startswith("dialog:stop:"):
-        ticket = data.split(":", 2)[2]
-        info = ACTIVE_DIALOGS_BY_TICKET.get(ticket)
-        if info and info.get("admin_id") == update.effective_user.id:
-            admin_id = info["admin_id"]
-            user_id = info["user_id"]
-            ACTIVE_DIALOGS_BY_TICKET.pop(ticket, None)
-            if ACTIVE_DIALOGS_BY_ADMIN.get(admin_id) == ticket:
-                ACTIVE_DIALOGS_BY_ADMIN.pop(admin_id, None)
-            if ACTIVE_DIALOGS_BY_USER.get(user_id) == ticket:
-                ACTIVE_DIALOGS_BY_USER.pop(user_id, None)
-            await context.bot.send_message(
-                chat_id=query.message.chat_id,
-                text=f"Диалог по заявке {ticket} завершён. Можете закрыть заявку кнопками «Завершено» / «Отклонено»."
-            )
-        else:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Диалог не активен или управляется другим оператором.")
+@CALLBACKS.action(OP_HISTORY, ref, admin=True)
+async def cb_history(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    query = update.callback_query
+    row = await load_request(r)
+    if not row:
+        await reply_in_chat(query, context, "Заявка не найдена.")
         return
+    await context.bot.send_message(chat_id=query.message.chat_id, text=await history_text(row[1]), parse_mode="HTML")
 
-    # --- Поменять статус заявки ---
-    if data.startswith("status:"):
-        try:
-            _, ticket, new_status = data.split(":", 2)
-        except ValueError:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Некорректные данные статуса.")
-            return
-
-        row = await get_request_by_ticket(ticket)
-        if not row:
-            await context.bot.send_message(chat_id=query.message.chat_id, text="Заявка не найдена.")
-            return
-        current_status = row[7]
-        if current_status in ("Завершено", "Отклонено"):
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Заявка {ticket} уже в финальном статусе ({current_status}). Менять нельзя.")
-            return
+@CALLBACKS.action(OP_NOOP, ref, admin=True)
+async def cb_noop(update: Update, context: ContextTypes.DEFAULT_TYPE, r: Ref):
+    pass
 
-        await update_status(ticket, status=new_status)
-
-        # Уведомим автора
-        row = await get_request_by_ticket(ticket)
-        if row:
-            _id, ticket, user_id_author, *_ = row
-            try:
-                await context.bot.send_message(chat_id=user_id_author, text=f"Статус вашей заявки {ticket} изменён: {new_status}")
-            except Exception as e:
-                log.warning("Не удалось уведомить автора о статусе: %s", e)
-
-        try:
-            await query.edit_message_text(f"Статус заявки {ticket} изменён на: {new_status}")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Статус заявки {ticket} изменён на: {new_status}")
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if not query:
+        return
+    found = CALLBACKS.decode((query.data or "").strip())
+    try:
+        await query.answer(None if found else "Кнопка устарела. Откройте меню заново.")
+    except BadRequest:
+        pass
+    if not found:
         return
 
-    # --- Разовый ответ ---
-    if data.startswith("reply:"):
-        ticket = data.split(":", 1)[1]
-        context.user_data["reply_to_ticket"] = ticket
-        try:
-            await query.edit_message_text(f"Введите текст ответа для заявки {ticket} (разовый).")
-        except BadRequest:
-            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Введите текст ответа для заявки {ticket} (разовый).")
+    action, args = found
+    if action.admin and not is_admin_user(update.effective_user.id):
+        await reply_in_chat(query, context, "Доступ запрещён.")
         return
+    await action.handler(update, context, *args)
 
 # ========= ERROR HANDLER =========
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1287,7 +1971,23 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
 
 # ========= STARTUP =========
 async def on_startup(app):
+    await open_db()
     await init_db()
+    await load_admins()
+    await load_departments()
+    # отправляет один процесс — так сохраняется порядок сообщений в чате
+    await outbox.start_outbox(app.bot, dispatch=IS_PRIMARY)
+    await audit.start_audit()
+    await load_dialogs()
+    await start_dialog_sweeper()
+    # индекс дублей; с несколькими воркерами — подтягивать их заявки
+    await dedup.start_dedup(follow_others=BOT_MODE == "worker" and WORKERS_TOTAL > 1)
+    # недокачанные вложения прошлых запусков подбирает один процесс
+    await media.start_media(app.bot, resume=IS_PRIMARY)
+    if IS_PRIMARY:
+        await resume_broadcasts(app.bot)
+        # архив, перенесённый до _m017, — дописать авторов в оглавление (в фоне, читает файлы)
+        app.create_task(archive.fill_index())
     Path(FILES_DIR).mkdir(parents=True, exist_ok=True)
     # Подсказки команд в меню Telegram
     try:
@@ -1298,13 +1998,38 @@ async def on_startup(app):
             BotCommand("cleanup", "Очистка заявок (admin)"),
             BotCommand("bulkclose", "Закрыть активные (admin)"),
             BotCommand("broadcast", "Массовая рассылка (admin)"),
+            BotCommand("search", "Поиск по заявкам (admin)"),
+            BotCommand("archive", "Архив закрытых заявок (admin)"),
+            BotCommand("history", "История заявки (admin)"),
+            BotCommand("dept", "Отделы (admin)"),
         ])
     except Exception as e:
         log.warning("set_my_commands failed: %s", e)
     log.info("DB ready. Files dir: %s", FILES_DIR)
 
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def on_shutdown(app):
+    await stop_broadcasts()
+    await stop_dialog_sweeper()
+    await flush_duplicate_counters()
+    await dedup.stop_dedup()
+    await outbox.stop_outbox()
+    await media.stop_media()
+    # последним перед закрытием базы: выше ещё могли записаться события
+    await audit.stop_audit()
+    await close_db()
+    log.info("DB closed")
+
+def build_app():
+    # разные чаты — параллельно, один чат — по порядку (см. updates.py)
+    builder = (
+        ApplicationBuilder().token(BOT_TOKEN)
+        .base_url(TELEGRAM_BASE_URL).base_file_url(TELEGRAM_BASE_FILE_URL)
+        .concurrent_updates(KeyedUpdateProcessor())
+    )
+    if BOT_MODE != "polling":
+        # обновления подаёт webhook.py, встроенный Updater не нужен
+        builder = builder.updater(None)
+    app = builder.build()
 
     # Команды
     app.add_handler(CommandHandler("start", start_command))
@@ -1313,6 +2038,10 @@ def main():
     app.add_handler(CommandHandler("cleanup", cleanup_command))
     app.add_handler(CommandHandler("bulkclose", bulkclose_command))
     app.add_handler(CommandHandler("broadcast", broadcast_command))
+    app.add_handler(CommandHandler("search", search_command))
+    app.add_handler(CommandHandler("archive", archive_command))
+    app.add_handler(CommandHandler("history", history_command))
+    app.add_handler(CommandHandler("dept", dept_command))
 
     # Инлайн-кнопки
     app.add_handler(CallbackQueryHandler(callback_handler))
@@ -1324,7 +2053,15 @@ def main():
     app.add_error_handler(error_handler)
 
     app.post_init = on_startup
-    app.run_polling(close_loop=False)
+    app.post_shutdown = on_shutdown
+    return app
+
+def main():
+    app = build_app()
+    if BOT_MODE == "polling":
+        app.run_polling(close_loop=False)
+    else:
+        run_server(app, BOT_MODE)
 
 if __name__ == "__main__":
     main()
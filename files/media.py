@@ -0,0 +1,308 @@
+# media.py
+# Локальные копии вложений заявок. В заявке хранится только file_id Telegram:
+# если Telegram перестанет отдавать файл, доказательства пропадут. Поэтому
+# вложение каждой заявки в фоне скачивается в FILES_DIR/media — житель
+# получает подтверждение сразу, загрузку он не ждёт (submit не блокирует).
+#
+# Файлы адресуются содержимым: путь — sha256 файла, разложенный по подпапкам
+# (ab/cd/abcd….jpg), чтобы в одной папке не копились тысячи файлов. Одно и то
+# же фото из десяти заявок лежит на диске один раз. Оригинал качается потоком
+# кусками по MEDIA_CHUNK (хэш считается на лету, в памяти файл целиком не
+# держится), миниатюра — целиком через utils.save_file_bytes.
+#
+# Хэш и размер записываются в БД (media_files, requests.media_sha256). Когда
+# оригиналы занимают больше MEDIA_CACHE_MAX_BYTES, давно не открытые удаляются
+# с диска (LRU по last_used_ts), запись с хэшем и размером остаётся, миниатюры
+# не удаляются никогда.
+#
+# Очередь загрузки переживает перезапуск: нескачанные вложения — это заявки с
+# media_sha256 IS NULL (частичный индекс), их подбирает resume при старте.
+#
+# Проверка против подмены Bot API — tests/test_media.py.
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+from time import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+from uuid import uuid4
+
+import httpx
+from telegram.error import BadRequest
+
+import db
+from config import (
+    FILES_DIR, MEDIA_WORKERS, MEDIA_CACHE_MAX_BYTES, MEDIA_MAX_BYTES, MEDIA_THUMB_MAX_BYTES,
+    MEDIA_CHUNK, MEDIA_ATTEMPTS
+)
+from utils import save_file_bytes
+
+log = logging.getLogger("bot.media")
+
+MEDIA_ROOT = Path(FILES_DIR) / "media"
+PRIORITY_NEW = 0      # вложения только что созданных заявок
+PRIORITY_BACKLOG = 1  # недокачанные с прошлых запусков
+RESUME_BATCH = 100
+STALE_PART_S = 3600   # недописанные файлы старше этого — остатки упавшего процесса
+
+_SUFFIX = re.compile(r"\.[a-z0-9]{1,8}")
+
+_QUEUE: Optional[asyncio.PriorityQueue] = None
+_WORKERS: List[asyncio.Task] = []
+_CLIENT: Optional[httpx.AsyncClient] = None
+_SEQ = 0
+# файл кладётся на диск и учитывается в БД под замком — иначе вытеснение может
+# удалить файл, который соседний воркер только что снова положил
+_STORE_LOCK = asyncio.Lock()
+# sha256 -> когда открывали; в БД сбрасывается перед вытеснением, а не на каждый просмотр
+_USED: Dict[str, int] = {}
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def _reason(e: Exception) -> str:
+    """Причина сбоя для лога. В тексте ошибок httpx — адрес файла, а в нём токен бота."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return f"{type(e).__name__} {e.response.status_code}"
+    if isinstance(e, httpx.HTTPError):
+        return type(e).__name__
+    return str(e) or type(e).__name__
+
+
+def _shard(sha: str, suffix: str) -> str:
+    return f"{sha[:2]}/{sha[2:4]}/{sha}{suffix}"
+
+
+def _suffix(file_path: str) -> str:
+    suffix = Path(urlsplit(file_path).path).suffix.lower()
+    return suffix if _SUFFIX.fullmatch(suffix) else ""
+
+
+async def _chunks(src: str) -> AsyncIterator[bytes]:
+    if src.startswith(("http://", "https://")):
+        async with _CLIENT.stream("GET", src) as resp:
+            resp.raise_for_status()
+            async for chunk in resp.aiter_bytes(MEDIA_CHUNK):
+                yield chunk
+        return
+    # локальный сервер Bot API (--local) отдаёт путь к файлу на диске
+    with open(src, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, MEDIA_CHUNK):
+            yield chunk
+
+
+async def _source(bot, file_id: str, limit: int) -> str:
+    tg_file = await bot.get_file(file_id)
+    if tg_file.file_size and tg_file.file_size > limit:
+        raise MediaTooLarge(f"{tg_file.file_size} байт")
+    if not tg_file.file_path:
+        raise BadRequest("Bot API не вернул file_path")
+    return tg_file.file_path
+
+
+async def _download(bot, file_id: str) -> Tuple[Path, str, int, str]:
+    """Скачать оригинал во временный файл: (путь, sha256, размер, расширение)."""
+    src = await _source(bot, file_id, MEDIA_MAX_BYTES)
+    tmp = MEDIA_ROOT / "tmp" / f"{uuid4().hex}.part"
+    await asyncio.to_thread(tmp.parent.mkdir, parents=True, exist_ok=True)
+    digest, size = hashlib.sha256(), 0
+    f = await asyncio.to_thread(open, tmp, "wb")
+    try:
+        async for chunk in _chunks(src):
+            size += len(chunk)
+            if size > MEDIA_MAX_BYTES:
+                raise MediaTooLarge(f"больше {MEDIA_MAX_BYTES} байт")
+            digest.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        f.close()
+        tmp.unlink(missing_ok=True)
+        raise
+    await asyncio.to_thread(f.close)
+    return tmp, digest.hexdigest(), size, _suffix(src)
+
+
+async def _download_small(bot, file_id: str) -> Tuple[bytes, str]:
+    """Скачать миниатюру в память: (байты, расширение)."""
+    src = await _source(bot, file_id, MEDIA_THUMB_MAX_BYTES)
+    parts, size = [], 0
+    async for chunk in _chunks(src):
+        size += len(chunk)
+        if size > MEDIA_THUMB_MAX_BYTES:
+            raise MediaTooLarge(f"миниатюра больше {MEDIA_THUMB_MAX_BYTES} байт")
+        parts.append(chunk)
+    return b"".join(parts), _suffix(src)
+
+
+def _place(tmp: Path, rel: str):
+    dest = MEDIA_ROOT / rel
+    if dest.exists():
+        tmp.unlink()  # такой файл уже есть — содержимое то же самое
+        return
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp, dest)
+
+
+async def ingest(bot, request_id: int, file_id: str, thumb_id: Optional[str] = None):
+    """Скачать вложение заявки (и миниатюру), сохранить по хэшу, учесть в БД."""
+    tmp, sha, size, suffix = await _download(bot, file_id)
+    thumb = None
+    if thumb_id:
+        try:
+            thumb = await _download_small(bot, thumb_id)
+        except Exception as e:
+            # без миниатюры копия всё равно полезна
+            log.info("Миниатюра заявки %s не скачана: %s", request_id, _reason(e))
+    async with _STORE_LOCK:
+        original = (sha, size, _shard(sha, suffix))
+        await asyncio.to_thread(_place, tmp, original[2])
+        thumb_file = None
+        if thumb:
+            data, t_suffix = thumb
+            t_sha = hashlib.sha256(data).hexdigest()
+            thumb_file = (t_sha, len(data), _shard(t_sha, t_suffix))
+            await asyncio.to_thread(save_file_bytes, data, thumb_file[2], str(MEDIA_ROOT))
+        await db.record_media(request_id, original, thumb_file)
+        await _evict(keep=sha)
+
+
+async def _flush_used():
+    if _USED:
+        used = [(ts, sha) for sha, ts in _USED.items()]
+        _USED.clear()
+        await db.touch_media(used)
+
+
+def _unlink_all(paths: List[str]):
+    for rel in paths:
+        (MEDIA_ROOT / rel).unlink(missing_ok=True)
+
+
+async def _evict(keep: Optional[str] = None):
+    """Удалить с диска давно не нужные оригиналы, пока их больше MEDIA_CACHE_MAX_BYTES."""
+    await _flush_used()
+    usage = await db.media_usage()
+    while usage > MEDIA_CACHE_MAX_BYTES:
+        victims = []
+        for sha, size, rel in await db.list_media_lru(RESUME_BATCH):
+            if usage <= MEDIA_CACHE_MAX_BYTES:
+                break
+            if sha != keep:
+                victims.append((sha, rel))
+                usage -= size
+        if not victims:
+            break
+        # сначала БД: лучше запись «вытеснен» при живом файле, чем наоборот
+        await db.mark_media_evicted([sha for sha, _ in victims])
+        await asyncio.to_thread(_unlink_all, [rel for _, rel in victims])
+        log.info("Вытеснено вложений: %s", len(victims))
+
+
+async def local_copy(request_id: int) -> Optional[Tuple[str, int, Optional[str], Optional[str]]]:
+    """
+    Копия вложения заявки: (sha256, размер, путь к оригиналу или None, если
+    вытеснен, путь к миниатюре или None). None — копии нет (ещё не скачана).
+    Считается использованием: оригинал отодвигается в конец очереди вытеснения.
+    """
+    row = await db.get_request_media(request_id)
+    if not row:
+        return None
+    sha, size, rel, stored, thumb_rel = row
+    _USED[sha] = int(time() * 1000)
+    return (sha, size, str(MEDIA_ROOT / rel) if stored else None,
+            str(MEDIA_ROOT / thumb_rel) if thumb_rel else None)
+
+
+# ---- очередь загрузки ----
+def _put(priority: int, job: Tuple[int, str, Optional[str]]):
+    global _SEQ
+    if _QUEUE is not None:
+        _SEQ += 1
+        _QUEUE.put_nowait((priority, _SEQ, job))
+
+
+def submit(request_id: int, file_id: Optional[str], thumb_id: Optional[str] = None):
+    """Поставить вложение новой заявки в очередь на скачивание (не ждёт)."""
+    if file_id:
+        _put(PRIORITY_NEW, (request_id, file_id, thumb_id))
+
+
+async def _worker(bot):
+    while True:
+        _prio, _seq, job = await _QUEUE.get()
+        request_id = job[0]
+        try:
+            await ingest(bot, *job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # BadRequest (file_id устарел, файл больше 20 МБ) и слишком большой файл не лечатся повтором
+            final = isinstance(e, (BadRequest, MediaTooLarge))
+            log.warning("Вложение заявки %s не скачано: %s", request_id, _reason(e))
+            try:
+                attempts = await db.media_failed(request_id, MEDIA_ATTEMPTS if final else 1)
+            except Exception:
+                attempts = MEDIA_ATTEMPTS
+            if attempts < MEDIA_ATTEMPTS:
+                asyncio.get_running_loop().call_later(2 ** attempts, _put, _prio, job)
+        finally:
+            _QUEUE.task_done()
+
+
+def _clean_parts():
+    edge = time() - STALE_PART_S
+    for part in (MEDIA_ROOT / "tmp").glob("*.part"):
+        try:
+            if part.stat().st_mtime < edge:
+                part.unlink()
+        except OSError:
+            pass
+
+
+async def _resume():
+    """Подобрать вложения, не скачанные в прошлых запусках (порциями, чтобы не раздувать очередь)."""
+    await asyncio.to_thread(_clean_parts)
+    after = 0
+    while True:
+        rows = await db.list_pending_media(after, MEDIA_ATTEMPTS, RESUME_BATCH)
+        for job in rows:
+            _put(PRIORITY_BACKLOG, tuple(job))
+        if len(rows) < RESUME_BATCH:
+            return
+        after = rows[-1][0]
+        while _QUEUE.qsize() > RESUME_BATCH:
+            await asyncio.sleep(1)
+
+
+async def start_media(bot, resume: bool = True):
+    global _QUEUE, _CLIENT
+    _QUEUE = asyncio.PriorityQueue()
+    _CLIENT = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0), follow_redirects=True)
+    for _ in range(max(1, MEDIA_WORKERS)):
+        _WORKERS.append(asyncio.create_task(_worker(bot)))
+    if resume:
+        _WORKERS.append(asyncio.create_task(_resume()))
+
+
+async def stop_media():
+    """Остановить загрузку. Недокачанное продолжится при следующем запуске."""
+    global _QUEUE, _CLIENT
+    for t in _WORKERS:
+        t.cancel()
+    await asyncio.gather(*_WORKERS, return_exceptions=True)
+    _WORKERS.clear()
+    _QUEUE = None
+    try:
+        await _flush_used()
+    except Exception as e:
+        log.warning("Не удалось сохранить отметки об использовании вложений: %s", e)
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
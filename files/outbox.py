@@ -0,0 +1,231 @@
+# outbox.py
+# Исходящие сообщения в Telegram: уведомления админам о новых заявках, жителям —
+# о статусе и ответах, отделам — о направленных заявках, пересылка в диалоге
+# оператор↔житель, правки счётчика дублей.
+#
+# Раньше хэндлер отправлял их сам или клал в очередь в памяти: сбой сети —
+# предупреждение в логе и потерянное сообщение, рестарт — потерянная очередь.
+# Теперь сообщение — строка таблицы outbox, записанная той же транзакцией, что
+# и изменение, о котором оно сообщает (db.update_status(…, outbox=[…]) и т.п.).
+# Хэндлер возвращается сразу после коммита, а отправитель в фоне разбирает
+# таблицу:
+#   - одновременно не больше OUTBOX_CONCURRENCY отправок; в один чат — по одной
+#     и строго в порядке постановки (фото, потом геолокация);
+#   - срочные (экстренные заявки) — первыми, массовые — последними;
+#   - лимиты Telegram — общий ratelimit.LIMITER; RetryAfter притормаживает
+#     всех и откладывает сообщение, не тратя попытку;
+#   - сетевой сбой — повтор через OUTBOX_BACKOFF, 2×, 4×… (не больше
+#     OUTBOX_BACKOFF_MAX), после OUTBOX_ATTEMPTS попыток — «не удалось»;
+#     Forbidden/BadRequest (бот заблокирован, чат не найден) не повторяются.
+#
+# Ключ идемпотентности (key) уникален: событие, обработанное дважды (повторная
+# доставка обновления, двойное нажатие), ставит сообщение один раз. Доставка —
+# «хотя бы один раз»: если процесс упал между отправкой и отметкой в БД, после
+# рестарта сообщение уйдёт повторно.
+#
+# Хук — что сделать с отправленным сообщением (например, запомнить message_id,
+# чтобы потом его править). Хуки регистрируются по имени декоратором on_sent,
+# в БД хранятся имя и аргументы.
+#
+# Отправляет один процесс (IS_PRIMARY), остальные только пишут в таблицу —
+# иначе не сохранить порядок в чате. Отправленные строки хранятся OUTBOX_KEEP
+# секунд (ради ключей), потом удаляются.
+#
+# Проверка на подставном боте (сбои, RetryAfter, порядок, рестарт) — tests/test_outbox.py.
+
+import asyncio
+import json
+import logging
+import random
+from time import monotonic, time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telegram import InlineKeyboardMarkup, TelegramObject
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+import db
+from config import (
+    OUTBOX_ATTEMPTS, OUTBOX_BACKOFF, OUTBOX_BACKOFF_MAX, OUTBOX_CONCURRENCY, OUTBOX_KEEP, OUTBOX_POLL
+)
+from ratelimit import LIMITER
+
+log = logging.getLogger("bot.outbox")
+
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
+PURGE_EVERY = 3600.0
+MEDIA_METHODS = {"photo": "send_photo", "video": "send_video", "document": "send_document"}
+
+Hook = Callable[..., Awaitable[None]]
+_HOOKS: Dict[str, Hook] = {}
+_INFLIGHT: Dict[int, asyncio.Task] = {}  # chat_id -> текущая отправка в этот чат
+_WAKE: Optional[asyncio.Event] = None
+_LOOP: Optional[asyncio.Task] = None
+_stopping = False
+
+
+def on_sent(name: str):
+    """Декоратор: хук name(chat_id, отправленное сообщение, *аргументы из строки outbox)."""
+    def register(fn: Hook) -> Hook:
+        _HOOKS[name] = fn
+        return fn
+    return register
+
+
+# ---- построение сообщений ----
+def call(
+    chat_id: int, method: str, key: Optional[str] = None, priority: int = PRIORITY_NORMAL,
+    hook: Optional[tuple] = None, **params
+) -> db.OutboxRow:
+    """Вызов bot.<method>(chat_id=chat_id, **params) как строка outbox; hook — (имя, аргументы…)."""
+    markup = params.get("reply_markup")
+    if isinstance(markup, TelegramObject):
+        params["reply_markup"] = markup.to_dict()
+    return (
+        chat_id, method, json.dumps(params, ensure_ascii=False), key, priority,
+        json.dumps(list(hook), ensure_ascii=False) if hook else None
+    )
+
+
+def message(chat_id: int, text: str, key: Optional[str] = None, priority: int = PRIORITY_NORMAL, **params) -> db.OutboxRow:
+    return call(chat_id, "send_message", key, priority, text=text, **params)
+
+
+def media(
+    chat_id: int, kind: str, file_id: str, caption: str, key: Optional[str] = None,
+    priority: int = PRIORITY_NORMAL, **params
+) -> db.OutboxRow:
+    """Фото / видео / документ (kind) по file_id с подписью."""
+    return call(chat_id, MEDIA_METHODS[kind], key, priority, caption=caption, **{kind: file_id}, **params)
+
+
+async def send(rows: List[db.OutboxRow]):
+    """Поставить сообщения, не привязанные к другому изменению в БД."""
+    await db.enqueue_outbox(rows)
+
+
+def wake():
+    if _WAKE is not None:
+        _WAKE.set()
+
+
+# ---- отправитель ----
+def _now_ms() -> int:
+    return int(time() * 1000)
+
+
+def _backoff(attempts: int) -> float:
+    # разброс ±20%: после общего сбоя повторы не идут одной волной
+    return min(OUTBOX_BACKOFF * 2 ** attempts, OUTBOX_BACKOFF_MAX) * random.uniform(0.8, 1.2)
+
+
+async def _invoke(bot, chat_id: int, method: str, params: str):
+    kwargs = json.loads(params)
+    if isinstance(kwargs.get("reply_markup"), dict):
+        kwargs["reply_markup"] = InlineKeyboardMarkup.de_json(kwargs["reply_markup"], bot)
+    await LIMITER.acquire(chat_id)
+    return await getattr(bot, method)(chat_id=chat_id, **kwargs)
+
+
+async def _deliver(bot, outbox_id: int, chat_id: int, method: str, params: str, hook: Optional[str], attempts: int):
+    try:
+        try:
+            result = await _invoke(bot, chat_id, method, params)
+        except RetryAfter as e:
+            LIMITER.pause(e.retry_after)
+            await db.outbox_retry(outbox_id, _now_ms() + int(e.retry_after * 1000), str(e), attempt=False)
+            return
+        except (Forbidden, BadRequest) as e:
+            # правка, совпавшая с текущим текстом, — не ошибка
+            if not (isinstance(e, BadRequest) and "not modified" in str(e).lower()):
+                log.warning("Сообщение %s в чат %s не отправлено: %s", outbox_id, chat_id, e)
+                await db.outbox_failed(outbox_id, str(e)[:200])
+                return
+            result = None
+        except Exception as e:
+            if attempts + 1 >= OUTBOX_ATTEMPTS:
+                log.warning("Сообщение %s в чат %s не отправлено после %s попыток: %s", outbox_id, chat_id, attempts + 1, e)
+                await db.outbox_failed(outbox_id, str(e)[:200])
+            else:
+                await db.outbox_retry(outbox_id, _now_ms() + int(_backoff(attempts) * 1000), str(e)[:200])
+            return
+        await db.outbox_sent(outbox_id, getattr(result, "message_id", None))
+        if hook and result is not None:
+            name, *args = json.loads(hook)
+            try:
+                await _HOOKS[name](chat_id, result, *args)
+            except Exception as e:
+                log.warning("Хук %s для сообщения %s не выполнен: %s", name, outbox_id, e)
+    except Exception:
+        # сбой БД: строка остаётся в очереди и будет отправлена ещё раз
+        log.exception("Ошибка при отправке сообщения %s", outbox_id)
+    finally:
+        _INFLIGHT.pop(chat_id, None)
+        wake()
+
+
+async def _run(bot):
+    last_purge = 0.0
+    while not _stopping:
+        _WAKE.clear()
+        try:
+            free = OUTBOX_CONCURRENCY - len(_INFLIGHT)
+            if free > 0:
+                # из каждого чата приходит одно сообщение. Чаты, занятые на момент
+                # запроса, пропускаем, даже если отправка уже закончилась: выборка
+                # могла застать её сообщение неотправленным
+                busy = set(_INFLIGHT)
+                for row in await db.outbox_due(_now_ms(), free + len(busy)):
+                    chat_id = row[1]
+                    if chat_id in busy or chat_id in _INFLIGHT:
+                        continue
+                    _INFLIGHT[chat_id] = asyncio.create_task(_deliver(bot, *row))
+                    free -= 1
+                    if not free:
+                        break
+            if monotonic() - last_purge >= PURGE_EVERY:
+                last_purge = monotonic()
+                n = await db.outbox_purge(_now_ms() - OUTBOX_KEEP * 1000)
+                if n:
+                    log.info("Удалено старых исходящих сообщений: %s", n)
+        except Exception:
+            log.exception("Ошибка отправителя исходящих сообщений")
+        try:
+            await asyncio.wait_for(_WAKE.wait(), OUTBOX_POLL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start_outbox(bot, dispatch: bool = True):
+    """Будить отправителя после коммитов; dispatch — этот процесс отправляет."""
+    global _WAKE, _LOOP, _stopping
+    _stopping = False
+    _WAKE = asyncio.Event()
+    db.set_outbox_listener(wake)
+    if dispatch:
+        _LOOP = asyncio.create_task(_run(bot))
+
+
+async def stop_outbox(timeout: float = 10.0):
+    """Дождаться начатых отправок (не дольше timeout); неотправленное останется в БД до следующего запуска."""
+    global _LOOP, _stopping
+    if _LOOP:
+        # не отменяем задачу: отмена посреди запроса оставляет читателя пула
+        # на старом снимке базы, и после перезапуска отправленное ушло бы ещё раз
+        _stopping = True
+        wake()
+        await asyncio.gather(_LOOP, return_exceptions=True)
+        _LOOP = None
+    tasks = list(_INFLIGHT.values())
+    if tasks:
+        _done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    db.set_outbox_listener(lambda: None)
+    left, _failed = await db.outbox_stats()
+    if left:
+        log.info("Остановка: ждут отправки %s сообщений — уйдут после запуска", left)
+
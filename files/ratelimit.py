@@ -0,0 +1,118 @@
+# ratelimit.py
+# Ограничение скорости исходящих сообщений в Telegram.
+# Лимиты Bot API: ~30 сообщений/сек на бота, ~1 сообщение/сек в один личный
+# чат и ~20 сообщений/мин в одну группу. Превышение — ошибка RetryAfter.
+# Здесь один общий лимитер на весь процесс (LIMITER) и обёртка send_with_retry,
+# которая ждёт свою очередь, повторяет при сетевых сбоях и уважает RetryAfter.
+
+import asyncio
+from time import monotonic
+from typing import Awaitable, Callable, Dict, TypeVar
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from config import TG_GLOBAL_RATE, TG_CHAT_INTERVAL, TG_GROUP_INTERVAL
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """Классическое «ведро токенов»: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._ts = monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов (например, после RetryAfter от Telegram)."""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        # под замком — ожидающие обслуживаются по очереди
+        async with self._lock:
+            while True:
+                now = monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChatLimiter:
+    """Минимальный интервал между сообщениями в один и тот же чат."""
+
+    def __init__(self, private_interval: float, group_interval: float):
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self._next: Dict[int, float] = {}
+
+    def _prune(self, now: float):
+        # чтобы словарь не рос бесконечно — выкидываем давно «остывшие» чаты
+        self._next = {cid: t for cid, t in self._next.items() if t > now}
+
+    async def acquire(self, chat_id: int):
+        now = monotonic()
+        if len(self._next) > 10000:
+            self._prune(now)
+        interval = self.group_interval if chat_id < 0 else self.private_interval
+        slot = max(now, self._next.get(chat_id, 0.0))
+        self._next[chat_id] = slot + interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class TelegramLimiter:
+    def __init__(self, rate: float, private_interval: float, group_interval: float):
+        self.bucket = TokenBucket(rate)
+        self.chats = ChatLimiter(private_interval, group_interval)
+
+    async def acquire(self, chat_id: int):
+        await self.chats.acquire(chat_id)
+        await self.bucket.acquire()
+
+    def pause(self, seconds: float):
+        self.bucket.pause(seconds)
+
+
+LIMITER = TelegramLimiter(TG_GLOBAL_RATE, TG_CHAT_INTERVAL, TG_GROUP_INTERVAL)
+
+
+async def send_with_retry(
+    make_call: Callable[[], Awaitable[T]],
+    chat_id: int,
+    attempts: int = 5,
+    limiter: TelegramLimiter = LIMITER,
+) -> T:
+    """
+    Выполнить вызов Bot API с учётом лимитов.
+    make_call — функция без аргументов, возвращающая новую корутину
+    (например: lambda: bot.send_message(chat_id, text)).
+    Forbidden/BadRequest (бот заблокирован, чат не найден) не повторяем.
+    """
+    delay = 1.0
+    for attempt in range(1, attempts + 1):
+        await limiter.acquire(chat_id)
+        try:
+            return await make_call()
+        except (Forbidden, BadRequest):
+            raise
+        except RetryAfter as e:
+            # притормаживаем всех отправителей, а не только этот вызов
+            limiter.pause(e.retry_after)
+            if attempt == attempts:
+                raise
+        except NetworkError:
+            if attempt == attempts:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
@@ -0,0 +1,144 @@
+# router.py
+# Маршрутизация обычных (не командных) сообщений в личке.
+# Раньше handle_messages был длинной цепочкой if: на каждое сообщение
+# проверялись все флаги ожидания ввода и текст сравнивался с каждой кнопкой
+# (с повторной нормализацией констант). Теперь:
+#   - тексты кнопок нормализуются один раз при регистрации и лежат в словаре —
+#     поиск маршрута O(1), новые меню не замедляют остальные сообщения;
+#   - режим ожидания ввода (тикет, дата, параметры экспорта, текст рассылки,
+#     создание заявки) — одно поле состояния в user_data, у каждого режима
+#     свой обработчик;
+#   - у каждого маршрута копится время выполнения (см. stats()), медленные
+#     вызовы пишутся в лог.
+
+import logging
+from time import perf_counter
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import ROUTE_SLOW_LOG
+
+log = logging.getLogger("bot.router")
+
+STATE_KEY = "state"
+STATE_ARG_KEY = "state_arg"
+
+
+def normalize(text: Optional[str]) -> str:
+    return (text or "").strip().lower()
+
+
+# ---- состояние ожидания ввода ----
+def set_state(user_data: dict, name: str, arg=None):
+    """Перевести пользователя в режим ожидания ввода (предыдущий режим сбрасывается)."""
+    user_data[STATE_KEY] = name
+    if arg is None:
+        user_data.pop(STATE_ARG_KEY, None)
+    else:
+        user_data[STATE_ARG_KEY] = arg
+
+
+def get_state(user_data: dict) -> Optional[str]:
+    return user_data.get(STATE_KEY)
+
+
+def pop_state(user_data: dict):
+    """Выйти из режима ожидания; вернуть его аргумент (например, тикет)."""
+    user_data.pop(STATE_KEY, None)
+    return user_data.pop(STATE_ARG_KEY, None)
+
+
+class Incoming:
+    """То, что роутер уже знает о сообщении, — чтобы обработчики не считали заново."""
+    __slots__ = ("is_admin", "kb", "text", "low")
+
+    def __init__(self, is_admin: bool, kb, text: str):
+        self.is_admin = is_admin
+        self.kb = kb
+        self.text = text
+        self.low = normalize(text)
+
+
+Handler = Callable[..., Awaitable[None]]  # handler(update, context, m: Incoming)
+
+
+class Route:
+    __slots__ = ("name", "handler", "admin", "count", "total", "max")
+
+    def __init__(self, name: str, handler: Handler, admin: bool):
+        self.name = name
+        self.handler = handler
+        self.admin = admin
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def allowed(self, is_admin: bool) -> bool:
+        return is_admin or not self.admin
+
+
+class Router:
+    def __init__(self):
+        self._buttons: Dict[str, Route] = {}
+        self._states: Dict[str, Route] = {}
+        self._routes: List[Route] = []
+
+    def _add(self, table: Dict[str, Route], keys, name: str, handler: Handler, admin: bool):
+        route = Route(name, handler, admin)
+        for key in keys:
+            if key in table:
+                raise ValueError(f"Маршрут «{key}» уже зарегистрирован ({table[key].name})")
+            table[key] = route
+        self._routes.append(route)
+        return handler
+
+    def button(self, *texts: str, admin: bool = False):
+        """Обработчик нажатия кнопки меню (или ввода того же текста вручную)."""
+        def deco(handler: Handler) -> Handler:
+            return self._add(self._buttons, [normalize(t) for t in texts], handler.__name__, handler, admin)
+        return deco
+
+    def state(self, name: str, admin: bool = False):
+        """Обработчик режима ожидания ввода name (см. set_state)."""
+        def deco(handler: Handler) -> Handler:
+            return self._add(self._states, [name], handler.__name__, handler, admin)
+        return deco
+
+    async def _run(self, route: Route, update, context, m: Incoming):
+        started = perf_counter()
+        try:
+            await route.handler(update, context, m)
+        finally:
+            spent = perf_counter() - started
+            route.count += 1
+            route.total += spent
+            route.max = max(route.max, spent)
+            if spent >= ROUTE_SLOW_LOG:
+                log.warning("Медленный маршрут %s: %.2f с", route.name, spent)
+
+    async def dispatch(self, update, context, m: Incoming) -> bool:
+        """Найти и выполнить маршрут. False — подходящего маршрута нет."""
+        user_data = context.user_data
+        state = user_data.get(STATE_KEY)
+        if state is not None:
+            route = self._states.get(state)
+            if route is not None and route.allowed(m.is_admin):
+                await self._run(route, update, context, m)
+                return True
+            # режим неизвестен или больше не доступен (сняли права) — сбрасываем
+            pop_state(user_data)
+
+        route = self._buttons.get(m.low)
+        if route is not None and route.allowed(m.is_admin):
+            await self._run(route, update, context, m)
+            return True
+        return False
+
+    def stats(self) -> List[dict]:
+        """Время по маршрутам, самые «дорогие» — первыми."""
+        rows = [
+            {"name": r.name, "count": r.count, "total": r.total,
+             "avg": r.total / r.count, "max": r.max}
+            for r in self._routes if r.count
+        ]
+        rows.sort(key=lambda r: -r["total"])
+        return rows
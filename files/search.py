@@ -0,0 +1,127 @@
+# search.py
+# Полнотекстовый поиск операторов по заявкам (SQLite FTS5).
+#
+# Индекс requests_fts (см. db._m007_search) — одна строка на заявку: текст
+# жителя, комментарий оператора и все ответы. Его обновляют функции записи
+# db.py той же транзакцией, что и саму заявку или ответ.
+#
+# Русская морфология. Токенизатор FTS5 (unicode61) не знает окончаний, а
+# префиксные запросы ("вод"*) на большой базе медленные: FTS5 на каждый
+# запрос сливает списки документов всех слов с таким началом. Поэтому слова
+# обрезаются до основы (облегчённый стеммер — отбрасываем типичное окончание)
+# ещё при индексации (index_text), и запрос ищет точные основы: «течь на
+# улице Ленина» находит «течёт… улица Ленина».
+# «ё» приравнивается к «е», служебные слова не индексируются.
+#
+# В индексе лежат основы, поэтому фрагмент с подсветкой (highlight) строится
+# здесь же, по исходному тексту найденных заявок.
+#
+# Проверки (в том числе на базе из 50 тыс. заявок) — tests/test_search.py.
+
+import html
+import re
+from typing import Iterable, List, Optional
+
+MIN_STEM = 3  # короче основу не обрезаем: «дом», «газ», «вода» -> «вод»
+
+# окончания словоизменения по длине; пробуем от длинных к коротким
+_ENDINGS = set("""
+    иями ями ами иях ях ах ией ием иям ям ам ем ом ов ев ей ой ий ый ие ые ое ее ая яя ую юю
+    ими ыми его ого ему ому их ых ою ею ия ья ье ии еи ию ью
+    ила ыла ена или ыли ило ыло ено ены ует уют ите ейте уйте ить ыть ишь ешь ете йте
+    ет ит ыт ут ют ят ть
+    а е и о у ы ь ю я й
+""".split())
+_ENDING_LENS = sorted({len(e) for e in _ENDINGS}, reverse=True)
+_REFLEXIVE = ("ся", "сь")
+STOP_WORDS = frozenset("""
+    а в во да же и из к ко ли на не нет но о об от по с со у что как это бы то для при до за
+    я мы вы он она они оно нас вас уже или
+""".split())
+
+_WORD = re.compile(r"\w+")
+_CYRILLIC = re.compile(r"[а-я]")
+
+
+def stem(word: str) -> str:
+    """Основа слова в нижнем регистре (цифры и латиница — как есть)."""
+    w = word.lower().replace("ё", "е")
+    if not _CYRILLIC.search(w):
+        return w
+    for suffix in _REFLEXIVE:
+        if w.endswith(suffix) and len(w) - 2 >= MIN_STEM:
+            w = w[:-2]
+            break
+    for n in _ENDING_LENS:
+        if len(w) - n >= MIN_STEM and w[-n:] in _ENDINGS:
+            return w[:-n]
+    return w
+
+
+def _keep(word: str) -> bool:
+    w = word.lower()
+    return w not in STOP_WORDS and (len(w) > 1 or w.isdigit())
+
+
+def stems(text: Optional[str]) -> List[str]:
+    return [stem(w) for w in _WORD.findall(text or "") if _keep(w)]
+
+
+def index_text(text: Optional[str]) -> str:
+    """То, что попадает в индекс вместо текста: основы через пробел."""
+    return " ".join(stems(text))
+
+
+def fts_query(text: str, prefix: bool = False) -> Optional[str]:
+    """
+    Запрос оператора -> выражение FTS5 MATCH: все основы должны встретиться
+    (в любом поле). prefix=True — ещё и как начало слова (медленнее; для
+    повторной попытки, когда точных совпадений нет). None — искать нечего.
+    """
+    terms = list(dict.fromkeys(stems(text)))
+    if not terms:
+        return None
+    star = "*" if prefix else ""
+    return " ".join(f'"{t}"{star}' for t in terms)
+
+
+def highlight(text: Optional[str], query: str, prefix: bool = False, around: int = 8) -> Optional[str]:
+    """
+    HTML-фрагмент текста вокруг первого совпадения с запросом: совпавшие слова
+    жирным, по around слов слева и справа. None — совпадений в тексте нет.
+    """
+    terms = set(stems(query))
+    if not text or not terms:
+        return None
+    text = " ".join(text.split())
+    words = list(_WORD.finditer(text))
+
+    def hit(w) -> bool:
+        s = stem(w.group())
+        return s in terms or (prefix and any(s.startswith(t) for t in terms))
+
+    marks = [hit(w) for w in words]
+    if True not in marks:
+        return None
+    first = marks.index(True)
+    lo, hi = max(0, first - around), min(len(words), first + around + 1)
+    start, end = words[lo].start(), words[hi - 1].end()
+    out, pos = [], start
+    for i in range(lo, hi):
+        if marks[i]:
+            w = words[i]
+            out.append(html.escape(text[pos:w.start()], quote=False))
+            out.append(f"<b>{html.escape(w.group(), quote=False)}</b>")
+            pos = w.end()
+    out.append(html.escape(text[pos:end], quote=False))
+    return ("…" if start else "") + "".join(out) + ("…" if end < len(text) else "")
+
+
+def best_snippet(fields: Iterable, query: str, prefix: bool = False) -> Optional[str]:
+    """Фрагмент из первого поля, где есть совпадение: fields — [(подпись, текст)]."""
+    for label, text in fields:
+        frag = highlight(text, query, prefix)
+        if frag:
+            return f"{label}{frag}"
+    return None
+
@@ -0,0 +1,63 @@
+# Общие фикстуры тестов. Запуск из папки files: python -m pytest -q
+#
+# Замеры скорости помечены @pytest.mark.benchmark и по умолчанию пропускаются:
+# на общей машине CI время плавает. Запуск с ними: python -m pytest -q --benchmark
+#
+# У каждого теста своя пустая база во временной папке. Все тесты идут в одном
+# цикле событий: модули бота держат asyncio.Lock на уровне модуля, а замок
+# привязывается к циклу, в котором его впервые пришлось ждать.
+
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import db  # noqa: E402
+
+DATA = Path(__file__).parent / "data"
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="запустить и замеры скорости")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: замер скорости, только с --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="замер скорости: запуск с --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+def load_update(name: str) -> dict:
+    """Записанный JSON Update из tests/data."""
+    return json.loads((DATA / name).read_text(encoding="utf-8"))
+
+
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop, tmp_path, monkeypatch):
+    """run(coro) — выполнить корутину на свежей базе tmp_path/bot.db."""
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "bot.db"))
+
+    async def prepared(coro):
+        await db.init_db()
+        return await coro
+
+    yield lambda coro: loop.run_until_complete(prepared(coro))
+    loop.run_until_complete(db.close_db())
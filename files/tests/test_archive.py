@@ -0,0 +1,177 @@
+# Архив закрытых заявок (archive.py): что из него видят житель и оператор.
+# Замер поиска в архиве — только с --benchmark.
+
+import random
+from datetime import datetime, timezone
+from time import perf_counter
+
+import pytest
+
+import archive
+import db
+import main
+
+
+@pytest.fixture(autouse=True)
+def archive_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(archive, "ARCHIVE_DIR", tmp_path / "archive")
+
+
+async def resident_requests():
+    """Житель 1: две закрытые заявки уходят в архив, одна остаётся в базе; у жителя 2 — своя."""
+    for ticket, user_id, text in (("T1", 1, "Яма на дороге у дома"), ("T2", 2, "Не горит фонарь"),
+                                  ("T3", 1, "Течёт крыша над подъездом"), ("T4", 1, "Нет отопления")):
+        await db.save_request(ticket, user_id, text)
+    for ticket in ("T1", "T2", "T3"):
+        await db.update_status(ticket, "Завершено")
+    await db.save_reply("T3", 7, "Крышу залатали")
+    await db.update_status("T4", "В обработке")
+    return await archive.archive_before("2100-01-01")
+
+
+async def pages(user_id: int, limit: int):
+    """Все страницы «Мои обращения» подряд: [[тикет, …], …]."""
+    rows, has_older, _ = await db.list_user_requests_page(user_id, limit)
+    result = [rows]
+    while has_older:
+        rows, has_older, _ = await db.list_user_requests_page(user_id, limit, older_than=(rows[-1][5], rows[-1][0]))
+        result.append(rows)
+    return [[r[1] for r in page] for page in result], result[0]
+
+
+def test_resident_list_and_card_include_archive(run):
+    async def scenario():
+        moved = await resident_requests()
+        tickets, first = await pages(1, 2)
+        archived_id = (await db.find_archived("T3"))[1]
+        mine = await main.archived_card(archived_id, user_id=1)
+        foreign = await main.archived_card(archived_id, user_id=2)
+        text, _buttons = await main.my_requests_page(1)
+        return moved, tickets, first, mine, foreign, text
+
+    moved, tickets, first, mine, foreign, text = run(scenario())
+    assert moved == 3
+    # архивные заявки идут в общем порядке, листание переходит между базой и архивом
+    assert tickets == [["T4", "T3"], ["T1"]]
+    assert first[1][2] == "Завершено" and first[1][4] == "Течёт крыша над подъездом"
+    assert "T3" in text and "T1" in text and "T2" not in text
+    # карточка жителя из архива — только его заявка
+    assert "Заявка T3" in mine and "Крышу залатали" in mine and "Автор" not in mine
+    assert foreign is None
+
+
+def test_fill_index_for_older_archive(run):
+    async def scenario():
+        await resident_requests()
+        # так выглядит оглавление архива, перенесённого до появления автора в нём
+        async with db.write_conn() as conn:
+            await conn.execute("UPDATE archive_index SET user_id=NULL, created_at=NULL, summary=NULL")
+        before, _ = await pages(1, 10)
+        await archive.fill_index()
+        after, first = await pages(1, 10)
+        return before, after, first
+
+    before, after, first = run(scenario())
+    assert before == [["T4"]]
+    assert after == [["T4", "T3", "T1"]]
+    assert first[1][3] and first[1][4] == "Течёт крыша над подъездом"
+
+
+def test_search_states_archive_limit(run):
+    async def scenario():
+        await resident_requests()
+        archived, _ = await main.search_view("крыша", 1)
+        live, _ = await main.search_view("отопление", 2)
+        return archived, live
+
+    archived, live = run(scenario())
+    assert "Ничего не найдено" in archived
+    assert main.SEARCH_ARCHIVE_NOTE in archived
+    assert "T4" in live and main.SEARCH_ARCHIVE_NOTE in live
+
+
+def year_of_requests(n: int):
+    """n заявок за 2024 год, часть закрыта; ответ — на каждую третью."""
+    rnd = random.Random(2)
+    words = ["течёт", "вода", "подъезд", "лифт", "свет", "двор", "яма", "дорога", "мусор", "отопление"]
+    day = 86_400_000
+    base = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+    rows = []
+    for i in range(n):
+        ts = base + i * (365 * day // n)
+        created = datetime.fromtimestamp(ts / 1000, timezone.utc).replace(tzinfo=None).isoformat()
+        rows.append((f"T{i:08d}", i % 3000, " ".join(rnd.choices(words, k=20)),
+                     rnd.choice(["Завершено", "Отклонено", "Новый"]), created, created, ts))
+    return rnd, rows
+
+
+async def insert(rows):
+    async with db.write_conn() as conn:
+        await conn.executemany(
+            "INSERT INTO requests(ticket, user_id, text, status, created_at, updated_at, created_ts) VALUES(?,?,?,?,?,?,?)",
+            rows
+        )
+        await conn.executemany(
+            "INSERT INTO replies(ticket, admin_id, text, created_at, created_ts) VALUES(?,?,?,?,?)",
+            [(r[0], 1, "Принято, бригада выехала", r[4], r[6]) for r in rows[::3]]
+        )
+
+
+def test_archive_moves_closed_and_reads_back(run):
+    rnd, rows = year_of_requests(20_000)
+    cutoff = "2024-12-01"
+    closed = {r[0]: r for r in rows if r[3] != "Новый" and r[4] < cutoff}
+    march = sum(1 for r in rows if r[4].startswith("2024-03"))
+
+    async def scenario():
+        await insert(rows)
+        moved = await archive.archive_before(cutoff)
+        async with db.read_conn() as conn:
+            async with conn.execute("SELECT ticket FROM requests") as cur:
+                left = {t for (t,) in await cur.fetchall()}
+        sample = rnd.sample([r[0] for r in rows], 300)
+        found = {x: await archive.lookup(x) for x in sample}
+        exported = 0
+        async for block in archive.iter_rows("2024-03-01T00:00:00", "2024-03-31T23:59:59"):
+            exported += len(block)
+        # блок, испорченный на диске, не читается молча
+        victim = next(iter(closed))
+        where = await db.find_archived(victim)
+        path = archive.ARCHIVE_DIR / where[2]
+        data = bytearray(path.read_bytes())
+        data[where[3] + where[4] // 2] ^= 0xFF
+        path.write_bytes(bytes(data))
+        with pytest.raises(archive.ArchiveCorrupted):
+            await archive.lookup(victim)
+        return moved, left, found, exported
+
+    moved, left, found, exported = run(scenario())
+    assert moved == len(closed)
+    assert left == {r[0] for r in rows} - set(closed)
+    for ticket, record in found.items():
+        if ticket not in closed:
+            assert record is None
+            continue
+        _t, user_id, text, status, _c, _u, ts = closed[ticket]
+        assert (record["user_id"], record["text"], record["status"], record["created_ts"]) == (user_id, text, status, ts)
+        assert len(record["replies"]) == (1 if int(ticket[1:]) % 3 == 0 else 0)
+    # экспорт периода берёт из архива закрытые, остальное экспорт читает из базы
+    assert exported == sum(1 for r in closed.values() if r[4].startswith("2024-03"))
+    assert 0 < exported < march
+
+
+@pytest.mark.benchmark
+def test_lookup_reads_one_block(run):
+    rnd, rows = year_of_requests(20_000)
+
+    async def scenario():
+        await insert(rows)
+        await archive.archive_before("2025-01-01")
+        sample = rnd.sample([r[0] for r in rows if r[3] != "Новый"], 300)
+        t = perf_counter()
+        for x in sample:
+            assert await archive.lookup(x) is not None
+        return (perf_counter() - t) / len(sample)
+
+    # поиск читает один блок, а не месяц целиком
+    assert run(scenario()) < 0.05
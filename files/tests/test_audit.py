@@ -0,0 +1,105 @@
+# Журнал действий (audit.py): буфер в памяти, запись пачками, ничего не теряется.
+
+import asyncio
+
+import pytest
+
+import audit
+import db
+
+N = 5000
+
+
+@pytest.fixture(autouse=True)
+def empty_buffer(monkeypatch):
+    monkeypatch.setattr(audit, "_PENDING", [])
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    """Сколько раз журнал писал в базу и сколько событий за раз."""
+    batches = []
+    save = db.save_audit
+
+    async def counted(events):
+        batches.append(len(events))
+        await save(events)
+
+    monkeypatch.setattr(db, "save_audit", counted)
+    return batches
+
+
+async def stored(ticket=None) -> int:
+    async with db.read_conn() as conn:
+        where, args = ("WHERE ticket=?", (ticket,)) if ticket else ("", ())
+        async with conn.execute(f"SELECT count(*) FROM audit_log {where}", args) as cur:
+            return (await cur.fetchone())[0]
+
+
+def test_events_are_written_in_batches(run, writes):
+    async def scenario():
+        await audit.start_audit()
+        for i in range(N):
+            audit.record(audit.STATUS, f"T{i % 100}", 1, to="В обработке")
+            if i % 100 == 0:
+                await asyncio.sleep(0)  # между действиями операторов бот занят другим
+        in_memory = len(writes)
+        await audit.stop_audit()
+        return in_memory, await stored()
+
+    in_memory, total = run(scenario())
+    assert total == N
+    # record() сам в базу не ходит: пишет фоновая задача, пачками
+    assert in_memory <= N // audit.AUDIT_BATCH
+    assert len(writes) <= N // audit.AUDIT_BATCH + 1
+    assert sum(writes) == N
+
+
+def test_history_merges_written_and_pending(run):
+    async def scenario():
+        audit.record(audit.CREATED, "T1", 5)
+        audit.record(audit.ROUTE, "T2", 1, dept="water")
+        await audit.flush()
+        audit.record(audit.STATUS, "T1", 1, was="Новый", to="В обработке")
+        audit.record(audit.REPLY, "T1", 1)
+        return await audit.history("T1"), await audit.history("T1", limit=2), await stored("T1")
+
+    full, last_two, written = run(scenario())
+    assert [(actor, action) for actor, action, _d, _at in full] == [(5, audit.CREATED), (1, audit.STATUS), (1, audit.REPLY)]
+    assert full[1][2] == {"was": "Новый", "to": "В обработке"}
+    assert audit.describe(full[1][1], full[1][2]) == "статус: Новый → В обработке"
+    assert [action for _a, action, _d, _at in last_two] == [audit.STATUS, audit.REPLY]
+    assert written == 1
+
+
+def test_failed_write_keeps_events(run, monkeypatch):
+    save = db.save_audit
+    failures = [RuntimeError("database is locked")]
+
+    async def flaky(events):
+        if failures:
+            raise failures.pop()
+        await save(events)
+
+    monkeypatch.setattr(db, "save_audit", flaky)
+    monkeypatch.setattr(audit, "AUDIT_MAX_PENDING", 8)
+
+    async def scenario():
+        for i in range(6):
+            audit.record(audit.STATUS, "T1", 1, to=f"s{i}")
+        await audit.flush()
+        kept = len(audit._PENDING)
+        # пока база недоступна, буфер не растёт сверх AUDIT_MAX_PENDING — уходят старые
+        failures.append(RuntimeError("database is locked"))
+        for i in range(6, 10):
+            audit.record(audit.STATUS, "T1", 1, to=f"s{i}")
+        await audit.flush()
+        capped = len(audit._PENDING)
+        await audit.stop_audit()
+        return kept, capped, await audit.history("T1")
+
+    kept, capped, events = run(scenario())
+    assert kept == 6
+    assert capped == 8
+    assert not audit._PENDING
+    assert [d["to"] for _a, _act, d, _at in events] == [f"s{i}" for i in range(2, 10)]
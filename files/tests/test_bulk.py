@@ -0,0 +1,101 @@
+# Массовые операции (bulk.py): порции не задерживают приём заявок, жители уведомляются.
+# Замер задержки приёма на большой базе — только с --benchmark.
+
+import asyncio
+import json
+import random
+from time import monotonic
+
+import pytest
+
+import bulk
+import db
+import outbox
+
+N = 100_000
+INTAKE_P99_S = 0.25  # одна порция BULK_BATCH — миллисекунды; весь DELETE на N строк — секунды
+
+
+async def fill(n: int):
+    rnd = random.Random(4)
+    words = ["течёт", "вода", "подъезд", "лифт", "свет", "двор", "яма", "дорога"]
+    async with db.write_conn() as conn:
+        for start in range(0, n, 10_000):
+            await conn.executemany(
+                "INSERT INTO requests(ticket, user_id, text, status, created_at, created_ts, latitude, longitude) "
+                "VALUES(?,?,?,?,?,?,?,?)",
+                [(f"B{i}", i % 5000, " ".join(rnd.choices(words, k=12)), "Новый", "2025-01-01T00:00:00", i,
+                  55.7 + rnd.random() / 10, 37.6 + rnd.random() / 10)
+                 for i in range(start, min(n, start + 10_000))]
+            )
+
+
+async def intake(stop: asyncio.Event, waits: list):
+    # житель создаёт заявку каждые 20 мс; меряем, сколько ждёт сохранение
+    i = 0
+    while not stop.is_set():
+        t = monotonic()
+        await db.save_request(ticket=f"R{i}", user_id=1, text="нет света")
+        waits.append(monotonic() - t)
+        i += 1
+        await asyncio.sleep(0.02)
+
+
+async def count(where: str) -> int:
+    async with db.read_conn() as conn:
+        async with conn.execute(f"SELECT count(*) FROM requests WHERE {where}") as cur:
+            return (await cur.fetchone())[0]
+
+
+def cleanup_during_intake(run, n: int):
+    """Чистка n заявок, пока жители создают новые: (удалено, сколько ждало каждое сохранение)."""
+    async def scenario():
+        await fill(n)
+        stop, waits = asyncio.Event(), []
+        task = asyncio.create_task(intake(stop, waits))
+        await asyncio.sleep(0.2)
+        before = len(waits)
+        deleted = await bulk.cleanup("active")
+        stop.set()
+        await task
+        return deleted, before, waits, await count("ticket LIKE 'B%'"), await count("ticket LIKE 'R%'")
+
+    deleted, before, waits, old_left, new_left = run(scenario())
+    assert old_left == 0
+    # заявки, созданные во время чистки, она не трогает (одна могла сохраняться на старте)
+    assert len(waits) - before - 1 <= new_left
+    assert deleted == n + len(waits) - new_left
+    return sorted(waits)
+
+
+def test_cleanup_runs_in_batches(run):
+    waits = cleanup_during_intake(run, 10_000)
+    # между порциями приём заявок продолжался
+    assert len(waits) > 10
+
+
+@pytest.mark.benchmark
+def test_cleanup_keeps_intake_responsive(run):
+    waits = cleanup_during_intake(run, N)
+    assert len(waits) > 20
+    assert waits[int(len(waits) * 0.99)] < INTAKE_P99_S
+
+
+def test_close_active_notifies_each_author_once(run):
+    async def scenario():
+        for i in range(30):
+            await db.save_request(f"T{i}", i % 3, "Нет воды")
+        await db.update_status("T0", "Отклонено")
+        closed = await bulk.close_active()
+        async with db.read_conn() as conn:
+            async with conn.execute("SELECT chat_id, params, priority FROM outbox ORDER BY chat_id") as cur:
+                messages = await cur.fetchall()
+        return closed, messages, await count("status='Завершено'"), await count("status='Отклонено'")
+
+    closed, messages, done, rejected = run(scenario())
+    assert closed == 29 and done == 29 and rejected == 1
+    # несколько заявок жителя из порции — одно сообщение
+    assert [chat_id for chat_id, _p, _prio in messages] == [0, 1, 2]
+    assert all(prio == outbox.PRIORITY_BACKGROUND for _c, _p, prio in messages)
+    text = json.loads(messages[1][1])["text"]
+    assert "Завершено" in text and "T1," in text and "T28" in text
@@ -0,0 +1,66 @@
+# Инлайн-кнопки (callbacks.py): компактный формат, старые кнопки, разбор по словарю кодов.
+# Замер скорости разбора — только с --benchmark.
+
+import timeit
+
+import pytest
+
+import main
+from callbacks import MAX_DATA, OP_OPEN, OP_OPEN_FOUND, OP_QUEUE_PAGE, OP_STATUS, STATUS, pack
+
+REGISTRY = main.CALLBACKS
+TICKET = "T20251110152312001" + "0100"
+
+
+def decoded(data: str):
+    found = REGISTRY.decode(data)
+    return found and (found[0].op, found[1])
+
+
+def test_new_format_round_trip():
+    assert decoded(pack(OP_OPEN, 123456)) == (OP_OPEN, [123456])
+    assert decoded(pack(OP_STATUS, 123456, STATUS.encode("Завершено"))) == (OP_STATUS, [123456, "Завершено"])
+    # самые длинные кнопки — с курсором страницы — укладываются в лимит Telegram
+    longest = pack(OP_QUEUE_PAGE, "o", 10 ** 13, 10 ** 9)
+    assert len(longest.encode()) <= MAX_DATA
+    assert decoded(pack(OP_OPEN_FOUND, 10 ** 9, 10 ** 6, 99)) == (OP_OPEN_FOUND, [10 ** 9, 10 ** 6, 99])
+    with pytest.raises(ValueError):
+        pack(OP_OPEN, "x" * MAX_DATA)
+
+
+def test_legacy_and_broken_buttons():
+    # кнопки в старых сообщениях продолжают работать
+    assert decoded(f"open:{TICKET}") == (OP_OPEN, [TICKET])
+    assert decoded(f"status:{TICKET}:Завершено") == (OP_STATUS, [TICKET, "Завершено"])
+    assert decoded("danger:cancel")[0] == "dx1"
+    # неизвестный код, лишний аргумент, неизвестный статус — не распознаются
+    assert decoded("zz1:5") is None
+    assert decoded(pack(OP_OPEN, 5) + ":6") is None
+    assert decoded(pack(OP_STATUS, 5, "q")) is None
+
+
+def test_new_format_skips_legacy_scan(monkeypatch):
+    scanned = []
+    scan = REGISTRY._decode_legacy
+
+    def counted(data):
+        scanned.append(data)
+        return scan(data)
+
+    monkeypatch.setattr(REGISTRY, "_decode_legacy", counted)
+    # кнопка нового формата находится по коду в словаре, даже испорченная
+    for data in (pack(OP_OPEN, 123456), pack(OP_STATUS, 123456, STATUS.encode("Завершено")), pack(OP_OPEN, 5) + ":6"):
+        REGISTRY.decode(data)
+    assert scanned == []
+    # перебор префиксов — только для кнопок старого формата
+    old = f"status:{TICKET}:Завершено"
+    assert decoded(old) == (OP_STATUS, [TICKET, "Завершено"])
+    assert scanned == [old]
+
+
+@pytest.mark.benchmark
+def test_decode_is_a_dictionary_lookup():
+    n = 100_000
+    for data in (pack(OP_OPEN, 123456), pack(OP_STATUS, 123456, "d"), f"status:{TICKET}:Завершено"):
+        spent = min(timeit.repeat(lambda: REGISTRY.decode(data), number=n, repeat=3)) / n
+        assert spent < 20e-6, data
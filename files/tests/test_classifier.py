@@ -0,0 +1,110 @@
+# Экстренные ключевые слова (classifier.py): основы слов, ранжирование, большой словарь.
+# Замер скорости против цикла — только с --benchmark.
+
+import random
+import timeit
+
+import pytest
+
+import classifier
+import config
+from classifier import KeywordMatcher
+
+# обычная (не экстренная) заявка — самый частый случай и худший для цикла
+# `kw in text`: он проверяет все ключи и ничего не находит
+ORDINARY = ("Во дворе дома на улице Ленина сильный запах сырости, соседи жалуются, "
+            "в подвале течёт вода из трубы, просим прислать сантехника скорее ") * 3
+
+
+def per_call(fn, n: int = 200) -> float:
+    return min(timeit.repeat(fn, number=n, repeat=3)) / n
+
+
+def test_stems_and_ranking():
+    m = KeywordMatcher(config.URGENT_KEYWORDS)
+    assert m.matches(ORDINARY) == []
+    # любое окончание, любой регистр, «ё» как «е», пробелы внутри ключа
+    assert m.matches("Подъезд ЗАМИНИРОВАЛИ") == [("emerg_bomb", 1)]
+    assert m.matches("Наводнёние в подвале") == [("emerg_flood", 1)]
+    assert m.matches("Человек   убит во дворе") == [("emerg_murder", 1)]
+    # совпадение — только с начала слова
+    assert m.matches("Андрон ударник") == [("emerg_uav", 1)]
+    # больше совпадений — выше, при равенстве — кто раньше
+    assert m.matches("Дрон упал, пожар, горит сарай") == [("emerg_fire", 2), ("emerg_uav", 1)]
+    assert m.matches("Дрон упал, пожар") == [("emerg_uav", 1), ("emerg_fire", 1)]
+
+
+ALPHABET = "абвгдежзиклмнопрстуфхцчшщыэюя"
+
+
+def big_dictionary(rnd: random.Random, size: int = 5000) -> dict:
+    big = dict(config.URGENT_KEYWORDS)
+    n = 0
+    while len(big) < size:
+        big["".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(4, 10)))] = f"emerg_test{n % 7}"
+        n += 1
+    return big
+
+
+def naive(keywords: dict, text: str):
+    """То же, что KeywordMatcher.matches, перебором ключей: с начала каждого слова —
+    самый длинный ключ, совпадения не перекрываются."""
+    cat = {" ".join(k.lower().replace("ё", "е").split()): v for k, v in keywords.items()}
+    t = text.lower().replace("ё", "е")
+    counts, first = {}, {}
+    i = 0
+    while i < len(t):
+        if t[i].isalnum() and (i == 0 or not t[i - 1].isalnum()):
+            hits = [k for k in cat if t.startswith(k, i)]
+            if hits:
+                k = max(hits, key=len)
+                counts[cat[k]] = counts.get(cat[k], 0) + 1
+                first.setdefault(cat[k], i)
+                i += len(k)
+                continue
+        i += 1
+    return sorted(counts.items(), key=lambda kv: (-kv[1], first[kv[0]]))
+
+
+def test_large_dictionary_matches_naive_loop():
+    rnd = random.Random(7)
+    big = big_dictionary(rnd)
+    m = KeywordMatcher(big)
+    keys = list(big)
+    filler = ORDINARY.split()
+    for _ in range(150):
+        # ключи с окончаниями и без, внутри обычных слов, среди обычного текста
+        words = [rnd.choice(filler) for _ in range(rnd.randint(3, 15))]
+        for _ in range(rnd.randint(0, 4)):
+            word = rnd.choice(keys) + rnd.choice(["", "а", "ами", "ение"])
+            words.insert(rnd.randrange(len(words) + 1), rnd.choice([word, word.upper(), "про" + word]))
+        text = " ".join(words)
+        assert m.matches(text) == naive(big, text), text
+
+
+def test_matcher_follows_config(monkeypatch):
+    monkeypatch.setattr(classifier, "_MATCHER", None)
+    monkeypatch.setattr(config, "URGENT_KEYWORDS", {"пожар": "emerg_fire"})
+    first = classifier.get_matcher()
+    assert classifier.get_matcher() is first
+    assert classifier.match_urgent("Пожар во дворе, дым") == [("emerg_fire", 1)]
+    # словарь заменили целиком
+    monkeypatch.setattr(config, "URGENT_KEYWORDS", {"дым": "emerg_smoke"})
+    assert classifier.match_urgent("Пожар во дворе, дым") == [("emerg_smoke", 1)]
+    # в тот же словарь добавили ключ
+    config.URGENT_KEYWORDS["пожар"] = "emerg_fire"
+    assert classifier.match_urgent("Пожар во дворе, дым") == [("emerg_fire", 1), ("emerg_smoke", 1)]
+
+
+@pytest.mark.benchmark
+def test_time_does_not_grow_with_dictionary():
+    big = big_dictionary(random.Random(1))
+    small_m, big_m = KeywordMatcher(config.URGENT_KEYWORDS), KeywordMatcher(big)
+    low = ORDINARY.lower()
+
+    small = per_call(lambda: small_m.matches(ORDINARY))
+    large = per_call(lambda: big_m.matches(ORDINARY))
+    loop = per_call(lambda: [kw for kw in big if kw in low])
+    # словарь в 300 раз больше — матчер медленнее в разы, цикл — в сотни раз
+    assert large < small * 5
+    assert large * 10 < loop
@@ -0,0 +1,159 @@
+# Дубли заявок: поиск в памяти, без общего замка, индекс между процессами.
+# Замер скорости поиска — только с --benchmark.
+
+import asyncio
+import json
+import random
+from time import perf_counter
+
+import pytest
+
+import bulk
+import db
+import dedup
+import main
+
+FIRE = "Горит дом на улице Ленина 15, много дыма"
+FIRE_AGAIN = "Горит дом на улице Ленина 15, дым"
+LIGHT = "Не горят фонари во дворе на Садовой"
+
+
+@pytest.fixture(autouse=True)
+def fresh_index(monkeypatch):
+    monkeypatch.setattr(dedup, "_INDEX", dedup.DedupIndex())
+    monkeypatch.setattr(dedup, "_loaded", False)
+
+
+def saver(n, gate=None):
+    """save(duplicate_of) для create_or_link; gate — задержать сохранение до события."""
+    async def save(duplicate_of):
+        if gate is not None:
+            await gate.wait()
+        ticket = f"T{n}"
+        return await db.save_request(ticket, n, "", duplicate_of=duplicate_of), ticket
+    return save
+
+
+def big_index(n: int = 5000) -> dedup.DedupIndex:
+    random.seed(3)
+    alpha = "абвгдежзиклмнопрстуфхцчшэюя"
+    words = ["".join(random.choices(alpha, k=random.randint(4, 9))) for _ in range(5000)]
+    streets = ["Ленина", "Мира", "Гагарина", "Советская", "Садовая", "Пушкина"]
+    index = dedup.DedupIndex(window_s=10 ** 9)
+    for i in range(n):
+        # в индексе только головные заявки — разные, поэтому со случайными словами
+        text = f"{random.choice(streets)} дом {random.randint(1, 200)} " + " ".join(random.choices(words, k=8))
+        index.add(i + 1, f"T{i}", 0, 55.7 + random.random() * 0.2, 37.5 + random.random() * 0.2, dedup.signature(text))
+    return index
+
+
+def test_detection_in_large_index():
+    index = big_index()
+    index.add(10_001, "NEAR", 0, 55.75, 37.6, dedup.signature(FIRE))
+    # тот же текст в другом конце города — не дубль
+    index.add(10_002, "FAR", 0, 55.9, 37.5, dedup.signature(FIRE))
+    found = index.candidates(dedup.signature(FIRE_AGAIN), 55.7502, 37.6003)
+    assert [m.ticket for m in found] == ["NEAR"]
+    assert index.candidates(dedup.signature(LIGHT), 55.75, 37.6) == []
+
+
+@pytest.mark.benchmark
+def test_detection_under_a_millisecond():
+    index = big_index()
+    n = 500
+    t = perf_counter()
+    for i in range(n):
+        # подпись нового текста и поиск — всё, что делается при создании заявки
+        index.candidates(dedup.signature(f"{FIRE} {i}"), 55.75, 37.6)
+    assert (perf_counter() - t) / n < 0.001
+
+
+def test_similar_waits_for_head_others_do_not(run):
+    async def scenario():
+        gate = asyncio.Event()
+        head = asyncio.ensure_future(dedup.create_or_link(FIRE, None, None, saver(1, gate)))
+        await asyncio.sleep(0)
+        # головная ещё сохраняется: другая заявка не ждёт её, похожая — ждёт
+        other = await asyncio.wait_for(dedup.create_or_link(LIGHT, None, None, saver(2)), 2)
+        dup = asyncio.ensure_future(dedup.create_or_link(FIRE_AGAIN, None, None, saver(3)))
+        await asyncio.sleep(0.05)
+        dup_waited = not dup.done()
+        gate.set()
+        return await head, other, await dup, dup_waited
+
+    (head_id, head_match), (_other_id, other_match), (_dup_id, dup_match), dup_waited = run(scenario())
+    assert head_match is None and other_match is None
+    assert dup_waited
+    assert dup_match.request_id == head_id and dup_match.ticket == "T1"
+
+
+def test_failed_head_releases_waiters(run):
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def broken(duplicate_of):
+            await gate.wait()
+            raise RuntimeError("база недоступна")
+
+        head = asyncio.ensure_future(dedup.create_or_link(FIRE, None, None, broken))
+        await asyncio.sleep(0)
+        dup = asyncio.ensure_future(dedup.create_or_link(FIRE_AGAIN, None, None, saver(2)))
+        await asyncio.sleep(0)
+        gate.set()
+        with pytest.raises(RuntimeError):
+            await head
+        return await dup
+
+    _request_id, match = run(scenario())
+    # похожая стала головной сама
+    assert match is None
+    assert len(dedup._INDEX) == 1
+
+
+def test_bulk_close_forgets_heads(run):
+    async def scenario():
+        await dedup.create_or_link(FIRE, None, None, saver(1))
+        await bulk.close_active()
+        return await dedup.create_or_link(FIRE_AGAIN, None, None, saver(2))
+
+    _request_id, match = run(scenario())
+    assert match is None
+
+
+def test_sync_follows_other_workers(run):
+    async def scenario():
+        await dedup.start_dedup()
+        # другой воркер сохранил головную заявку после нашей загрузки индекса…
+        other = await db.save_request("W1", 9, FIRE)
+        # …а наша новее — и не должна сдвигать границу загрузки за неё
+        await dedup.create_or_link(LIGHT, None, None, saver(2))
+        await dedup._sync(prune=True)
+        _id, linked = await dedup.create_or_link(FIRE_AGAIN, None, None, saver(3))
+        # другой воркер закрыл заявку — после синхронизации она не исходная
+        await db.update_status("W1", "Завершено")
+        await dedup._sync(prune=True)
+        return other, linked, other in dedup._INDEX
+
+    other, linked, still_indexed = run(scenario())
+    assert linked is not None and linked.request_id == other
+    assert not still_indexed
+
+
+def test_shutdown_flushes_pending_counter(run):
+    async def scenario():
+        head = await db.save_request("T1", 1, FIRE)
+        await db.save_notice(head, 500, 77, "text", "Новая заявка T1")
+        await db.save_request("T2", 2, FIRE_AGAIN, duplicate_of=head)
+        # счётчик ждёт DEDUP_EDIT_DELAY, а бот уже останавливается
+        main.schedule_duplicate_counter(head)
+        await asyncio.sleep(0)
+        await main.flush_duplicate_counters()
+        async with db.read_conn() as conn:
+            async with conn.execute("SELECT chat_id, method, params FROM outbox") as cur:
+                return await cur.fetchall(), dict(main._COUNTER_TASKS), set(main._COUNTER_RUNNING)
+
+    edits, waiting, running = run(scenario())
+    assert [(chat_id, method) for chat_id, method, _p in edits] == [(500, "edit_message_text")]
+    params = json.loads(edits[0][2])
+    assert params["message_id"] == 77 and "Похожих заявок: 1 (последняя T2)" in params["text"]
+    assert not waiting and not running
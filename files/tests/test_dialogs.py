@@ -0,0 +1,48 @@
+# Диалоги оператор↔житель (dialogs.py): закрытие по неактивности при нескольких воркерах.
+
+import pytest
+
+import db
+import dialogs
+
+HOUR_MS = 3600 * 1000
+
+
+@pytest.fixture(autouse=True)
+def primary(monkeypatch):
+    monkeypatch.setattr(dialogs, "IS_PRIMARY", True)
+    for index in (dialogs._BY_TICKET, dialogs._BY_ADMIN, dialogs._BY_USER, dialogs._DIRTY):
+        index.clear()
+    yield
+    for index in (dialogs._BY_TICKET, dialogs._BY_ADMIN, dialogs._BY_USER, dialogs._DIRTY):
+        index.clear()
+
+
+async def outbox_chats():
+    async with db.read_conn() as conn:
+        async with conn.execute("SELECT chat_id FROM outbox ORDER BY chat_id") as cur:
+            return [r[0] for r in await cur.fetchall()]
+
+
+def test_touch_from_other_worker_keeps_dialog(run):
+    async def scenario():
+        # главный процесс: два диалога, оба по его памяти давно без активности
+        await dialogs.start_dialog("T1", 10, 20)
+        await dialogs.start_dialog("T2", 11, 21)
+        stale = dialogs._now_ms() - dialogs.DIALOG_IDLE_TIMEOUT * 1000 - HOUR_MS
+        for ticket in ("T1", "T2"):
+            dialogs._BY_TICKET[ticket]["last"] = stale
+        await db.touch_dialogs([("T1", stale), ("T2", stale)])
+        # воркер 2 обработал сообщение диалога T1 и сбросил отметку в БД;
+        # версия кэша при этом не меняется — память главного не перечитывается
+        fresh = dialogs._now_ms()
+        await db.touch_dialogs([("T1", fresh)])
+        await dialogs._expire_idle()
+        return fresh, await db.list_dialogs(), await outbox_chats()
+
+    fresh, left, notified = run(scenario())
+    assert [row[0] for row in left] == ["T1"]
+    assert dialogs.dialog_info("T1")["last"] == fresh
+    assert dialogs.dialog_for_admin(11) is None and dialogs.dialog_info("T2") is None
+    # о закрытии узнают только участники действительно неактивного диалога
+    assert notified == [11, 21]
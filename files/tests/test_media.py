@@ -0,0 +1,169 @@
+# Локальные копии вложений (media.py) против подмены Bot API: aiohttp-сервер
+# отвечает на getFile и отдаёт файлы кусками, как api.telegram.org.
+
+import asyncio
+import hashlib
+import logging
+import random
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+from telegram import Bot
+
+import db
+import media
+
+TOKEN = "123:TEST"
+N = 30
+
+
+class FakeBotApi:
+    """Файлы подмены: каждый пятый — повтор уже виденного (одно фото из разных заявок).
+    Файлов с file_id на «x» на сервере нет — 404."""
+
+    def __init__(self, n: int):
+        rnd = random.Random(5)
+        self.blobs = [rnd.randbytes(rnd.randint(20_000, 200_000)) for _ in range(n * 4 // 5)]
+        self.thumbs = [rnd.randbytes(4_000) for _ in range(n)]
+        self.runner = None
+        self.port = None
+
+    def blob(self, file_id: str) -> bytes:
+        kind, n = file_id[0], int(file_id[1:])
+        return self.thumbs[n] if kind == "t" else self.blobs[n % len(self.blobs)]
+
+    async def _api(self, request: web.Request):
+        if request.match_info["method"] == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}})
+        fid = (await request.post())["file_id"]
+        return web.json_response({"ok": True, "result": {
+            "file_id": fid, "file_unique_id": fid, "file_size": len(self.blob(fid)), "file_path": f"photos/{fid}.jpg"}})
+
+    async def _file(self, request: web.Request):
+        stem = Path(request.match_info["path"]).stem
+        if stem.startswith("x"):
+            raise web.HTTPNotFound()
+        data = self.blob(stem)
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        for i in range(0, len(data), 16 * 1024):
+            await resp.write(data[i:i + 16 * 1024])
+        await resp.write_eof()
+        return resp
+
+    async def start(self) -> Bot:
+        app = web.Application()
+        app.router.add_post(f"/bot{TOKEN}/{{method}}", self._api)
+        app.router.add_get(f"/file/bot{TOKEN}/{{path:.*}}", self._file)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        bot = Bot(TOKEN, base_url=f"http://127.0.0.1:{self.port}/bot",
+                  base_file_url=f"http://127.0.0.1:{self.port}/file/bot")
+        await bot.initialize()
+        return bot
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+@pytest.fixture
+def api(monkeypatch, tmp_path):
+    fake = FakeBotApi(N)
+    monkeypatch.setattr(media, "MEDIA_ROOT", tmp_path / "media")
+    # влезает примерно треть разных файлов — вытеснение обязательно сработает
+    monkeypatch.setattr(media, "MEDIA_CACHE_MAX_BYTES", sum(len(b) for b in fake.blobs) // 3)
+    return fake
+
+
+async def pending_media() -> int:
+    async with db.read_conn() as conn:
+        async with conn.execute("SELECT count(*) FROM requests WHERE media_sha256 IS NULL") as cur:
+            return (await cur.fetchone())[0]
+
+
+async def wait_downloaded(timeout: float = 30.0):
+    loop = asyncio.get_running_loop()
+    edge = loop.time() + timeout
+    while await pending_media():
+        assert loop.time() < edge, "вложения не скачались"
+        await asyncio.sleep(0.05)
+    await media._QUEUE.join()
+
+
+def test_content_addressed_store_with_eviction_and_resume(run, api):
+    async def scenario():
+        bot = await api.start()
+        try:
+            ids = [await db.save_request(f"T{i}", i, "фото", media_path=f"f{i}", thumb_id=f"t{i}") for i in range(N)]
+            # первый запуск успевает скачать половину…
+            await media.start_media(bot, resume=False)
+            for i in range(N // 2):
+                media.submit(ids[i], f"f{i}", f"t{i}")
+            await media._QUEUE.join()
+            await media.stop_media()
+            left_after_crash = await pending_media()
+            # …после перезапуска остальные подбирает resume
+            await media.start_media(bot, resume=True)
+            await wait_downloaded()
+            await media.stop_media()
+            return ids, left_after_crash, [await db.get_request_media(i) for i in ids], await db.media_usage()
+        finally:
+            await bot.shutdown()
+            await api.stop()
+
+    ids, left_after_crash, copies, usage = run(scenario())
+    root = media.MEDIA_ROOT
+    originals = {hashlib.sha256(b).hexdigest(): len(b) for b in api.blobs}
+    thumbs = {hashlib.sha256(b).hexdigest() for b in api.thumbs}
+
+    assert left_after_crash == N - N // 2
+    # хэш записан у каждой заявки и совпадает с содержимым её файла
+    for i, copy in enumerate(copies):
+        assert copy is not None
+        sha, size, rel, stored, thumb_rel = copy
+        assert sha == hashlib.sha256(api.blob(f"f{i}")).hexdigest() and size == originals[sha]
+        # миниатюры не вытесняются
+        assert thumb_rel and (root / thumb_rel).is_file()
+    # каждый sha на диске один раз, имя файла — хэш содержимого
+    files = [p for p in root.rglob("*") if p.is_file() and p.relative_to(root).parts[0] != "tmp"]
+    names = [p.stem for p in files]
+    assert len(names) == len(set(names))
+    for p in files:
+        assert hashlib.sha256(p.read_bytes()).hexdigest() == p.stem
+    # вытеснение удерживает оригиналы в пределах лимита
+    on_disk = sum(p.stat().st_size for p in files if p.stem in originals)
+    assert usage <= media.MEDIA_CACHE_MAX_BYTES
+    assert on_disk <= media.MEDIA_CACHE_MAX_BYTES
+    assert len([n for n in names if n in originals]) < len(originals)
+    assert thumbs <= set(names)
+
+
+def test_failed_download_log_hides_token(run, api, caplog):
+    async def scenario():
+        bot = await api.start()
+        try:
+            with_thumb = await db.save_request("T1", 1, "фото", media_path="f0", thumb_id="x1")
+            lost = await db.save_request("T2", 2, "фото", media_path="x0")
+            await media.start_media(bot, resume=False)
+            media.submit(with_thumb, "f0", "x1")
+            media.submit(lost, "x0")
+            await media._QUEUE.join()
+            await media.stop_media()
+            return await db.get_request_media(with_thumb), await db.get_request_media(lost)
+        finally:
+            await bot.shutdown()
+            await api.stop()
+
+    with caplog.at_level(logging.INFO, logger="bot.media"):
+        copy, missing = run(scenario())
+    # без миниатюры копия оригинала всё равно сохраняется
+    assert copy is not None and not copy[4]
+    assert missing is None
+    logged = [r.getMessage() for r in caplog.records if r.name == "bot.media"]
+    assert [m for m in logged if "Миниатюра заявки" in m] and [m for m in logged if "Вложение заявки" in m]
+    # адрес файла в Bot API содержит токен бота — в лог идёт только код ответа
+    assert all("404" in m and TOKEN not in m for m in logged if "не скачан" in m)
@@ -0,0 +1,112 @@
+# Исходящие сообщения (outbox.py) на подставном боте: сбои сети, RetryAfter,
+# порядок в чате, перезапуск посреди отправки.
+
+import asyncio
+import json
+from typing import Dict, List
+
+import pytest
+from telegram.error import Forbidden, NetworkError, RetryAfter
+
+import db
+import outbox
+from ratelimit import TelegramLimiter
+
+N = 2000
+CHATS = 50
+
+
+class Sent:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FlakyBot:
+    """Каждый 7-й вызов — сетевой сбой, каждый 97-й — RetryAfter; чат 13 заблокировал бота."""
+
+    def __init__(self):
+        self.calls = 0
+        self.got: Dict[int, List[int]] = {}
+
+    async def send_message(self, chat_id, text):
+        self.calls += 1
+        await asyncio.sleep(0.002)
+        if chat_id == 13:
+            raise Forbidden("bot was blocked by the user")
+        if self.calls % 97 == 0:
+            raise RetryAfter(0.05)
+        if self.calls % 7 == 0:
+            raise NetworkError("connection reset")
+        self.got.setdefault(chat_id, []).append(int(text))
+        return Sent(self.calls)
+
+
+@pytest.fixture(autouse=True)
+def fast(monkeypatch):
+    # без лимитов Telegram и с короткими паузами: проверяется сама очередь
+    monkeypatch.setattr(outbox, "LIMITER", TelegramLimiter(10_000, 0, 0))
+    monkeypatch.setattr(outbox, "OUTBOX_BACKOFF", 0.01)
+
+
+async def drain(timeout: float = 30.0):
+    loop = asyncio.get_running_loop()
+    edge = loop.time() + timeout
+    while (await db.outbox_stats())[0]:
+        assert loop.time() < edge, "очередь не разобрана"
+        await asyncio.sleep(0.05)
+
+
+def test_exactly_once_in_order_through_failures_and_restart(run):
+    bot = FlakyBot()
+    rows = [outbox.message(i % CHATS, str(i), key=f"t:{i}") for i in range(N)]
+
+    async def scenario():
+        await outbox.send(rows)
+        await outbox.send(rows[:100])  # повтор тех же событий — второй раз не ставится
+        await outbox.start_outbox(bot)
+        await asyncio.sleep(0.3)
+        await outbox.stop_outbox()  # «рестарт» посреди отправки
+        sent_before_restart = sum(len(v) for v in bot.got.values())
+        await outbox.start_outbox(bot)
+        await drain()
+        await outbox.stop_outbox()
+        async with db.read_conn() as conn:
+            async with conn.execute("SELECT count(*) FROM outbox") as cur:
+                queued = (await cur.fetchone())[0]
+        return sent_before_restart, queued, await db.outbox_stats()
+
+    sent_before_restart, queued, (left, failed) = run(scenario())
+    assert queued == N
+    assert 0 < sent_before_restart < N
+    expected = {chat: [i for i in range(N) if i % CHATS == chat] for chat in range(CHATS) if chat != 13}
+    # каждое сообщение доставлено ровно один раз и в порядке постановки
+    assert bot.got == expected
+    assert left == 0
+    # Forbidden не лечится повтором: сообщения в заблокированный чат — «не удалось»
+    assert failed == N // CHATS
+
+
+def test_hook_receives_sent_message(run, monkeypatch):
+    seen = []
+
+    async def remember(chat_id, sent, ticket):
+        seen.append((chat_id, sent.message_id, ticket))
+
+    monkeypatch.setitem(outbox._HOOKS, "test_remember", remember)
+
+    class Bot:
+        async def send_message(self, chat_id, text):
+            return Sent(100 + chat_id)
+
+    async def scenario():
+        await outbox.send([outbox.message(1, "новая заявка", key="n:1", hook=("test_remember", "T1"))])
+        await outbox.start_outbox(Bot())
+        await drain()
+        await outbox.stop_outbox()
+        async with db.read_conn() as conn:
+            async with conn.execute("SELECT method, params, message_id FROM outbox") as cur:
+                return await cur.fetchone()
+
+    method, params, message_id = run(scenario())
+    assert seen == [(1, 101, "T1")]
+    assert (method, json.loads(params), message_id) == ("send_message", {"text": "новая заявка"}, 101)
@@ -0,0 +1,57 @@
+# Направление заявки в отдел (main.cb_route): вложение уходит методом своего вида.
+
+import json
+from types import SimpleNamespace
+
+import db
+import main
+import outbox
+
+DEPT_CHAT = -100500
+
+
+class Query:
+    """Нажатие кнопки «Направить в отдел»: ответ бота — правка сообщения с кнопкой."""
+
+    def __init__(self, n: int):
+        self.id = f"q{n}"
+        self.edited = []
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edited.append(text)
+
+
+async def route(request_id: int, n: int) -> Query:
+    query = Query(n)
+    update = SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=1))
+    await main.cb_route(update, SimpleNamespace(), request_id, "water")
+    return query
+
+
+def test_attachment_sent_by_its_kind(run):
+    async def scenario():
+        await db.upsert_department("water", "Водоканал", DEPT_CHAT)
+        ids = [
+            await db.save_request("T1", 1, "Видео протечки", media_path="vid", media_kind="video"),
+            await db.save_request("T2", 1, "Акт осмотра", media_path="doc", media_kind="document"),
+            await db.save_request("T3", 1, "Фото ямы", media_path="pic", media_kind="photo"),
+        ]
+        # заявка до _m018: вид вложения не записан
+        ids.append(await db.save_request("T4", 1, "Старая заявка", media_path="old"))
+        answers = [(await route(request_id, n)).edited for n, request_id in enumerate(ids)]
+        async with db.read_conn() as conn:
+            async with conn.execute(
+                "SELECT method, params FROM outbox WHERE chat_id=? AND key LIKE '%:media' ORDER BY id", (DEPT_CHAT,)
+            ) as cur:
+                media = [(method, json.loads(params)) for method, params in await cur.fetchall()]
+        return answers, media, await db.get_media_kind(ids[0])
+
+    answers, media, stored = run(scenario())
+    assert stored == "video"
+    assert all(a == [f"Заявка T{n} направлена в отдел: Водоканал"] for n, a in enumerate(answers, 1))
+    assert [(method, params[kind]) for (method, params), kind in zip(media, ("video", "document", "photo", "photo"))] == [
+        (outbox.MEDIA_METHODS["video"], "vid"),
+        (outbox.MEDIA_METHODS["document"], "doc"),
+        (outbox.MEDIA_METHODS["photo"], "pic"),
+        (outbox.MEDIA_METHODS["photo"], "old"),
+    ]
@@ -0,0 +1,114 @@
+# Полнотекстовый поиск: индекс ведёт Python, схема базы открывается обычным sqlite3.
+# Замер скорости на большой базе — только с --benchmark.
+
+import random
+import sqlite3
+from time import perf_counter
+
+import pytest
+
+import db
+from config import SEARCH_CANDIDATES
+from search import fts_query
+
+
+async def found(query: str):
+    rows, _total, _capped = await db.search_requests(fts_query(query), limit=10)
+    return [r[1] for r in rows]
+
+
+def test_index_follows_bot_writes(run):
+    async def scenario():
+        await db.save_request("T1", 1, "Течёт вода с потолка в подъезде")
+        await db.save_request("T2", 2, "Не горит фонарь во дворе")
+        by_text = await found("течь")
+        await db.update_status("T2", "В обработке", admin_comment="Заменили лампу")
+        by_comment = await found("лампа")
+        await db.save_reply("T1", 7, "Сантехник придёт завтра")
+        await db.save_reply("T1", 7, "Стояк перекрыли")
+        by_replies = (await found("сантехник"), await found("стояк"))
+        return by_text, by_comment, by_replies
+
+    by_text, by_comment, by_replies = run(scenario())
+    assert by_text == ["T1"]
+    assert by_comment == ["T2"]
+    assert by_replies == (["T1"], ["T1"])
+
+
+def test_schema_writable_without_bot(run):
+    async def scenario():
+        await db.save_request("T1", 1, "Яма на дороге у дома")
+        await db.close_db()
+        # то, что делают sqlite3 CLI, просмотрщики баз и разовые скрипты
+        conn = sqlite3.connect(db.DB_PATH)
+        with conn:
+            assert not conn.execute("SELECT name FROM sqlite_master WHERE sql LIKE '%fts_stems%'").fetchall()
+            conn.execute("UPDATE requests SET admin_comment='асфальт' WHERE ticket='T1'")
+            conn.execute("INSERT INTO requests(ticket, user_id, text, status, created_at, created_ts) "
+                         "VALUES('T2', 2, 'Прорвало трубу', 'Новый', '2025-11-10T12:00:00', 1762776000000)")
+            conn.execute("INSERT INTO replies(ticket, admin_id, text) VALUES('T2', 7, 'Бригада выехала')")
+            conn.execute("DELETE FROM requests WHERE ticket='T1'")
+        conn.close()
+        gone = await found("яма")
+        await db.rebuild_search_index()
+        return gone, await found("труба"), await found("бригада")
+
+    gone, by_text, by_reply = run(scenario())
+    # удаление индекс видит сразу, новые строки — после пересборки
+    assert gone == []
+    assert by_text == ["T2"]
+    assert by_reply == ["T2"]
+
+
+PHRASES = [
+    "течёт вода с потолка в подъезде", "не работает лифт", "прорвало трубу на улице Ленина",
+    "нет света во дворе, фонари не горят", "яма на дороге у дома", "холодные батареи, отопление не включили",
+    "запах газа на лестнице", "шумят соседи по ночам", "мусор не вывозят неделю", "сломан кран в квартире",
+]
+# запрос -> номер фразы, которую он должен находить (None — ничего)
+QUERIES = {"течь с потолка": 0, "улица Ленина": 2, "лифт": 1, "газ лестница": 6, "отопление": 5, "водопровод": None}
+
+
+def search_large_base(run, n: int):
+    """База из n заявок; для каждого запроса — (время поиска, результат) и номера фраз заявок."""
+    rnd = random.Random(1)
+    alpha = "абвгдежзиклмнопрстуфхцчшэюя"
+    filler = ["".join(rnd.choices(alpha, k=rnd.randint(4, 9))) for _ in range(20_000)]
+    picked = [rnd.randrange(len(PHRASES)) for _ in range(n)]
+    rows = [(f"T{i}", i % 5000, f"{PHRASES[p]} {' '.join(rnd.choices(filler, k=15))} дом {i % 300}",
+             "Новый", "2025-01-01T00:00:00", i) for i, p in enumerate(picked)]
+
+    async def scenario():
+        async with db.write_conn() as conn:
+            await conn.executemany(
+                "INSERT INTO requests(ticket, user_id, text, status, created_at, created_ts) VALUES(?,?,?,?,?,?)", rows
+            )
+        await db.rebuild_search_index()
+        result = {}
+        for q in QUERIES:
+            t = perf_counter()
+            found = await db.search_requests(fts_query(q), limit=5)
+            result[q] = (perf_counter() - t, found)
+        return result
+
+    return run(scenario()), picked
+
+
+def test_search_caps_frequent_words(run):
+    # на каждую фразу больше SEARCH_CANDIDATES заявок
+    result, picked = search_large_base(run, 15_000)
+    for q, (_spent, (found, total, capped)) in result.items():
+        want = QUERIES[q]
+        matching = picked.count(want) if want is not None else 0
+        # частое слово — ранжируются только SEARCH_CANDIDATES самых свежих совпадений
+        assert total == min(matching, SEARCH_CANDIDATES), q
+        assert capped == (matching > SEARCH_CANDIDATES), q
+        assert all(PHRASES[want] in r[6] for r in found), q
+    assert any(capped for _s, (_f, _t, capped) in result.values())
+
+
+@pytest.mark.benchmark
+def test_search_on_large_base(run):
+    for q, (spent, (found, _total, _capped)) in search_large_base(run, 50_000)[0].items():
+        assert found or QUERIES[q] is None, q
+        assert spent < 0.1, q
@@ -0,0 +1,147 @@
+# updates.py
+# Параллельная обработка входящих обновлений с сохранением порядка внутри чата.
+# По умолчанию PTB обрабатывает обновления строго по одному: медленный хэндлер
+# (экспорт, подтверждение рассылки) задерживает всех жителей. Здесь обновления
+# разных чатов идут параллельно (не больше UPDATE_CONCURRENCY одновременно),
+# а обновления одного чата выстраиваются в очередь за своим замком — мастер
+# создания заявки и диалоги в context.user_data видят сообщения по порядку.
+#
+# Слот глобального лимита занимается только после замка чата: обновления,
+# которые ждут свой чат, не отнимают слоты у других чатов.
+#
+# Метрики (глубина очередей, время ожидания) — snapshot(); раз в
+# UPDATE_METRICS_EVERY секунд они пишутся в лог.
+
+import asyncio
+import logging
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import UPDATE_BACKLOG, UPDATE_CONCURRENCY, UPDATE_METRICS_EVERY
+
+log = logging.getLogger("bot.updates")
+
+
+def update_key(update: object) -> Optional[int]:
+    """Ключ очереди: чат обновления, иначе отправитель. None — без упорядочивания."""
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+
+class _Chat:
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # очередь ожидающих FIFO
+        self.depth = 0              # сколько обновлений чата ждёт или выполняется
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, backlog: int = UPDATE_BACKLOG):
+        # лимит базового класса — это сколько обновлений вообще принято в работу
+        # (включая ждущие свой чат); реальный параллелизм ограничивает _slots
+        super().__init__(max(2, concurrency, backlog))
+        self.concurrency = max(1, concurrency)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._chats: Dict[int, _Chat] = {}
+        self._reporter: Optional[asyncio.Task] = None
+        self._reset_window()
+        self.pending = 0    # принято в работу: выполняется или ждёт
+        self.running = 0
+        self.processed = 0
+        # вызывается с обновлением, когда его обработка закончилась — в том числе
+        # ошибкой (повтор упал бы так же), но не отменой; воркер по нему удаляет
+        # обновление из update_inbox
+        self.on_done: Optional[Callable[[object], None]] = None
+
+    def _reset_window(self):
+        self._w_count = 0
+        self._w_total = 0.0
+        self._w_max = 0.0
+        self._w_depth = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        queued = monotonic()
+        self.pending += 1
+        key = update_key(update)
+        chat = None
+        if key is not None:
+            chat = self._chats.get(key)
+            if chat is None:
+                chat = self._chats[key] = _Chat()
+            chat.depth += 1
+            self._w_depth = max(self._w_depth, chat.depth)
+        try:
+            if chat is not None:
+                await chat.lock.acquire()
+            try:
+                async with self._slots:
+                    waited = monotonic() - queued
+                    self._w_count += 1
+                    self._w_total += waited
+                    self._w_max = max(self._w_max, waited)
+                    self.running += 1
+                    cancelled = False
+                    try:
+                        await coroutine
+                    except asyncio.CancelledError:
+                        cancelled = True
+                        raise
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+                        if self.on_done and not cancelled:
+                            self.on_done(update)
+            finally:
+                if chat is not None:
+                    chat.lock.release()
+        finally:
+            self.pending -= 1
+            if chat is not None:
+                chat.depth -= 1
+                if chat.depth == 0 and self._chats.get(key) is chat:
+                    del self._chats[key]
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """Текущее состояние и статистика ожидания с прошлого сброса."""
+        snap = {
+            "running": self.running,
+            "waiting": self.pending - self.running,
+            "chats": len(self._chats),
+            "max_depth": self._w_depth,
+            "processed": self.processed,
+            "window": self._w_count,
+            "wait_avg": self._w_total / self._w_count if self._w_count else 0.0,
+            "wait_max": self._w_max,
+        }
+        if reset:
+            self._reset_window()
+        return snap
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(UPDATE_METRICS_EVERY)
+            snap = self.snapshot(reset=True)
+            if snap["window"] or snap["running"]:
+                log.info(
+                    "Обновления: выполняется %(running)s, ждут %(waiting)s (чатов %(chats)s, "
+                    "макс. очередь чата %(max_depth)s), за период %(window)s, ожидание "
+                    "ср. %(wait_avg).3f с / макс. %(wait_max).3f с", snap
+                )
+
+    async def initialize(self) -> None:
+        if self._reporter is None:
+            self._reporter = asyncio.create_task(self._report_loop())
+
+    async def shutdown(self) -> None:
+        if self._reporter:
+            self._reporter.cancel()
+            await asyncio.gather(self._reporter, return_exceptions=True)
+            self._reporter = None
@@ -1,27 +1,66 @@
 # utils.py
 # Всякая полезная мелочь, чтобы не плодить код в main.py.
 
-from datetime import datetime
+import os
+import threading
+from datetime import datetime, timedelta
 from pathlib import Path
-from config import FILES_DIR
+from config import FILES_DIR, WORKER_ID
+
+class TicketAllocator:
+    """
+    Генератор номеров заявок в духе snowflake: время + номер процесса + счётчик.
+    Формат: T + YYYYMMDDHHMMSSmmm + WW + SS
+      - mmm — миллисекунды (UTC),
+      - WW  — WORKER_ID процесса (00–99), у каждого запущенного бота свой,
+      - SS  — порядковый номер в пределах миллисекунды (00–99).
+    Номера уникальны при любой частоте создания и сортируются по времени как строки.
+    Если счётчик в миллисекунде исчерпан (или часы ушли назад), берём следующую
+    миллисекунду «в долг» — без ожидания и без обращения к БД.
+    """
+    SEQ_LIMIT = 100
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= 99:
+            raise ValueError("WORKER_ID должен быть от 0 до 99")
+        self.worker_id = worker_id
+        self._last = datetime.min
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> str:
+        with self._lock:
+            now = datetime.utcnow()
+            now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+            if now > self._last:
+                self._last, self._seq = now, 0
+            else:
+                self._seq += 1
+                if self._seq >= self.SEQ_LIMIT:
+                    self._last, self._seq = self._last + timedelta(milliseconds=1), 0
+            ts = self._last
+            return "T" + ts.strftime("%Y%m%d%H%M%S") + f"{ts.microsecond // 1000:03d}{self.worker_id:02d}{self._seq:02d}"
+
+_ALLOCATOR = TicketAllocator(WORKER_ID)
 
 def gen_ticket() -> str:
     """
-    Генерируем удобный номер заявки по времени (UTC).
-    Формат: TYYYYMMDDHHMMSSmmm (T + дата-время + миллисекунды)
-    Пример: T20251110152312001
+    Номер новой заявки (см. TicketAllocator).
+    Пример: T202511101523120010100
     """
-    now = datetime.utcnow()
-    return "T" + now.strftime("%Y%m%d%H%M%S") + f"{int(now.microsecond/1000):03d}"
+    return _ALLOCATOR.next()
 
-def save_file_bytes(data: bytes, filename: str) -> str:
+def save_file_bytes(data: bytes, filename: str, folder: str = FILES_DIR) -> str:
     """
-    Сохраняем байты в папку ./files и возвращаем путь.
-    Сейчас не используется, но место готово, если добавим медиа/документы.
+    Сохраняем байты в папку (по умолчанию ./files) и возвращаем путь.
+    filename может содержать подпапки (media/ab/cd/…) — они создаются.
+    Запись атомарная: сначала во временный файл, потом переименование —
+    читатель никогда не увидит недописанный файл.
     """
-    folder = Path(FILES_DIR)
-    folder.mkdir(parents=True, exist_ok=True)
-    path = folder / filename
-    with open(path, "wb") as f:
+    path = Path(folder) / filename
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.part")
+    with open(tmp, "wb") as f:
         f.write(data)
+    os.replace(tmp, path)
     return str(path)
@@ -0,0 +1,248 @@
+# webhook.py
+# Альтернативы long polling (см. BOT_MODE в config.py):
+#   webhook — aiohttp-сервер принимает POST от Telegram и кладёт Update прямо
+#             в очередь приложения;
+#   ingress — тот же сервер, но обновления только сохраняются в update_inbox;
+#   worker  — процесс без сервера: забирает из update_inbox свою долю чатов
+#             и обрабатывает. Воркеров можно запустить несколько. Строка
+#             удаляется из update_inbox только после обработки обновления
+#             (см. db.claim_updates): упавший воркер ничего не теряет.
+# Запрос без правильного X-Telegram-Bot-Api-Secret-Token отклоняется (403).
+# Проверить локально можно, отправив записанный JSON Update на
+# http://WEBHOOK_LISTEN:WEBHOOK_PORT/WEBHOOK_PATH (WEBHOOK_URL можно не задавать —
+# тогда set_webhook не вызывается); то же делает tests/test_webhook.py.
+
+import asyncio
+import json
+import logging
+import signal
+from typing import Dict, List
+
+from telegram import Update
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET,
+    WORKER_ID, WORKERS_TOTAL, UPDATE_POLL_INTERVAL, UPDATE_BACKLOG, CACHE_SYNC_EVERY
+)
+from db import (
+    open_db, close_db, init_db, enqueue_update, claim_updates, ack_updates, release_updates,
+    get_cache_versions, load_admins, load_departments
+)
+from dialogs import load_dialogs
+
+log = logging.getLogger("bot.webhook")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# ключи Update, в которых есть чат/отправитель — по ним выбираем долю воркера
+_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+              "my_chat_member", "chat_member", "chat_join_request")
+_USER_KEYS = ("inline_query", "chosen_inline_result", "shipping_query",
+              "pre_checkout_query", "poll_answer")
+
+
+def update_chat_id(data: dict) -> int:
+    """Чат, к которому относится обновление (для callback — чат сообщения с кнопкой)."""
+    for key in _CHAT_KEYS:
+        obj = data.get(key)
+        if obj:
+            return (obj.get("chat") or obj.get("from") or {}).get("id", 0)
+    cq = data.get("callback_query")
+    if cq:
+        return ((cq.get("message") or {}).get("chat") or cq.get("from") or {}).get("id", 0)
+    for key in _USER_KEYS:
+        obj = data.get(key)
+        if obj:
+            return (obj.get("from") or obj.get("user") or {}).get("id", 0)
+    return 0
+
+
+def update_shard(data: dict) -> int:
+    return update_chat_id(data) % max(1, WORKERS_TOTAL)
+
+
+# ---- HTTP-сервер ----
+async def _serve(sink):
+    # aiohttp нужен только в режимах webhook/ingress
+    from aiohttp import web
+
+    async def handle(request):
+        if WEBHOOK_SECRET and request.headers.get(SECRET_HEADER) != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not isinstance(data, dict) or "update_id" not in data:
+            return web.Response(status=400)
+        await sink(data)
+        return web.Response(text="ok")
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    log.info("Webhook слушает http://%s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    return runner
+
+
+async def _set_webhook(bot):
+    if not WEBHOOK_URL:
+        log.warning("WEBHOOK_URL не задан — set_webhook пропущен (локальный режим)")
+        return
+    await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                          allowed_updates=Update.ALL_TYPES)
+
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+async def _run_app(app, feeder, after_stop=None):
+    """Жизненный цикл Application как в run_polling, но обновления подаёт feeder.
+    after_stop — когда все принятые обновления обработаны, база ещё открыта."""
+    await app.initialize()
+    try:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+        await feeder()
+    finally:
+        if app.running:
+            await app.stop()
+        if after_stop:
+            await after_stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+
+# ---- режимы ----
+def webhook_sink(app):
+    """Приёмник режима webhook: обновление сразу в очередь приложения."""
+    async def sink(data):
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    return sink
+
+
+async def ingress_sink(data):
+    """Приёмник режима ingress: обновление в update_inbox, в долю своего чата."""
+    await enqueue_update(update_shard(data), json.dumps(data, ensure_ascii=False))
+
+
+async def run_webhook_mode(app):
+    async def feeder():
+        stop = _stop_event()
+        await _set_webhook(app.bot)
+        runner = await _serve(webhook_sink(app))
+        try:
+            await stop.wait()
+        finally:
+            await runner.cleanup()
+
+    await _run_app(app, feeder)
+
+
+async def run_ingress_mode(app):
+    stop = _stop_event()
+    await open_db()
+    await init_db()
+    try:
+        async with app.bot:
+            await _set_webhook(app.bot)
+            runner = await _serve(ingress_sink)
+            try:
+                await stop.wait()
+            finally:
+                await runner.cleanup()
+    finally:
+        await close_db()
+
+
+async def _cache_sync_loop():
+    # админы, отделы и диалоги кэшируются в памяти каждого процесса — подтягиваем
+    # изменения, сделанные другими воркерами
+    seen = await get_cache_versions()
+    while True:
+        await asyncio.sleep(CACHE_SYNC_EVERY)
+        try:
+            now = await get_cache_versions()
+            if now.get("admins") != seen.get("admins"):
+                await load_admins()
+            if now.get("departments") != seen.get("departments"):
+                await load_departments()
+            if now.get("dialogs") != seen.get("dialogs"):
+                await load_dialogs()
+            seen = now
+        except Exception:
+            log.exception("Не удалось синхронизировать кэши")
+
+
+async def run_worker_mode(app):
+    shard = WORKER_ID % max(1, WORKERS_TOTAL)
+    claimed: Dict[int, int] = {}  # update_id -> id строки в update_inbox
+    done: List[int] = []          # обработаны, строки ещё не удалены
+
+    def processed(update):
+        inbox_id = claimed.pop(getattr(update, "update_id", None), None)
+        if inbox_id is not None:
+            done.append(inbox_id)
+
+    async def ack():
+        ids = done[:]
+        del done[:]
+        await ack_updates(ids)
+
+    async def feeder():
+        stop = _stop_event()
+        sync = asyncio.create_task(_cache_sync_loop()) if WORKERS_TOTAL > 1 else None
+        # у доли один воркер: всё, что помечено забранным, осталось от прошлого запуска
+        released = await release_updates(shard)
+        if released:
+            log.warning("Воркер: %s обновлений прошлого запуска не были обработаны — обрабатываю заново", released)
+        app.update_processor.on_done = processed
+        log.info("Воркер: доля %s из %s", shard, WORKERS_TOTAL)
+        try:
+            while not stop.is_set():
+                await ack()
+                # не забирать больше, чем процессор готов принять в работу
+                free = min(100, UPDATE_BACKLOG - len(claimed))
+                rows = await claim_updates(shard, WORKER_ID, free) if free > 0 else []
+                for _id, payload in rows:
+                    update = Update.de_json(json.loads(payload), app.bot)
+                    claimed[update.update_id] = _id
+                    await app.update_queue.put(update)
+                if not rows:
+                    try:
+                        await asyncio.wait_for(stop.wait(), UPDATE_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if sync:
+                sync.cancel()
+                await asyncio.gather(sync, return_exceptions=True)
+
+    await _run_app(app, feeder, after_stop=ack)
+
+
+MODES = {
+    "webhook": run_webhook_mode,
+    "ingress": run_ingress_mode,
+    "worker": run_worker_mode,
+}
+
+
+def run_server(app, mode: str):
+    if mode not in MODES:
+        raise ValueError(f"Неизвестный BOT_MODE: {mode}")
+    asyncio.run(MODES[mode](app))